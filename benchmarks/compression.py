@@ -0,0 +1,110 @@
+"""Response latency for admin list pages with and without CompressionMiddleware
+
+Each request goes through the real ASGI path (FastJSONResponse wrapped in
+CompressionMiddleware) so serialization and compression are both timed. The
+client side adds decompression plus the time to move the body over a link of
+the given bandwidth, which is where compression pays for itself.
+
+Run from the repository root: python -m benchmarks.compression
+"""
+
+import asyncio
+import gzip
+import time
+from datetime import datetime, timedelta
+
+import main
+from main import CompressionMiddleware, FastJSONResponse
+
+def build_page(rows: int) -> dict:
+    """A /api/admin/users page with ``rows`` users"""
+    now = datetime.utcnow()
+    users = [
+        {
+            "user_id": 1000000000 + i,
+            "first_name": f"User {i}",
+            "username": f"user_{i}",
+            "wallet_balance": round(i * 1.37, 2),
+            "total_earned": round(i * 2.11, 2),
+            "device_verified": i % 3 != 0,
+            "is_banned": False,
+            "referral_count": i % 7,
+            "created_at": now - timedelta(days=i),
+            "last_activity": now
+        }
+        for i in range(rows)
+    ]
+    return {"success": True, "data": {"users": users}}
+
+def decompress(encoding: str, body: bytes) -> bytes:
+    if encoding == "br":
+        return main.brotli.decompress(body)
+    if encoding == "zstd":
+        return main.zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    return body
+
+async def request(app, accept_encoding: str):
+    """Drive one GET through the ASGI app and return (content-encoding, body)"""
+    scope = {
+        "type": "http", "method": "GET", "path": "/api/admin/users",
+        "headers": [(b"accept-encoding", accept_encoding.encode("latin-1"))]
+    }
+    chunks = []
+    encoding = "identity"
+    
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    
+    async def send(message):
+        nonlocal encoding
+        if message["type"] == "http.response.start":
+            for name, value in message.get("headers", []):
+                if name == b"content-encoding":
+                    encoding = value.decode("latin-1")
+        else:
+            chunks.append(message.get("body", b""))
+    
+    await app(scope, receive, send)
+    return encoding, b"".join(chunks)
+
+def run(page_sizes=(20, 50, 100, 500), bandwidths_mbps=(2, 10, 50), iterations: int = 20):
+    """Print server time, client decode time and time-to-last-byte per page size and link speed"""
+    encodings = ["identity", "gzip"]
+    if main.brotli is not None:
+        encodings.append("br")
+    if main.zstandard is not None:
+        encodings.append("zstd")
+    
+    async def measure():
+        header = f"{'rows':>6} {'encoding':>9} {'sent KB':>9} {'server ms':>10} {'decode ms':>10}"
+        print(header + "".join(f" {f'@{mbps}Mbps ms':>12}" for mbps in bandwidths_mbps))
+        for rows in page_sizes:
+            page = build_page(rows)
+            
+            async def endpoint(scope, receive, send):
+                await FastJSONResponse(page)(scope, receive, send)
+            
+            app = CompressionMiddleware(endpoint)
+            for accept_encoding in encodings:
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    encoding, body = await request(app, accept_encoding)
+                server_ms = (time.perf_counter() - started) * 1000 / iterations
+                
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    decompress(encoding, body)
+                decode_ms = (time.perf_counter() - started) * 1000 / iterations
+                
+                line = f"{rows:>6} {encoding:>9} {len(body) / 1024:>9.1f} {server_ms:>10.3f} {decode_ms:>10.3f}"
+                for mbps in bandwidths_mbps:
+                    transfer_ms = len(body) * 8 / (mbps * 1_000_000) * 1000
+                    line += f" {server_ms + transfer_ms + decode_ms:>12.2f}"
+                print(line)
+    
+    asyncio.run(measure())
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,86 @@
+"""Payout throughput: a new ClientSession per payout vs the pooled GatewayHTTPClient
+
+Also provides a local Razorpay-style payout endpoint for load tests. To point
+the bot at it, run ``python -m benchmarks.gateway_payouts --serve`` and start
+the bot with RAZORPAY_BASE_URL=http://127.0.0.1:18080/v1 and
+RAZORPAY_LIVE_PAYOUTS=true.
+
+Run from the repository root: python -m benchmarks.gateway_payouts
+"""
+
+import asyncio
+import base64
+import sys
+import time
+import uuid
+
+import aiohttp
+from aiohttp import web
+
+from main import GatewayHTTPClient
+
+async def start_mock_payout_gateway(port: int = 18080, latency_ms: float = 20.0) -> web.AppRunner:
+    """Serve POST /v1/payouts on 127.0.0.1 with a fixed latency; returns the aiohttp runner"""
+    async def create_payout(request):
+        payload = await request.json()
+        await asyncio.sleep(latency_ms / 1000)
+        return web.json_response({
+            "id": f"pout_{uuid.uuid4().hex[:14]}",
+            "amount": payload.get("amount"),
+            "status": "processed",
+            "reference_id": request.headers.get("X-Payout-Idempotency")
+        })
+    
+    mock_app = web.Application()
+    mock_app.router.add_post("/v1/payouts", create_payout)
+    runner = web.AppRunner(mock_app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+def run(payouts: int = 500, concurrency: int = 20, port: int = 18080):
+    base_url = f"http://127.0.0.1:{port}/v1"
+    payload = {"account_number": "2323230001548326", "amount": 10000, "currency": "INR", "mode": "UPI"}
+    headers = {"Authorization": "Basic " + base64.b64encode(b"key:secret").decode("ascii")}
+    
+    async def measure():
+        runner = await start_mock_payout_gateway(port)
+        semaphore = asyncio.Semaphore(concurrency)
+        pooled = GatewayHTTPClient("benchmark", base_url, headers, pool_size=concurrency)
+        
+        async def per_call_session(index):
+            async with semaphore:
+                async with aiohttp.ClientSession(headers=headers) as session:
+                    async with session.post(f"{base_url}/payouts", json=payload) as response:
+                        await response.json()
+        
+        async def pooled_session(index):
+            async with semaphore:
+                await pooled.post_json("/payouts", payload, headers={"X-Payout-Idempotency": f"wd-{index}"})
+        
+        try:
+            for label, call in (("session per payout", per_call_session), ("pooled session", pooled_session)):
+                started = time.perf_counter()
+                await asyncio.gather(*(call(index) for index in range(payouts)))
+                elapsed = time.perf_counter() - started
+                print(f"{label:>20}: {payouts / elapsed:8.1f} payouts/s ({elapsed * 1000 / payouts:.2f} ms avg)")
+        finally:
+            await pooled.close()
+            await runner.cleanup()
+    
+    asyncio.run(measure())
+
+async def serve(port: int = 18080):
+    """Keep the mock gateway running until interrupted"""
+    runner = await start_mock_payout_gateway(port)
+    print(f"Mock payout gateway on http://127.0.0.1:{port}/v1")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    if "--serve" in sys.argv:
+        asyncio.run(serve())
+    else:
+        run()
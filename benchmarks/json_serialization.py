@@ -0,0 +1,51 @@
+"""Serialization time for a 1000-row user list: jsonable_encoder + json vs FastJSONResponse
+
+Run from the repository root: python -m benchmarks.json_serialization
+"""
+
+import json
+import time
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+
+from main import FastJSONResponse
+
+def run(rows: int = 1000, iterations: int = 20):
+    users = [
+        {
+            "user_id": 1000000000 + i,
+            "name": f"User {i}",
+            "username": f"user_{i}",
+            "wallet_balance": round(i * 1.37, 2),
+            "total_earned": round(i * 2.11, 2),
+            "device_verified": i % 3 != 0,
+            "is_active": True,
+            "is_banned": False,
+            "created_at": datetime.utcnow() - timedelta(days=i),
+            "last_activity": datetime.utcnow(),
+            "total_referrals": i % 7,
+            "campaigns_completed": i % 5
+        }
+        for i in range(rows)
+    ]
+    
+    def legacy():
+        formatted = [
+            {**user, "created_at": user["created_at"].isoformat(), "last_activity": user["last_activity"].isoformat()}
+            for user in users
+        ]
+        return json.dumps(jsonable_encoder({"success": True, "data": {"users": formatted}})).encode("utf-8")
+    
+    def fast():
+        return FastJSONResponse({"success": True, "data": {"users": users}}).body
+    
+    for label, serialize in (("jsonable_encoder + json", legacy), ("FastJSONResponse", fast)):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            serialize()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / iterations
+        print(f"{label:>24}: {elapsed_ms:8.2f} ms per {rows}-row response")
+
+if __name__ == "__main__":
+    run()
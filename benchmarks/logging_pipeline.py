@@ -0,0 +1,61 @@
+"""Event-loop time spent logging the per-update webhook/callback lines
+
+Compares the previous setup (eager f-strings, synchronous StreamHandler)
+with the queued, lazy, sampled pipeline. Output goes to /dev/null.
+
+Run from the repository root: python -m benchmarks.logging_pipeline
+"""
+
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+from main import LOG_TEXT_FORMAT, JsonLogFormatter, LazyQueueHandler, LogSamplingFilter
+
+def make_logger(name: str, handler: logging.Handler) -> logging.Logger:
+    bench_logger = logging.getLogger(f"benchmark.{name}")
+    bench_logger.handlers = [handler]
+    bench_logger.propagate = False
+    bench_logger.setLevel(logging.INFO)
+    return bench_logger
+
+def run(updates: int = 20000, sample_rate: float = 0.1):
+    devnull = open(os.devnull, "w")
+    
+    sync_handler = logging.StreamHandler(devnull)
+    sync_handler.setFormatter(logging.Formatter(LOG_TEXT_FORMAT))
+    legacy_logger = make_logger("legacy", sync_handler)
+    
+    bench_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+    queued_handler = LazyQueueHandler(bench_queue)
+    queued_handler.addFilter(LogSamplingFilter({"benchmark.queued": sample_rate}))
+    output = logging.StreamHandler(devnull)
+    output.setFormatter(JsonLogFormatter())
+    listener = logging.handlers.QueueListener(bench_queue, output)
+    listener.start()
+    queued_logger = make_logger("queued", queued_handler)
+    
+    try:
+        started = time.perf_counter()
+        for user_id in range(updates):
+            legacy_logger.info(f"📨 Webhook: callback_query from user {user_id}")
+            legacy_logger.info(f"🔘 Callback received: wallet_menu from user {user_id}")
+        legacy_us = (time.perf_counter() - started) * 1_000_000 / updates
+        
+        started = time.perf_counter()
+        for user_id in range(updates):
+            queued_logger.info("📨 Webhook: %s from user %s", "callback_query", user_id)
+            queued_logger.info("🔘 Callback received: %s from user %s", "wallet_menu", user_id)
+        queued_us = (time.perf_counter() - started) * 1_000_000 / updates
+    finally:
+        listener.stop()
+        devnull.close()
+    
+    print(f"{'sync f-string':>28}: {legacy_us:7.2f} µs of event-loop time per update")
+    print(f"{f'queued, sampled {sample_rate:.0%}':>28}: {queued_us:7.2f} µs of event-loop time per update")
+    print(f"{'saved':>28}: {legacy_us - queued_us:7.2f} µs per update")
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,65 @@
+"""Throughput of a read/update mix at different maxPoolSize values against a local mongod
+
+Uses the scratch database ``walletbot_benchmark`` (dropped afterwards) on
+BENCHMARK_MONGODB_URL, default mongodb://localhost:27017.
+
+Run from the repository root: python -m benchmarks.mongo_pool
+"""
+
+import asyncio
+import os
+import time
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from main import COLLECTION_PROFILES, available_compressors, mongo_client_options
+
+async def run_pool(url: str, pool_size: int, operations: int, concurrency: int):
+    client = AsyncIOMotorClient(url, **mongo_client_options(maxPoolSize=pool_size, minPoolSize=0))
+    collection = client.walletbot_benchmark.users
+    await collection.delete_many({})
+    await collection.create_index("user_id", unique=True)
+    await collection.insert_many([
+        {"user_id": index, "wallet_balance": 0.0, "last_activity": datetime.utcnow()} for index in range(1000)
+    ])
+    relaxed = client.walletbot_benchmark.get_collection("users", **COLLECTION_PROFILES["relaxed"])
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    
+    async def operation(index: int):
+        async with semaphore:
+            started = time.perf_counter()
+            user_id = index % 1000
+            await collection.find_one({"user_id": user_id})
+            if index % 4 == 0:
+                await collection.update_one({"user_id": user_id}, {"$inc": {"wallet_balance": 1}})
+            else:
+                await relaxed.update_one({"user_id": user_id}, {"$set": {"last_activity": datetime.utcnow()}})
+            latencies.append(time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(operation(index) for index in range(operations)))
+    elapsed = time.perf_counter() - started
+    
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f"pool {pool_size:>4}: {operations / elapsed:8.0f} ops/s  p50 {p50:6.2f} ms  p99 {p99:7.2f} ms")
+    
+    await client.drop_database("walletbot_benchmark")
+    client.close()
+
+def run(pool_sizes=(5, 20, 50, 100), operations: int = 5000, concurrency: int = 200, url: str = None):
+    url = url or os.getenv("BENCHMARK_MONGODB_URL", "mongodb://localhost:27017")
+    
+    async def measure():
+        print(f"compressors: {','.join(available_compressors()) or 'none'}, concurrency {concurrency}")
+        for pool_size in pool_sizes:
+            await run_pool(url, pool_size, operations, concurrency)
+    
+    asyncio.run(measure())
+
+if __name__ == "__main__":
+    run()
@@ -9,17 +9,38 @@ import os
 import sys
 import asyncio
 import secrets
+import random
 import hashlib
+import hmac
 import base64
 import uuid
 import json
 import io
+import csv
+import decimal
+import gzip
+import zlib
 import zipfile
 import logging
-from datetime import datetime, timedelta
+import logging.handlers
+import atexit
+import mimetypes
+import time
+import bisect
+import threading
+import heapq
+import re
+import contextvars
+import functools
+import contextlib
+import queue
+import socket
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Optional, Any
 
 # -------------------- Third-Party ---------------------------
+import aiohttp
 from fastapi import (
     FastAPI, HTTPException, Depends, Request,
     File, UploadFile, Form
@@ -27,10 +48,14 @@ from fastapi import (
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.responses import (
-    HTMLResponse, JSONResponse, FileResponse, StreamingResponse
+    HTMLResponse, JSONResponse, FileResponse, StreamingResponse, Response
 )
 from fastapi.staticfiles import StaticFiles
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, WriteConcern, monitoring
+from pymongo.read_preferences import Primary, SecondaryPreferred
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import Decimal128, ObjectId
 
 from telegram import (
     Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup,
@@ -41,14 +66,128 @@ from telegram.ext import (
     CallbackQueryHandler, ContextTypes, filters
 )
 from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
+
+try:
+    import brotli  # optional: responses fall back to gzip without it
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard  # optional: zstd content coding
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson  # fast JSON responses; stdlib json is used when missing
+except ImportError:
+    orjson = None
 
 # -------------------- Logging -------------------------------
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+# Records are queued from the event loop and formatted/written by a
+# background listener thread. Hot paths log with %-style arguments so the
+# message is only built if the record survives level and sampling checks.
+#   LOG_LEVEL         root level (default INFO)
+#   LOG_FORMAT        "text" or "json"
+#   LOG_SAMPLE_RATES  per-logger keep rate for INFO and below, e.g.
+#                     "wallet-bot.webhook=0.1,wallet-bot.callbacks=0.05"
+LOG_TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+LOG_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None)).keys()) | {"message", "asctime"}
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line; ``extra={...}`` fields are included as-is"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class LogSamplingFilter(logging.Filter):
+    """Keep a fraction of INFO/DEBUG records per logger (warnings and errors always pass)"""
+    
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+        rate = self.rates.get(record.name)
+        return rate is None or random.random() < rate
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread
+    
+    The stdlib version formats in prepare(), i.e. on the event loop.
+    """
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for part in (spec or "").split(","):
+        name, _, rate = part.partition("=")
+        if name.strip() and rate.strip():
+            try:
+                rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+            except ValueError:
+                pass
+    return rates
+
+log_listener: Optional[logging.handlers.QueueListener] = None
+
+def configure_logging(level: str = None, fmt: str = None, sample_rates: str = None, stream=None):
+    """Route all logging through a queue to a background writer"""
+    global log_listener
+    
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    fmt = (fmt or os.getenv("LOG_FORMAT", "text")).lower()
+    rates = parse_sample_rates(sample_rates if sample_rates is not None else os.getenv("LOG_SAMPLE_RATES", ""))
+    
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(
+        JsonLogFormatter() if fmt == "json" else logging.Formatter(LOG_TEXT_FORMAT, datefmt="%Y-%m-%d %H:%M:%S")
+    )
+    
+    if log_listener is not None:
+        log_listener.stop()
+    log_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    log_listener.start()
+    
+    queue_handler = LazyQueueHandler(log_queue)
+    if rates:
+        queue_handler.addFilter(LogSamplingFilter(rates))
+    
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+def stop_logging():
+    """Flush queued records; runs at interpreter exit so shutdown logs are kept"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+configure_logging()
+atexit.register(stop_logging)
 logger = logging.getLogger("wallet-bot")
+webhook_logger = logger.getChild("webhook")
+callback_logger = logger.getChild("callbacks")
+wallet_logger = logger.getChild("wallet")
 
 # -------------------- Environment / Constants ---------------
 BOT_TOKEN: str = os.getenv("BOT_TOKEN", "REPLACE_ME")
@@ -75,6 +214,131 @@ RENDER_EXTERNAL_URL: str = os.getenv(
 
 PORT: int = int(os.getenv("PORT", 8000))
 
+# MongoDB client profile
+MONGO_MAX_POOL_SIZE: int = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE: int = int(os.getenv("MONGO_MIN_POOL_SIZE", 5))
+MONGO_MAX_IDLE_TIME_MS: int = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 120000))
+MONGO_MAX_CONNECTING: int = int(os.getenv("MONGO_MAX_CONNECTING", 4))
+MONGO_WAIT_QUEUE_TIMEOUT_MS: int = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000))
+# Wire compression, in order of preference; unavailable codecs are skipped
+MONGO_COMPRESSORS: str = os.getenv("MONGO_COMPRESSORS", "zstd,snappy,zlib")
+MONGO_RETRY_WRITES: bool = os.getenv("MONGO_RETRY_WRITES", "true").lower() == "true"
+MONGO_RETRY_READS: bool = os.getenv("MONGO_RETRY_READS", "true").lower() == "true"
+# Default write concern (wallet, withdrawal and transaction writes); activity
+# and telemetry writes use the "relaxed" collection profile instead
+MONGO_WRITE_CONCERN: str = os.getenv("MONGO_WRITE_CONCERN", "majority")
+MONGO_WRITE_JOURNAL: bool = os.getenv("MONGO_WRITE_JOURNAL", "true").lower() == "true"
+# Analytics/admin reads may go to secondaries at most this stale (>= 90s, -1 = unbounded)
+MONGO_ANALYTICS_MAX_STALENESS_SECONDS: int = int(os.getenv("MONGO_ANALYTICS_MAX_STALENESS_SECONDS", 120))
+# After an admin write, analytics reads stay on the primary this long so the
+# admin sees their own change (defaults to the staleness bound)
+MONGO_READ_YOUR_WRITES_SECONDS: int = int(os.getenv("MONGO_READ_YOUR_WRITES_SECONDS", MONGO_ANALYTICS_MAX_STALENESS_SECONDS))
+
+# Near-duplicate device detection: how many of the 12 fingerprint
+# components two devices must share before they are flagged
+DEVICE_SIMILARITY_MIN_SHARED: int = int(os.getenv("DEVICE_SIMILARITY_MIN_SHARED", 10))
+
+# Responses smaller than this (bytes) are sent uncompressed
+RESPONSE_COMPRESSION_MIN_SIZE: int = int(os.getenv("RESPONSE_COMPRESSION_MIN_SIZE", 1024))
+
+# Full recount of the materialized dashboard counters (seconds)
+DASHBOARD_STATS_RECONCILE_SECONDS: int = int(os.getenv("DASHBOARD_STATS_RECONCILE_SECONDS", 900))
+
+# Analytics rollups: how often new events are folded in, and how long
+# per-minute buckets are kept (hour/day buckets are kept indefinitely)
+ANALYTICS_ROLLUP_INTERVAL_SECONDS: int = int(os.getenv("ANALYTICS_ROLLUP_INTERVAL_SECONDS", 60))
+ANALYTICS_MINUTE_RETENTION_DAYS: int = int(os.getenv("ANALYTICS_MINUTE_RETENTION_DAYS", 7))
+# Longest range /api/admin/analytics will read, in buckets of the requested granularity
+ANALYTICS_MAX_QUERY_BUCKETS: int = int(os.getenv("ANALYTICS_MAX_QUERY_BUCKETS", 2000))
+
+# Transactions older than this move from the hot collection to monthly archives
+TRANSACTION_HOT_DAYS: int = int(os.getenv("TRANSACTION_HOT_DAYS", 90))
+TRANSACTION_ARCHIVE_INTERVAL_SECONDS: int = int(os.getenv("TRANSACTION_ARCHIVE_INTERVAL_SECONDS", 3600))
+
+# Ledger verification (wallet_balance vs. transaction replay)
+LEDGER_VERIFY_INTERVAL_SECONDS: int = int(os.getenv("LEDGER_VERIFY_INTERVAL_SECONDS", 86400))
+LEDGER_VERIFY_CONCURRENCY: int = int(os.getenv("LEDGER_VERIFY_CONCURRENCY", 8))
+LEDGER_VERIFY_BATCH_SIZE: int = int(os.getenv("LEDGER_VERIFY_BATCH_SIZE", 5000))
+
+# Automatic withdrawal worker pool
+WITHDRAWAL_WORKERS: int = int(os.getenv("WITHDRAWAL_WORKERS", 32))
+WITHDRAWAL_GATEWAY_CONCURRENCY: int = int(os.getenv("WITHDRAWAL_GATEWAY_CONCURRENCY", 4))
+WITHDRAWAL_MAX_ATTEMPTS: int = int(os.getenv("WITHDRAWAL_MAX_ATTEMPTS", 5))
+
+# Registers the in-process simulated payout gateway (staging / load tests only)
+PAYOUT_SIMULATED_GATEWAY: bool = os.getenv("PAYOUT_SIMULATED_GATEWAY", "false").lower() == "true"
+
+# Background health probes (/health serves the last result without I/O)
+HEALTH_PROBE_INTERVAL_SECONDS: int = int(os.getenv("HEALTH_PROBE_INTERVAL_SECONDS", 15))
+HEALTH_PROBE_TIMEOUT_SECONDS: float = float(os.getenv("HEALTH_PROBE_TIMEOUT_SECONDS", 5))
+
+# Bearer token required by /metrics (open when unset, e.g. behind a private network)
+METRICS_TOKEN: str = os.getenv("METRICS_TOKEN", "")
+
+# Mongo query profiler: commands slower than the threshold enter the top-N
+# list; the same query shape repeated this often in one update is an N+1
+QUERY_PROFILER_ENABLED: bool = os.getenv("QUERY_PROFILER_ENABLED", "true").lower() == "true"
+SLOW_QUERY_THRESHOLD_MS: float = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", 50))
+SLOW_QUERY_TOP_N: int = int(os.getenv("SLOW_QUERY_TOP_N", 50))
+N_PLUS_ONE_THRESHOLD: int = int(os.getenv("N_PLUS_ONE_THRESHOLD", 5))
+
+# Update/admin request tracing: sampled traces (plus every over-budget root
+# span) are appended as OTLP JSON lines to TRACE_EXPORT_PATH, which rotates to
+# .1 ... .N once it reaches TRACE_EXPORT_MAX_BYTES
+TRACE_SAMPLE_RATE: float = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+TRACE_EXPORT_PATH: str = os.getenv("TRACE_EXPORT_PATH", "traces/spans.otlp.jsonl")
+TRACE_EXPORT_MAX_BYTES: int = int(os.getenv("TRACE_EXPORT_MAX_BYTES", 50 * 1024 * 1024))
+TRACE_EXPORT_BACKUPS: int = int(os.getenv("TRACE_EXPORT_BACKUPS", 3))
+TRACE_ROUND_TRIP_BUDGET: int = int(os.getenv("TRACE_ROUND_TRIP_BUDGET", 12))
+TRACE_LATENCY_BUDGET_MS: float = float(os.getenv("TRACE_LATENCY_BUDGET_MS", 1500))
+
+# Payment gateway HTTP clients (one pooled keep-alive session per gateway)
+GATEWAY_HTTP_POOL_SIZE: int = int(os.getenv("GATEWAY_HTTP_POOL_SIZE", 20))
+GATEWAY_HTTP_TIMEOUT_SECONDS: float = float(os.getenv("GATEWAY_HTTP_TIMEOUT_SECONDS", 30))
+GATEWAY_DNS_CACHE_SECONDS: int = int(os.getenv("GATEWAY_DNS_CACHE_SECONDS", 300))
+# Razorpay payouts only hit the real API when explicitly enabled; the base
+# URL can point at the local mock gateway for load tests (python -m benchmarks.gateway_payouts --serve)
+RAZORPAY_LIVE_PAYOUTS: bool = os.getenv("RAZORPAY_LIVE_PAYOUTS", "false").lower() == "true"
+RAZORPAY_BASE_URL: str = os.getenv("RAZORPAY_BASE_URL", "https://api.razorpay.com/v1")
+
+# Clustered mode: several uvicorn workers/replicas share the webhook load; the
+# holder of a Mongo lease runs singleton duties (webhook, schedulers, rollups)
+CLUSTER_MODE: bool = os.getenv("CLUSTER_MODE", "false").lower() == "true"
+WEB_CONCURRENCY: int = int(os.getenv("WEB_CONCURRENCY", 1))
+CLUSTER_LEASE_SECONDS: int = int(os.getenv("CLUSTER_LEASE_SECONDS", 30))
+# Where per-user conversation state lives: "memory" (one process) or "mongo"
+SHARED_STATE_BACKEND: str = os.getenv("SHARED_STATE_BACKEND", "mongo" if CLUSTER_MODE else "memory").lower()
+
+# External API keys: documents are cached for API_KEY_CACHE_SECONDS (a
+# deactivated key keeps working on other replicas for at most that long) and
+# usage counters are written in batches every API_USAGE_FLUSH_SECONDS
+API_KEY_CACHE_SECONDS: int = int(os.getenv("API_KEY_CACHE_SECONDS", 60))
+API_USAGE_FLUSH_SECONDS: int = int(os.getenv("API_USAGE_FLUSH_SECONDS", 10))
+# Hourly sliding-window limits: "memory" counts per process, "mongo" merges the
+# counts of all replicas every RATE_LIMIT_SYNC_SECONDS
+RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "mongo" if CLUSTER_MODE else "memory").lower()
+RATE_LIMIT_SYNC_SECONDS: int = int(os.getenv("RATE_LIMIT_SYNC_SECONDS", 5))
+RATE_LIMIT_MAX_KEYS: int = int(os.getenv("RATE_LIMIT_MAX_KEYS", 10000))
+# Largest batch accepted by /api/external/add-earnings/batch (each item counts
+# against the key's hourly rate limit)
+EXTERNAL_BATCH_MAX_ITEMS: int = int(os.getenv("EXTERNAL_BATCH_MAX_ITEMS", 1000))
+
+# Idempotency keys for wallet-crediting APIs: responses are replayed for
+# IDEMPOTENCY_TTL_SECONDS; a reservation left by a crashed request can be
+# taken over after IDEMPOTENCY_LOCK_SECONDS
+IDEMPOTENCY_TTL_SECONDS: int = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", 86400))
+IDEMPOTENCY_LOCK_SECONDS: int = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", 60))
+IDEMPOTENCY_CACHE_SIZE: int = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 10000))
+
+# Partner webhooks: wallet events are buffered per API key and POSTed as signed
+# batches every PARTNER_WEBHOOK_BATCH_SECONDS; failed batches are retried with
+# backoff and moved to partner_webhook_dead_letters after the last attempt
+PARTNER_WEBHOOK_BATCH_SECONDS: float = float(os.getenv("PARTNER_WEBHOOK_BATCH_SECONDS", 2.0))
+PARTNER_WEBHOOK_BATCH_MAX_EVENTS: int = int(os.getenv("PARTNER_WEBHOOK_BATCH_MAX_EVENTS", 100))
+PARTNER_WEBHOOK_MAX_ATTEMPTS: int = int(os.getenv("PARTNER_WEBHOOK_MAX_ATTEMPTS", 8))
+PARTNER_WEBHOOK_TIMEOUT_SECONDS: float = float(os.getenv("PARTNER_WEBHOOK_TIMEOUT_SECONDS", 10))
+PARTNER_WEBHOOK_MAX_BUFFER: int = int(os.getenv("PARTNER_WEBHOOK_MAX_BUFFER", 10000))
+
 # ------------- Emoji Map (safe Unicode characters) ----------
 EMOJI: Dict[str, str] = {
     "check": "✅", "cross": "❌", "pending": "⏳", "warn": "⚠️",
@@ -88,23 +352,1143 @@ EMOJI: Dict[str, str] = {
 os.makedirs("uploads/screenshots", exist_ok=True)
 os.makedirs("uploads/campaign_images", exist_ok=True)
 
+# -------------------- Compressed Responses ------------------
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """Parse an Accept-Encoding header into {coding: qvalue}"""
+    encodings = {}
+    for part in (header or "").split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        encodings[token] = quality
+    return encodings
+
+def choose_encoding(header: str, available, preference=("br", "zstd", "gzip")) -> str:
+    """Pick the best content coding the client accepts, or 'identity'"""
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get("*", 0.0)
+    best, best_quality = "identity", 0.0
+    for coding in preference:
+        if coding not in available:
+            continue
+        quality = accepted.get(coding, wildcard)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+class CompressedAsset:
+    """Immutable response body with precomputed gzip/brotli variants and ETag"""
+    
+    def __init__(self, body: bytes, media_type: str, cache_control: str):
+        self.body = body
+        self.media_type = media_type
+        self.cache_control = cache_control
+        # Weak ETag: the same validator covers every encoded representation
+        self.etag = f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.variants: Dict[str, bytes] = {"identity": body}
+        
+        compressed = gzip.compress(body, compresslevel=9)
+        if len(compressed) < len(body):
+            self.variants["gzip"] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=11)
+            if len(compressed) < len(body):
+                self.variants["br"] = compressed
+    
+    def not_modified(self, request: Request) -> bool:
+        """True when the client's cached copy is still current"""
+        if_none_match = request.headers.get("if-none-match", "")
+        return self.etag in [tag.strip() for tag in if_none_match.split(",")]
+    
+    def response(self, request: Request, cache_control: str = None) -> Response:
+        """Serve the best variant for this request (304 when unchanged)"""
+        headers = {
+            "ETag": self.etag,
+            "Cache-Control": cache_control or self.cache_control,
+            "Vary": "Accept-Encoding"
+        }
+        if self.not_modified(request):
+            return Response(status_code=304, headers=headers)
+        
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""), self.variants)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=self.variants[encoding], media_type=self.media_type, headers=headers)
+
+class PrerenderedPageCache:
+    """HTML pages rendered once into compressed byte buffers"""
+    
+    def __init__(self):
+        self.renderers: Dict[str, Any] = {}
+        self.pages: Dict[str, CompressedAsset] = {}
+    
+    def register(self, name: str, renderer, cache_control: str = "no-cache"):
+        """Register a page renderer (a callable returning the HTML string)"""
+        self.renderers[name] = (renderer, cache_control)
+        self.pages.pop(name, None)
+    
+    def build(self, name: str) -> CompressedAsset:
+        """Render and compress a single page"""
+        renderer, cache_control = self.renderers[name]
+        page = CompressedAsset(renderer().encode("utf-8"), "text/html; charset=utf-8", cache_control)
+        self.pages[name] = page
+        return page
+    
+    def build_all(self) -> int:
+        """Render every registered page (called at startup)"""
+        for name in self.renderers:
+            self.build(name)
+        return len(self.pages)
+    
+    def respond(self, name: str, request: Request) -> Response:
+        """Serve a page, rendering it on first use if startup hasn't yet"""
+        page = self.pages.get(name) or self.build(name)
+        return page.response(request)
+
+prerendered_pages = PrerenderedPageCache()
+
+class CompressionMiddleware:
+    """ASGI response compression: gzip, plus brotli/zstd when those modules are installed"""
+    
+    COMPRESSIBLE_TYPES = (
+        "application/json", "application/x-ndjson", "application/javascript",
+        "image/svg+xml", "text/"
+    )
+    
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6,
+                 brotli_quality: int = 4, zstd_level: int = 3):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.zstd_level = zstd_level
+        self.available = {"gzip"}
+        if brotli is not None:
+            self.available.add("br")
+        if zstandard is not None:
+            self.available.add("zstd")
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        accept_encoding = ""
+        for name, value in scope.get("headers", []):
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        
+        encoding = choose_encoding(accept_encoding, self.available)
+        if encoding == "identity":
+            await self.app(scope, receive, send)
+            return
+        
+        await self.app(scope, receive, _CompressedSender(self, encoding, send))
+    
+    def is_compressible(self, status: int, headers: List) -> bool:
+        """Only compress uncompressed, compressible content"""
+        if status < 200 or status in (204, 304):
+            return False
+        content_type = ""
+        for name, value in headers:
+            if name.lower() == b"content-encoding":
+                return False
+            if name.lower() == b"content-type":
+                content_type = value.decode("latin-1").lower()
+        return content_type.startswith(self.COMPRESSIBLE_TYPES)
+    
+    def compressor(self, encoding: str) -> "StreamCompressor":
+        """Create a streaming compressor for the negotiated coding"""
+        return StreamCompressor(encoding, self.gzip_level, self.brotli_quality, self.zstd_level)
+
+class StreamCompressor:
+    """Incremental compressor with a common interface for gzip, brotli and zstd"""
+    
+    def __init__(self, encoding: str, gzip_level: int = 6, brotli_quality: int = 4, zstd_level: int = 3):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=brotli_quality)
+        elif encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=zstd_level).compressobj()
+        else:
+            self._compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)  # 31 = gzip container
+    
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        """Compress a chunk; ``flush`` forces buffered output out for streaming"""
+        if self.encoding == "br":
+            output = self._compressor.process(data)
+            return output + self._compressor.flush() if flush else output
+        output = self._compressor.compress(data)
+        if not flush:
+            return output
+        if self.encoding == "zstd":
+            return output + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return output + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    def finish(self) -> bytes:
+        """Terminate the stream"""
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+class _CompressedSender:
+    """ASGI send wrapper that compresses the response body on the fly"""
+    
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send = send
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+    
+    async def __call__(self, message):
+        message_type = message["type"]
+        
+        if message_type == "http.response.start":
+            self.start_message = message
+            self.passthrough = not self.middleware.is_compressible(
+                message["status"], message.get("headers", [])
+            )
+            if self.passthrough:
+                await self.send(message)
+            return
+        
+        if message_type != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+        
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        
+        if self.compressor is None:
+            # First body chunk decides: small single-chunk responses go out as-is
+            if not more_body and len(body) < self.middleware.minimum_size:
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+            
+            self.compressor = self.middleware.compressor(self.encoding)
+            headers = [
+                (name, value) for name, value in self.start_message.get("headers", [])
+                if name.lower() not in (b"content-length", b"vary")
+            ]
+            vary = [value for name, value in self.start_message.get("headers", []) if name.lower() == b"vary"]
+            headers.append((b"content-encoding", self.encoding.encode("latin-1")))
+            headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+            
+            if not more_body:
+                compressed = self.compressor.compress(body) + self.compressor.finish()
+                headers.append((b"content-length", str(len(compressed)).encode("latin-1")))
+                await self.send({**self.start_message, "headers": headers})
+                await self.send({"type": "http.response.body", "body": compressed})
+                return
+            
+            await self.send({**self.start_message, "headers": headers})
+        
+        if more_body:
+            chunk = self.compressor.compress(body, flush=True)
+            if chunk:
+                await self.send({"type": "http.response.body", "body": chunk, "more_body": True})
+        else:
+            chunk = self.compressor.compress(body) + self.compressor.finish()
+            await self.send({"type": "http.response.body", "body": chunk})
+
+
+# -------------------- JSON Responses ------------------------
+def _json_default(value):
+    """Serialize the BSON/stdlib types that show up in Mongo documents"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (bytes, bytearray)):  # includes bson.Binary
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dump_json(content: Any) -> bytes:
+    """Encode content as compact UTF-8 JSON (datetimes and ObjectIds handled natively)"""
+    if orjson is not None:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson
+    
+    Returning this directly from an endpoint also skips FastAPI's
+    jsonable_encoder pass, so raw Mongo documents can be sent as-is.
+    """
+    
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
+
+# -------------------- Metrics -------------------------------
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labelnames, labelvalues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _ValueChild:
+    __slots__ = ("value", "lock")
+    
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()  # Mongo listener callbacks run on driver threads
+    
+    def inc(self, amount: float = 1.0):
+        with self.lock:
+            self.value += amount
+    
+    def dec(self, amount: float = 1.0):
+        with self.lock:
+            self.value -= amount
+    
+    def set(self, value: float):
+        self.value = value
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "lock")
+    
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+    
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+class Metric:
+    """Prometheus metric family; ``labels()`` children are created once and reused
+    
+    Hot paths should resolve their child up front (or via a small dict) so an
+    observation is a bisect plus a locked add.
+    """
+    
+    kind = "untyped"
+    
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.children: Dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self.children[()] = self._new_child()
+    
+    def _new_child(self):
+        return _ValueChild()
+    
+    def labels(self, *labelvalues):
+        child = self.children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(labelvalues, self._new_child())
+        return child
+    
+    def inc(self, amount: float = 1.0):
+        self.children[()].inc(amount)
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, child in list(self.children.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {child.value}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+class Gauge(Metric):
+    kind = "gauge"
+    
+    def __init__(self, name: str, documentation: str, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback  # evaluated at scrape time: returns {labelvalues: value}
+    
+    def dec(self, amount: float = 1.0):
+        self.children[()].dec(amount)
+    
+    def set(self, value: float):
+        self.children[()].set(value)
+    
+    def render(self) -> List[str]:
+        if self.callback is not None:
+            try:
+                for labelvalues, value in self.callback().items():
+                    self.labels(*labelvalues).set(value)
+            except Exception as e:
+                logger.error(f"❌ Gauge {self.name} callback error: {e}")
+        return super().render()
+
+class Histogram(Metric):
+    kind = "histogram"
+    
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+    
+    def observe(self, value: float):
+        self.children[()].observe(value)
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labelvalues, child in list(self.children.items()):
+            with child.lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labelvalues)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Collects metric families and renders the Prometheus text format"""
+    
+    def __init__(self):
+        self.metrics: List[Metric] = []
+    
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+    
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def gauge(self, name: str, documentation: str, labelnames=(), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback))
+    
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+WEBHOOK_UPDATE_TYPES = ("message", "callback_query", "inline_query", "unknown")
+BOT_HANDLER_SECONDS = metrics.histogram(
+    "walletbot_bot_handler_seconds", "Telegram update handler latency", ("handler",))
+WEBHOOK_SECONDS = metrics.histogram(
+    "walletbot_webhook_seconds", "End-to-end /webhook processing latency", ("update_type",))
+WEBHOOK_IN_FLIGHT = metrics.gauge("walletbot_webhook_in_flight", "Webhook updates currently being processed")
+MONGO_COMMAND_SECONDS = metrics.histogram(
+    "walletbot_mongo_command_seconds", "MongoDB command latency", ("collection", "command"))
+MONGO_COMMAND_FAILURES = metrics.counter(
+    "walletbot_mongo_command_failures_total", "Failed MongoDB commands", ("collection", "command"))
+TELEGRAM_API_SECONDS = metrics.histogram(
+    "walletbot_telegram_api_seconds", "Telegram Bot API call latency", ("method",))
+TELEGRAM_API_RATE_LIMITED = metrics.counter(
+    "walletbot_telegram_api_rate_limited_total", "Telegram Bot API 429 responses", ("method",))
+WALLET_MUTATIONS = metrics.counter(
+    "walletbot_wallet_mutations_total", "Wallet balance updates", ("direction",))
+WALLET_MUTATION_AMOUNT = metrics.counter(
+    "walletbot_wallet_mutation_amount_total", "Absolute amount moved by wallet updates", ("direction",))
+
+# Callback router prefixes, in the order CallbackQueryHandler checks them
+CALLBACK_ROUTE_PREFIXES = ("wallet", "campaign", "withdraw", "referral", "admin", "gift", "channel", "verify_", "screenshot")
+
+def callback_route(callback_data: str) -> str:
+    for prefix in CALLBACK_ROUTE_PREFIXES:
+        if callback_data.startswith(prefix):
+            return prefix
+    return "general"
+
+# Pre-created children for fixed label sets
+CALLBACK_ROUTE_SECONDS = {
+    prefix: BOT_HANDLER_SECONDS.labels(f"callback:{prefix}")
+    for prefix in CALLBACK_ROUTE_PREFIXES + ("general",)
+}
+WEBHOOK_SECONDS_BY_TYPE = {update_type: WEBHOOK_SECONDS.labels(update_type) for update_type in WEBHOOK_UPDATE_TYPES}
+WALLET_MUTATIONS_BY_DIRECTION = {
+    direction: (WALLET_MUTATIONS.labels(direction), WALLET_MUTATION_AMOUNT.labels(direction))
+    for direction in ("credit", "debit")
+}
+
+def timed_handler(name: str, callback):
+    """Wrap a bot handler callback so its latency is recorded under ``name``"""
+    child = BOT_HANDLER_SECONDS.labels(name)
+    
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            child.observe(time.perf_counter() - started)
+    
+    wrapper.__name__ = getattr(callback, "__name__", name)
+    return wrapper
+
+class MongoMetricsListener(monitoring.CommandListener):
+    """Feeds per-collection/command latency into the metrics registry"""
+    
+    IGNORED_COMMANDS = frozenset(("hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue", "endSessions"))
+    
+    def __init__(self):
+        self._in_flight: Dict[tuple, str] = {}
+        self._children: Dict[tuple, tuple] = {}
+    
+    def _child(self, collection: str, command: str) -> tuple:
+        key = (collection, command)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = (
+                MONGO_COMMAND_SECONDS.labels(collection, command),
+                MONGO_COMMAND_FAILURES.labels(collection, command)
+            )
+        return child
+    
+    def started(self, event):
+        if event.command_name in self.IGNORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        self._in_flight[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else "-"
+    
+    def succeeded(self, event):
+        collection = self._in_flight.pop((event.connection_id, event.request_id), None)
+        if collection is not None:
+            self._child(collection, event.command_name)[0].observe(event.duration_micros / 1_000_000)
+    
+    def failed(self, event):
+        collection = self._in_flight.pop((event.connection_id, event.request_id), None)
+        if collection is not None:
+            latency, failures = self._child(collection, event.command_name)
+            latency.observe(event.duration_micros / 1_000_000)
+            failures.inc()
+
+class TelegramMetricsRequest(HTTPXRequest):
+    """HTTPXRequest that records Bot API latency and 429s per method"""
+    
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        start_ns = time.time_ns()
+        code = 0
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        finally:
+            TELEGRAM_API_SECONDS.labels(api_method).observe(time.perf_counter() - started)
+            update_tracer.record_telegram_call(api_method, start_ns, code)
+        if code == 429:
+            TELEGRAM_API_RATE_LIMITED.labels(api_method).inc()
+        return code, payload
+
+# -------------------- Query Profiler ------------------------
+# Motor runs commands on executor threads but copies the caller's context,
+# so these ContextVars are visible to the command listener.
+query_origin: contextvars.ContextVar = contextvars.ContextVar("query_origin", default=None)
+query_update_trace: contextvars.ContextVar = contextvars.ContextVar("query_update_trace", default=None)
+
+def profiled_queries(cls):
+    """Class decorator: attribute Mongo commands issued by each coroutine method to that method"""
+    for attribute, value in list(vars(cls).items()):
+        if attribute.startswith("__") or not asyncio.iscoroutinefunction(value):
+            continue
+        
+        def wrap(method, origin):
+            @functools.wraps(method)
+            async def wrapper(*args, **kwargs):
+                token = query_origin.set(origin)
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    query_origin.reset(token)
+            return wrapper
+        
+        setattr(cls, attribute, wrap(value, f"{cls.__name__}.{attribute}"))
+    return cls
+
+def query_shape(value: Any, depth: int = 0) -> Any:
+    """Replace literal values with placeholders, keeping field names and operators"""
+    if depth > 6:
+        return "?"
+    if isinstance(value, dict):
+        return {key: query_shape(item, depth + 1) for key, item in value.items()}
+    if isinstance(value, list):
+        if value and all(isinstance(item, dict) for item in value):
+            return [query_shape(item, depth + 1) for item in value]
+        return "[?]"
+    return "?"
+
+def command_filter(command_name: str, command: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Extract the query filter from a raw command document"""
+    if command_name in ("find", "count", "distinct"):
+        return command.get("filter", command.get("query"))
+    if command_name == "findAndModify":
+        return command.get("query")
+    if command_name in ("update", "delete"):
+        statements = command.get("updates") or command.get("deletes") or [{}]
+        return statements[0].get("q")
+    if command_name == "aggregate":
+        for stage in command.get("pipeline", []):
+            if "$match" in stage:
+                return stage["$match"]
+        return {}
+    return None
+
+class UpdateQueryTrace:
+    """Mongo round trips made while handling one Telegram update"""
+    
+    __slots__ = ("label", "round_trips", "shapes", "total_ms")
+    
+    def __init__(self, label: str):
+        self.label = label
+        self.round_trips = 0
+        self.shapes: Dict[tuple, int] = {}
+        self.total_ms = 0.0
+
+class QueryProfiler(monitoring.CommandListener):
+    """Per-origin command statistics, top-N slow queries and N+1 detection
+    
+    Commands are grouped by (origin, collection, command, filter shape). The
+    last concrete filter of each group is kept in memory only, so
+    ``explain_top_shapes`` can check the winning plan for collection scans.
+    """
+    
+    IGNORED_COMMANDS = MongoMetricsListener.IGNORED_COMMANDS | {"explain", "getMore", "killCursors", "createIndexes"}
+    MAX_GROUPS = 2000
+    
+    def __init__(self, slow_threshold_ms: float = SLOW_QUERY_THRESHOLD_MS, top_n: int = SLOW_QUERY_TOP_N,
+                 n_plus_one_threshold: int = N_PLUS_ONE_THRESHOLD):
+        self.slow_threshold_ms = slow_threshold_ms
+        self.top_n = top_n
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self.lock:
+            self._in_flight: Dict[tuple, tuple] = {}
+            self.groups: Dict[tuple, Dict[str, Any]] = {}
+            self.slow_queries: List[tuple] = []  # min-heap of (duration_ms, seq, record)
+            self.n_plus_one: Dict[tuple, Dict[str, Any]] = {}
+            self.update_round_trips: Dict[str, Dict[str, float]] = {}
+            self.plans: Dict[tuple, Dict[str, Any]] = {}
+            self.started_at = datetime.utcnow()
+            self._sequence = 0
+    
+    # -------- listener callbacks (driver threads) --------
+    
+    def started(self, event):
+        if event.command_name in self.IGNORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        query = command_filter(event.command_name, event.command)
+        shape = json.dumps(query_shape(query), sort_keys=True) if query is not None else "-"
+        self._in_flight[(event.connection_id, event.request_id)] = (
+            query_origin.get() or "unattributed",
+            collection if isinstance(collection, str) else "-",
+            shape,
+            query,
+            query_update_trace.get()
+        )
+    
+    def succeeded(self, event):
+        self._record(event)
+    
+    def failed(self, event):
+        self._record(event, failed=True)
+    
+    def _record(self, event, failed: bool = False):
+        context = self._in_flight.pop((event.connection_id, event.request_id), None)
+        if context is None:
+            return
+        origin, collection, shape, query, trace = context
+        duration_ms = event.duration_micros / 1000
+        key = (origin, collection, event.command_name, shape)
+        
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                if len(self.groups) >= self.MAX_GROUPS:
+                    return
+                group = self.groups[key] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "failures": 0}
+            group["count"] += 1
+            group["total_ms"] += duration_ms
+            group["max_ms"] = max(group["max_ms"], duration_ms)
+            group["failures"] += 1 if failed else 0
+            group["sample_filter"] = query
+            
+            if duration_ms >= self.slow_threshold_ms:
+                self._sequence += 1
+                record = {
+                    "origin": origin, "collection": collection, "command": event.command_name,
+                    "shape": shape, "duration_ms": round(duration_ms, 2), "at": datetime.utcnow()
+                }
+                if len(self.slow_queries) < self.top_n:
+                    heapq.heappush(self.slow_queries, (duration_ms, self._sequence, record))
+                elif duration_ms > self.slow_queries[0][0]:
+                    heapq.heapreplace(self.slow_queries, (duration_ms, self._sequence, record))
+            
+            if trace is not None:
+                trace.round_trips += 1
+                trace.total_ms += duration_ms
+                trace.shapes[key] = trace.shapes.get(key, 0) + 1
+    
+    # -------- per-update accounting --------
+    
+    def finish_update(self, trace: UpdateQueryTrace):
+        """Fold one update's round trips into the stats and flag repeated shapes"""
+        with self.lock:
+            stats = self.update_round_trips.setdefault(
+                trace.label, {"updates": 0, "round_trips": 0, "max_round_trips": 0, "total_ms": 0.0}
+            )
+            stats["updates"] += 1
+            stats["round_trips"] += trace.round_trips
+            stats["max_round_trips"] = max(stats["max_round_trips"], trace.round_trips)
+            stats["total_ms"] += trace.total_ms
+            
+            for key, repeats in trace.shapes.items():
+                if repeats < self.n_plus_one_threshold:
+                    continue
+                pattern = self.n_plus_one.setdefault(key, {"occurrences": 0, "max_repeats": 0})
+                pattern["occurrences"] += 1
+                pattern["max_repeats"] = max(pattern["max_repeats"], repeats)
+                pattern["update_type"] = trace.label
+    
+    # -------- index analysis --------
+    
+    async def explain_top_shapes(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Explain the most expensive query shapes and record which ones scan a whole collection"""
+        if not (db_connected and db_client):
+            return []
+        
+        with self.lock:
+            candidates = sorted(
+                ((key, group) for key, group in self.groups.items()
+                 if key[2] in ("find", "count", "findAndModify", "update", "delete", "aggregate")
+                 and key[1] != "-" and group.get("sample_filter") is not None),
+                key=lambda item: item[1]["total_ms"], reverse=True
+            )[:limit]
+        
+        database = db_client.walletbot
+        findings = []
+        for key, group in candidates:
+            origin, collection, command_name, shape = key
+            try:
+                explained = await database.command({
+                    "explain": {"find": collection, "filter": group["sample_filter"]},
+                    "verbosity": "queryPlanner"
+                })
+                winning_plan = json.dumps(explained.get("queryPlanner", {}).get("winningPlan", {}), default=str)
+                plan = {
+                    "collscan": "COLLSCAN" in winning_plan,
+                    "stages": sorted(set(re.findall(r'"stage": "([A-Z_]+)"', winning_plan))),
+                    "explained_at": datetime.utcnow()
+                }
+            except Exception as e:
+                plan = {"error": str(e), "explained_at": datetime.utcnow()}
+            
+            with self.lock:
+                self.plans[(collection, shape)] = plan
+            if plan.get("collscan"):
+                logger.warning(f"⚠️ COLLSCAN on {collection} for {shape} (from {origin})")
+            findings.append({"origin": origin, "collection": collection, "command": command_name, "shape": shape, **plan})
+        return findings
+    
+    def report(self, limit: int = 25) -> Dict[str, Any]:
+        """Snapshot for the admin endpoint"""
+        with self.lock:
+            groups = sorted(self.groups.items(), key=lambda item: item[1]["total_ms"], reverse=True)[:limit]
+            slow = sorted(self.slow_queries, reverse=True)
+            n_plus_one = sorted(self.n_plus_one.items(), key=lambda item: item[1]["occurrences"], reverse=True)[:limit]
+            round_trips = {label: dict(stats) for label, stats in self.update_round_trips.items()}
+            collscans = [
+                {"collection": collection, "shape": shape, **plan}
+                for (collection, shape), plan in self.plans.items() if plan.get("collscan")
+            ]
+        
+        for stats in round_trips.values():
+            stats["avg_round_trips"] = round(stats["round_trips"] / stats["updates"], 2) if stats["updates"] else 0
+        
+        return {
+            "since": self.started_at,
+            "top_queries": [
+                {
+                    "origin": origin, "collection": collection, "command": command_name, "shape": shape,
+                    "count": group["count"], "total_ms": round(group["total_ms"], 2),
+                    "avg_ms": round(group["total_ms"] / group["count"], 2), "max_ms": round(group["max_ms"], 2),
+                    "failures": group["failures"]
+                }
+                for (origin, collection, command_name, shape), group in groups
+            ],
+            "slow_queries": [record for _, _, record in slow],
+            "n_plus_one": [
+                {"origin": origin, "collection": collection, "command": command_name, "shape": shape, **pattern}
+                for (origin, collection, command_name, shape), pattern in n_plus_one
+            ],
+            "round_trips_per_update": round_trips,
+            "collection_scans": collscans
+        }
+
+query_profiler = QueryProfiler()
+
+ID_PATH_SEGMENT = re.compile(r"^(?=.*\d)[\w-]{6,}$|^\d+$")
+
+def normalize_request_path(path: str) -> str:
+    """Replace id-like path segments with {id} to keep label cardinality bounded"""
+    return "/".join("{id}" if ID_PATH_SEGMENT.match(segment) else segment for segment in path.split("/"))
+
+class QueryOriginMiddleware:
+    """Attribute queries made directly in HTTP endpoints to a normalized request path"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = query_origin.set(f"{scope['method']} {normalize_request_path(scope['path'])}")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            query_origin.reset(token)
+
+# -------------------- Update Tracing ------------------------
+UPDATE_BUDGET_EXCEEDED = metrics.counter(
+    "walletbot_update_budget_exceeded_total", "Root spans over the round-trip or latency budget", ("kind",))
+
+class Trace:
+    """One root span (Telegram update or admin request) and its children"""
+    
+    __slots__ = ("trace_id", "root_span_id", "name", "attributes", "sampled", "start_ns",
+                 "spans", "mongo_round_trips", "telegram_calls", "pending")
+    
+    def __init__(self, name: str, attributes: Dict[str, Any], sampled: bool):
+        self.trace_id = secrets.token_hex(16)
+        self.root_span_id = secrets.token_hex(8)
+        self.name = name
+        self.attributes = attributes
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.spans: List[Dict[str, Any]] = []
+        self.mongo_round_trips = 0
+        self.telegram_calls = 0
+        self.pending: Dict[tuple, tuple] = {}
+    
+    def add_span(self, name: str, start_ns: int, end_ns: int, attributes: Dict[str, Any], error: str = None):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": secrets.token_hex(8),
+            "parentSpanId": self.root_span_id,
+            "name": name,
+            "kind": 3,  # CLIENT
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(end_ns),
+            "attributes": _otlp_attributes(attributes)
+        }
+        if error:
+            span["status"] = {"code": 2, "message": error}
+        self.spans.append(span)
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    converted = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            converted.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            converted.append({"key": key, "value": {"intValue": str(value)}})
+        elif isinstance(value, float):
+            converted.append({"key": key, "value": {"doubleValue": value}})
+        elif value is not None:
+            converted.append({"key": key, "value": {"stringValue": str(value)}})
+    return converted
+
+current_trace: contextvars.ContextVar = contextvars.ContextVar("current_trace", default=None)
+
+class UpdateTracer(monitoring.CommandListener):
+    """Root spans per update/admin request with Mongo, Bot API and file I/O children
+    
+    Round trips and latency are counted for every root span so budgets are
+    enforced regardless of sampling; child spans are only collected for
+    sampled traces. Export happens on a background thread.
+    """
+    
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, export_path: str = TRACE_EXPORT_PATH,
+                 round_trip_budget: int = TRACE_ROUND_TRIP_BUDGET, latency_budget_ms: float = TRACE_LATENCY_BUDGET_MS,
+                 max_bytes: int = TRACE_EXPORT_MAX_BYTES, backups: int = TRACE_EXPORT_BACKUPS):
+        self.sample_rate = sample_rate
+        self.export_path = export_path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.round_trip_budget = round_trip_budget
+        self.latency_budget_ms = latency_budget_ms
+        self.exported = 0
+        self.over_budget = 0
+        self._queue: "queue.Queue" = queue.Queue(maxsize=10000)
+        self._writer: Optional[threading.Thread] = None
+        self._resource = {"attributes": _otlp_attributes({
+            "service.name": "enterprise-wallet-bot",
+            "service.instance.id": f"{os.uname().nodename if hasattr(os, 'uname') else 'local'}-{os.getpid()}"
+        })}
+    
+    # -------- root spans --------
+    
+    @contextlib.contextmanager
+    def root_span(self, name: str, attributes: Dict[str, Any] = None):
+        trace = Trace(name, attributes or {}, random.random() < self.sample_rate)
+        token = current_trace.set(trace)
+        started = time.perf_counter()
+        error = None
+        try:
+            yield trace
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            current_trace.reset(token)
+            self._finish(trace, (time.perf_counter() - started) * 1000, error)
+    
+    def _finish(self, trace: Trace, duration_ms: float, error: str = None):
+        exceeded = []
+        if trace.mongo_round_trips + trace.telegram_calls > self.round_trip_budget:
+            exceeded.append("round_trips")
+        if duration_ms > self.latency_budget_ms:
+            exceeded.append("latency")
+        for kind in exceeded:
+            UPDATE_BUDGET_EXCEEDED.labels(kind).inc()
+        if exceeded:
+            self.over_budget += 1
+            logger.warning(
+                "⚠️ %s over budget (%s): %d mongo + %d telegram round trips, %.1f ms",
+                trace.name, ",".join(exceeded), trace.mongo_round_trips, trace.telegram_calls, duration_ms
+            )
+        
+        if not (trace.sampled or exceeded):
+            return
+        
+        root = {
+            "traceId": trace.trace_id,
+            "spanId": trace.root_span_id,
+            "name": trace.name,
+            "kind": 2,  # SERVER
+            "startTimeUnixNano": str(trace.start_ns),
+            "endTimeUnixNano": str(trace.start_ns + int(duration_ms * 1_000_000)),
+            "attributes": _otlp_attributes({
+                **trace.attributes,
+                "mongo.round_trips": trace.mongo_round_trips,
+                "telegram.calls": trace.telegram_calls,
+                "budget.exceeded": ",".join(exceeded) or None,
+                "trace.sampled": trace.sampled
+            })
+        }
+        if error:
+            root["status"] = {"code": 2, "message": error}
+        
+        try:
+            self._queue.put_nowait([root] + trace.spans)
+        except queue.Full:
+            return
+        self._ensure_writer()
+    
+    # -------- child spans --------
+    
+    @contextlib.contextmanager
+    def span(self, name: str, attributes: Dict[str, Any] = None):
+        """Child span under the current trace (no-op when unsampled or outside a trace)"""
+        trace = current_trace.get()
+        if trace is None or not trace.sampled:
+            yield
+            return
+        start_ns = time.time_ns()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            trace.add_span(name, start_ns, time.time_ns(), attributes or {}, error)
+    
+    def record_telegram_call(self, api_method: str, start_ns: int, status_code: int):
+        trace = current_trace.get()
+        if trace is None:
+            return
+        trace.telegram_calls += 1
+        if trace.sampled:
+            trace.add_span(f"telegram.{api_method}", start_ns, time.time_ns(), {
+                "rpc.system": "telegram", "rpc.method": api_method, "http.status_code": status_code
+            }, error=f"HTTP {status_code}" if status_code >= 400 else None)
+    
+    # -------- Mongo command listener (driver threads) --------
+    
+    def started(self, event):
+        trace = current_trace.get()
+        if trace is None or event.command_name in MongoMetricsListener.IGNORED_COMMANDS:
+            return
+        trace.mongo_round_trips += 1
+        if trace.sampled:
+            collection = event.command.get(event.command_name)
+            trace.pending[(event.connection_id, event.request_id)] = (
+                time.time_ns(), collection if isinstance(collection, str) else None
+            )
+    
+    def succeeded(self, event):
+        self._end_command(event)
+    
+    def failed(self, event):
+        self._end_command(event, error=str(getattr(event, "failure", "failed")))
+    
+    def _end_command(self, event, error: str = None):
+        trace = current_trace.get()
+        if trace is None or not trace.sampled:
+            return
+        pending = trace.pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        start_ns, collection = pending
+        trace.add_span(f"mongodb.{event.command_name}", start_ns, start_ns + event.duration_micros * 1000, {
+            "db.system": "mongodb", "db.operation": event.command_name, "db.mongodb.collection": collection,
+            "origin": query_origin.get()
+        }, error)
+    
+    # -------- export --------
+    
+    def _ensure_writer(self):
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._write_loop, name="trace-exporter", daemon=True)
+            self._writer.start()
+    
+    def _write_loop(self):
+        directory = os.path.dirname(self.export_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 200:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._rotate_if_full()
+                with open(self.export_path, "ab") as export_file:
+                    for spans in batch:
+                        export_file.write(dump_json({"resourceSpans": [{
+                            "resource": self._resource,
+                            "scopeSpans": [{"scope": {"name": "walletbot.tracer"}, "spans": spans}]
+                        }]}) + b"\n")
+                self.exported += len(batch)
+            except Exception as e:
+                logger.error(f"❌ Trace export error: {e}")
+    
+    def _rotate_if_full(self):
+        """spans.jsonl -> spans.jsonl.1 -> ... -> .<backups> (oldest dropped)"""
+        try:
+            if os.path.getsize(self.export_path) < self.max_bytes:
+                return
+        except FileNotFoundError:
+            return
+        if self.backups <= 0:
+            os.remove(self.export_path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            older = f"{self.export_path}.{index}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.export_path}.{index + 1}")
+        os.replace(self.export_path, f"{self.export_path}.1")
+    
+    def status(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "round_trip_budget": self.round_trip_budget,
+            "latency_budget_ms": self.latency_budget_ms,
+            "exported_traces": self.exported,
+            "over_budget": self.over_budget,
+            "export_queue": self._queue.qsize(),
+            "export_path": self.export_path
+        }
+
+update_tracer = UpdateTracer()
+
+class AdminWriteTracker:
+    """Note admin writes so QueryRouter can give the admin read-your-writes"""
+    
+    READ_METHODS = ("GET", "HEAD", "OPTIONS")
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/api/admin"):
+            if scope["method"] not in self.READ_METHODS:
+                await query_router.mark_admin_write()
+            else:
+                await query_router.sync_admin_write()
+        await self.app(scope, receive, send)
+
+class AdminTracingMiddleware:
+    """Open a root span for every admin API request"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api/admin"):
+            await self.app(scope, receive, send)
+            return
+        name = f"{scope['method']} {normalize_request_path(scope['path'])}"
+        with update_tracer.root_span(name, {"http.method": scope["method"], "http.route": name.split(" ", 1)[1]}):
+            await self.app(scope, receive, send)
+
 # -------------------- FastAPI app ---------------------------
 app = FastAPI(
     title="Enterprise Wallet Bot – Single-File Build",
     version="1.0.0",
     docs_url="/docs",
     redoc_url="/redoc",
+    default_response_class=FastJSONResponse,
 )
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_credentials=True,
     allow_methods=["*"], allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware, minimum_size=RESPONSE_COMPRESSION_MIN_SIZE)
+if QUERY_PROFILER_ENABLED:
+    app.add_middleware(QueryOriginMiddleware)
+app.add_middleware(AdminTracingMiddleware)
+app.add_middleware(AdminWriteTracker)
 basic_auth = HTTPBasic()
 
 # -------------------- Global Runtime Objects ---------------
 db_client: Optional[AsyncIOMotorClient] = None
 db_connected: bool = False
+# Multi-document transactions need a replica set or sharded cluster (set in init_database)
+db_supports_transactions: bool = False
 wallet_bot = None  # will hold Telegram bot wrapper instance later
 
 
@@ -119,17 +1503,64 @@ wallet_bot = None  # will hold Telegram bot wrapper instance later
 # ============================================================
 
 # -------------------- Database Connection -------------------
+def available_compressors(preferred: str = MONGO_COMPRESSORS) -> List[str]:
+    """Requested wire compressors whose codec module is installed"""
+    installed = {"zlib"}
+    if zstandard is not None:
+        installed.add("zstd")
+    try:
+        import snappy  # noqa: F401  (python-snappy)
+        installed.add("snappy")
+    except ImportError:
+        pass
+    return [name.strip() for name in preferred.split(",") if name.strip() in installed]
+
+def mongo_client_options(**overrides) -> Dict[str, Any]:
+    """Motor client keyword arguments for the configured DB profile"""
+    write_concern = int(MONGO_WRITE_CONCERN) if MONGO_WRITE_CONCERN.isdigit() else MONGO_WRITE_CONCERN
+    options = {
+        "serverSelectionTimeoutMS": 10000,
+        "connectTimeoutMS": 10000,
+        "socketTimeoutMS": 10000,
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "maxConnecting": MONGO_MAX_CONNECTING,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "retryWrites": MONGO_RETRY_WRITES,
+        "retryReads": MONGO_RETRY_READS,
+        "w": write_concern,
+        "journal": MONGO_WRITE_JOURNAL,
+        "appname": "enterprise-wallet-bot"
+    }
+    compressors = available_compressors()
+    if compressors:
+        options["compressors"] = ",".join(compressors)
+    options.update(overrides)
+    return options
+
+# Per-collection option profiles for EnhancedUserModel.get_collection
+COLLECTION_PROFILES: Dict[str, Dict[str, Any]] = {
+    # client defaults: primary reads, configured write concern
+    "default": {},
+    # last_activity and similar bookkeeping: acknowledged by the primary only
+    "relaxed": {"write_concern": WriteConcern(w=1, j=False)},
+    # dashboards, statistics and list pages
+    "analytics": {"read_preference": SecondaryPreferred(max_staleness=MONGO_ANALYTICS_MAX_STALENESS_SECONDS)},
+    # must observe the latest committed write
+    "primary": {"read_preference": Primary()}
+}
+
 async def init_database() -> bool:
     """Initialize MongoDB connection with proper error handling"""
-    global db_client, db_connected
+    global db_client, db_connected, db_supports_transactions
     
     try:
         clean_url = MONGODB_URL.strip().replace('\n', '').replace('\r', '')
         db_client = AsyncIOMotorClient(
             clean_url,
-            serverSelectionTimeoutMS=10000,
-            connectTimeoutMS=10000,
-            socketTimeoutMS=10000
+            event_listeners=[MongoMetricsListener(), update_tracer] + ([query_profiler] if QUERY_PROFILER_ENABLED else []),
+            **mongo_client_options()
         )
         
         # Test connection
@@ -137,6 +1568,14 @@ async def init_database() -> bool:
         db_connected = True
         logger.info("✅ Database connected successfully")
         
+        hello = await db_client.admin.command('hello')
+        db_supports_transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+        if not db_supports_transactions:
+            logger.warning(
+                "⚠️ MongoDB is a standalone server: keyed and bulk wallet credits write the ledger row "
+                "and the balance separately (run a replica set for atomic credits)"
+            )
+        
         # Setup collections and indexes
         await setup_database_collections()
         await setup_default_bot_settings()
@@ -158,10 +1597,37 @@ async def setup_database_collections():
         
         # Create unique indexes
         await db.users.create_index("user_id", unique=True)
+        await db.users.create_index("created_at")
+        await db.users.create_index("device_verified_at", sparse=True)
+        await db.transactions.create_index("timestamp")
+        await db.transactions.create_index([("user_id", 1), ("timestamp", -1)])
+        await db.transaction_archive_index.create_index("user_id", unique=True)
+        await db.balance_checkpoints.create_index("user_id", unique=True)
+        await db.ledger_reports.create_index("report_id", unique=True)
+        await db.ledger_discrepancies.create_index([("report_id", 1), ("user_id", 1)])
+        await db.withdrawal_requests.create_index("request_time")
+        await db.withdrawal_requests.create_index("processed_time", sparse=True)
+        await db.withdrawal_jobs.create_index("request_id", unique=True)
+        await db.withdrawal_jobs.create_index([("status", 1), ("next_attempt_at", 1)])
+        await db.analytics_rollups.create_index([("metric", 1), ("granularity", 1), ("bucket", 1)])
+        await db.analytics_rollups.create_index("expires_at", expireAfterSeconds=0)
         await db.device_fingerprints.create_index("fingerprint", unique=True)
+        await db.device_similarity_index.create_index("fingerprint", unique=True)
+        await db.device_similarity_index.create_index("band_keys")
         await db.campaigns.create_index("campaign_id", unique=True)
         await db.gift_codes.create_index("code", unique=True)
         await db.withdrawal_requests.create_index("request_id", unique=True)
+        await db.shared_state.create_index("expires_at", expireAfterSeconds=0)
+        await db.rate_limit_counters.create_index("expires_at", expireAfterSeconds=0)
+        await db.api_keys.create_index("api_key", unique=True)
+        await db.idempotency_keys.create_index("expires_at", expireAfterSeconds=0)
+        await db.partner_webhook_deliveries.create_index([("status", 1), ("next_attempt_at", 1)])
+        await db.partner_webhook_dead_letters.create_index("delivery_id", unique=True)
+        await db.partner_users.create_index([("user_id", 1), ("api_key", 1)], unique=True)
+        await db.transactions.create_index(
+            "idempotency_key", unique=True,
+            partialFilterExpression={"idempotency_key": {"$exists": True}}
+        )
         
         logger.info("✅ Database collections and indexes created")
         
@@ -224,6 +1690,235 @@ async def setup_default_bot_settings():
     except Exception as e:
         logger.error(f"❌ Default settings creation error: {e}")
 
+# -------------------- Background Tasks ----------------------
+class PeriodicTask:
+    """Run a coroutine function on a fixed interval in the background"""
+    
+    def __init__(self, name: str, func, interval_seconds: float, initial_delay: float = 0,
+                 leader_only: bool = False):
+        self.name = name
+        self.func = func
+        self.interval_seconds = interval_seconds
+        self.initial_delay = initial_delay
+        self.leader_only = leader_only  # skipped on replicas not holding the cluster lease
+        self.last_run: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Schedule the loop on the running event loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name=f"periodic:{self.name}")
+    
+    async def _run(self):
+        await asyncio.sleep(self.initial_delay)
+        while True:
+            if self.leader_only and not leader_election.is_leader:
+                await asyncio.sleep(self.interval_seconds)
+                continue
+            try:
+                await self.func()
+                self.last_run = datetime.utcnow()
+                self.last_error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"❌ Periodic task {self.name} error: {e}")
+            await asyncio.sleep(self.interval_seconds)
+    
+    async def stop(self):
+        """Cancel the loop and wait for it to finish"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+# Started in startup_event, stopped in shutdown_event
+periodic_tasks: List[PeriodicTask] = []
+
+# -------------------- Cluster Coordination --------------------
+
+@profiled_queries
+class LeaderElection:
+    """Single Mongo lease document electing one replica for singleton duties
+    
+    Lease expiry is compared against the server clock ($$NOW), so replica clock
+    skew cannot produce two holders. Locally a node only trusts its lease until
+    CLUSTER_LEASE_SECONDS after the renewal that granted it was sent.
+    """
+    
+    LEASE_ID = "leader"
+    
+    def __init__(self, user_model_instance, lease_seconds: int = CLUSTER_LEASE_SECONDS):
+        self.user_model = user_model_instance
+        self.lease_seconds = lease_seconds
+        self.node_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.on_elected: List = []  # coroutine functions run each time this node becomes leader
+        self.elections = 0
+        self._valid_until = 0.0
+    
+    @property
+    def is_leader(self) -> bool:
+        if not CLUSTER_MODE:
+            return True
+        return time.monotonic() < self._valid_until
+    
+    async def campaign(self) -> bool:
+        """Acquire or renew the lease; returns whether this node now leads"""
+        if not CLUSTER_MODE:
+            return True
+        
+        leases = self.user_model.get_collection('cluster_leases')
+        if leases is None:
+            self._valid_until = 0.0
+            return False
+        
+        was_leader = self.is_leader
+        sent_at = time.monotonic()
+        try:
+            lease = await leases.find_one_and_update(
+                {
+                    "_id": self.LEASE_ID,
+                    "$or": [
+                        {"holder": self.node_id},
+                        {"$expr": {"$lt": ["$expires_at", "$$NOW"]}}
+                    ]
+                },
+                [{"$set": {
+                    "holder": self.node_id,
+                    "expires_at": {"$add": ["$$NOW", self.lease_seconds * 1000]},
+                    "renewed_at": "$$NOW"
+                }}],
+                upsert=True,
+                return_document=True
+            )
+        except DuplicateKeyError:
+            lease = None  # held by another live node
+        except Exception as e:
+            logger.error(f"❌ Leader lease renewal error: {e}")
+            lease = None
+        
+        if lease and lease.get("holder") == self.node_id:
+            self._valid_until = sent_at + self.lease_seconds
+        else:
+            self._valid_until = 0.0
+        
+        if self.is_leader and not was_leader:
+            self.elections += 1
+            logger.info(f"👑 {self.node_id} elected cluster leader")
+            for callback in self.on_elected:
+                try:
+                    await callback()
+                except Exception as e:
+                    logger.error(f"❌ Leader election callback error: {e}")
+        elif was_leader and not self.is_leader:
+            logger.warning(f"⚠️ {self.node_id} lost the cluster lease")
+        
+        return self.is_leader
+    
+    async def release(self):
+        """Hand the lease back so another replica takes over without waiting for expiry"""
+        if not CLUSTER_MODE or not self.is_leader:
+            return
+        leases = self.user_model.get_collection('cluster_leases')
+        if leases is None:
+            return
+        try:
+            await leases.delete_one({"_id": self.LEASE_ID, "holder": self.node_id})
+            self._valid_until = 0.0
+            logger.info(f"👑 {self.node_id} released the cluster lease")
+        except Exception as e:
+            logger.error(f"❌ Leader lease release error: {e}")
+    
+    async def status(self) -> Dict[str, Any]:
+        lease = None
+        leases = self.user_model.get_collection('cluster_leases')
+        if CLUSTER_MODE and leases is not None:
+            lease = await leases.find_one({"_id": self.LEASE_ID}, {"_id": 0})
+        return {
+            "cluster_mode": CLUSTER_MODE,
+            "node_id": self.node_id,
+            "is_leader": self.is_leader,
+            "elections_won": self.elections,
+            "lease_seconds": self.lease_seconds,
+            "lease": lease
+        }
+
+class InMemoryKVStore:
+    """Process-local key/value store with per-key expiry (single-process deployments)"""
+    
+    SWEEP_INTERVAL_SECONDS = 60
+    
+    def __init__(self):
+        self._data: Dict[str, tuple] = {}
+        self._next_sweep = time.monotonic() + self.SWEEP_INTERVAL_SECONDS
+    
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            return None
+        return value
+    
+    async def set(self, key: str, value: Any, ttl_seconds: float):
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._data = {k: entry for k, entry in self._data.items() if entry[1] > now}
+            self._next_sweep = now + self.SWEEP_INTERVAL_SECONDS
+        self._data[key] = (value, now + ttl_seconds)
+    
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+@profiled_queries
+class MongoKVStore:
+    """Key/value store on a TTL collection, shared by every worker and replica"""
+    
+    def __init__(self, user_model_instance, collection_name: str = "shared_state"):
+        self.user_model = user_model_instance
+        self.collection_name = collection_name
+    
+    async def get(self, key: str) -> Optional[Any]:
+        collection = self.user_model.get_collection(self.collection_name)
+        if collection is None:
+            return None
+        # the TTL monitor only runs once a minute, so expiry is also checked here
+        doc = await collection.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.utcnow()}}, {"value": 1}
+        )
+        return doc["value"] if doc else None
+    
+    async def set(self, key: str, value: Any, ttl_seconds: float):
+        collection = self.user_model.get_collection(self.collection_name)
+        if collection is None:
+            return
+        await collection.update_one(
+            {"_id": key},
+            {"$set": {"value": value, "expires_at": datetime.utcnow() + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+    
+    async def delete(self, key: str):
+        collection = self.user_model.get_collection(self.collection_name)
+        if collection is None:
+            return
+        await collection.delete_one({"_id": key})
+
+def create_shared_state_store(user_model_instance):
+    """Pick the SHARED_STATE_BACKEND implementation"""
+    if SHARED_STATE_BACKEND == "mongo":
+        return MongoKVStore(user_model_instance)
+    if CLUSTER_MODE:
+        logger.warning("⚠️ CLUSTER_MODE with in-memory shared state - conversation state is per process")
+    return InMemoryKVStore()
+
 # -------------------- Security & Auth Helpers ---------------
 def create_simple_token(data: Dict[str, Any]) -> str:
     """Create simple base64 token (JWT-free implementation)"""
@@ -308,23 +2003,210 @@ async def safe_send_message(bot, chat_id: int, text: str, reply_markup=None, par
 #  Append this directly after CHUNK 2.
 # ============================================================
 
+# -------------------- Device Similarity Index ---------------
+# Order matters: generate_device_fingerprint hashes the components in
+# exactly this order, so existing fingerprints stay stable.
+DEVICE_FINGERPRINT_COMPONENTS = (
+    'screen_resolution', 'user_agent_hash', 'timezone_offset', 'platform',
+    'language', 'canvas_hash', 'webgl_hash', 'hardware_concurrency',
+    'memory', 'touch_support', 'color_depth', 'screen_orientation'
+)
+
+@profiled_queries
+class DeviceSimilarityIndex:
+    """Near-duplicate device detection over per-component fingerprint hashes.
+    
+    The 12 components are split into (12 - min_shared + 1) bands. Two devices
+    sharing at least ``min_shared`` components differ in at most
+    (12 - min_shared) places, so by pigeonhole they agree on every component
+    of at least one band. Looking up band keys through a multikey index finds
+    every such candidate without scanning ``device_fingerprints``.
+    """
+    
+    def __init__(self, user_model_instance, min_shared: int = DEVICE_SIMILARITY_MIN_SHARED,
+                 candidate_limit: int = 200):
+        self.user_model = user_model_instance
+        component_count = len(DEVICE_FINGERPRINT_COMPONENTS)
+        self.min_shared = max(1, min(min_shared, component_count))
+        self.candidate_limit = candidate_limit
+        
+        # Interleave components so related ones (resolution/orientation,
+        # platform/user agent) fall into different bands
+        band_count = component_count - self.min_shared + 1
+        self.bands = [
+            list(range(band, component_count, band_count))
+            for band in range(band_count)
+        ]
+    
+    @staticmethod
+    def component_hashes(device_data: Dict[str, Any]) -> List[Optional[str]]:
+        """Hash each fingerprint component separately (None for missing values)"""
+        hashes = []
+        for index, name in enumerate(DEVICE_FINGERPRINT_COMPONENTS):
+            value = str(device_data.get(name, ''))
+            if value:
+                hashes.append(hashlib.sha1(f"{index}:{value}".encode('utf-8')).hexdigest()[:16])
+            else:
+                hashes.append(None)
+        return hashes
+    
+    def band_keys(self, component_hashes: List[Optional[str]]) -> List[str]:
+        """Build one LSH key per band; bands with no data are skipped"""
+        keys = []
+        for band_index, members in enumerate(self.bands):
+            if all(component_hashes[i] is None for i in members):
+                continue  # would collide with every sparse device
+            joined = '|'.join(component_hashes[i] or '-' for i in members)
+            keys.append(f"{band_index}:{hashlib.sha1(joined.encode('utf-8')).hexdigest()[:20]}")
+        return keys
+    
+    def shared_components(self, left: List[Optional[str]], right: List[Optional[str]]) -> List[str]:
+        """Names of the components two devices have in common"""
+        return [
+            DEVICE_FINGERPRINT_COMPONENTS[i]
+            for i, (a, b) in enumerate(zip(left, right))
+            if a is not None and a == b
+        ]
+    
+    async def find_similar_devices(self, component_hashes: List[Optional[str]],
+                                   exclude_user_id: int = None, limit: int = 20) -> List[Dict[str, Any]]:
+        """Find registered devices sharing at least ``min_shared`` components"""
+        collection = self.user_model.get_collection('device_similarity_index')
+        if collection is None:
+            return []
+        
+        keys = self.band_keys(component_hashes)
+        if not keys:
+            return []
+        
+        try:
+            # Rarest bands first: a band of common values can hold more devices than
+            # candidate_limit and must not crowd out the specific bands' candidates
+            sizes = await asyncio.gather(*(
+                collection.count_documents({"band_keys": key}, limit=self.candidate_limit + 1)
+                for key in keys
+            ))
+            candidates, seen = [], set()
+            for _, key in sorted(zip(sizes, keys)):
+                remaining = self.candidate_limit - len(candidates)
+                if remaining <= 0:
+                    break
+                for candidate in await collection.find(
+                    {"band_keys": key, "fingerprint": {"$nin": list(seen)}},
+                    {"_id": 0, "user_id": 1, "fingerprint": 1, "component_hashes": 1}
+                ).limit(remaining).to_list(remaining):
+                    seen.add(candidate.get('fingerprint'))
+                    candidates.append(candidate)
+            
+            matches = []
+            for candidate in candidates:
+                if exclude_user_id is not None and candidate.get('user_id') == exclude_user_id:
+                    continue
+                shared = self.shared_components(component_hashes, candidate.get('component_hashes') or [])
+                if len(shared) >= self.min_shared:
+                    matches.append({
+                        "user_id": candidate.get('user_id'),
+                        "fingerprint": candidate.get('fingerprint'),
+                        "shared_count": len(shared),
+                        "shared_components": shared
+                    })
+            
+            matches.sort(key=lambda match: match["shared_count"], reverse=True)
+            return matches[:limit]
+            
+        except Exception as e:
+            logger.error(f"❌ Device similarity lookup error: {e}")
+            return []
+    
+    async def add_device(self, user_id: int, fingerprint: str, component_hashes: List[Optional[str]]):
+        """Register a verified device in the similarity index"""
+        collection = self.user_model.get_collection('device_similarity_index')
+        if collection is None:
+            return
+        
+        try:
+            await collection.update_one(
+                {"fingerprint": fingerprint},
+                {
+                    "$set": {
+                        "user_id": user_id,
+                        "component_hashes": component_hashes,
+                        "band_keys": self.band_keys(component_hashes)
+                    },
+                    "$setOnInsert": {"created_at": datetime.utcnow()}
+                },
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"❌ Error indexing device for user {user_id}: {e}")
+    
+    async def rebuild_from_device_fingerprints(self, batch_size: int = 1000) -> Dict[str, Any]:
+        """Backfill the index from stored device records (one pass, batched writes)"""
+        device_collection = self.user_model.get_collection('device_fingerprints')
+        index_collection = self.user_model.get_collection('device_similarity_index')
+        if device_collection is None or index_collection is None:
+            return {"success": False, "message": "Database error"}
+        
+        indexed = 0
+        try:
+            operations = []
+            cursor = device_collection.find(
+                {}, {"_id": 0, "user_id": 1, "fingerprint": 1, "device_data": 1, "created_at": 1}
+            ).batch_size(batch_size)
+            
+            async for device in cursor:
+                component_hashes = self.component_hashes(device.get('device_data') or {})
+                operations.append(UpdateOne(
+                    {"fingerprint": device['fingerprint']},
+                    {
+                        "$set": {
+                            "user_id": device.get('user_id'),
+                            "component_hashes": component_hashes,
+                            "band_keys": self.band_keys(component_hashes)
+                        },
+                        "$setOnInsert": {"created_at": device.get('created_at', datetime.utcnow())}
+                    },
+                    upsert=True
+                ))
+                if len(operations) >= batch_size:
+                    await index_collection.bulk_write(operations, ordered=False)
+                    indexed += len(operations)
+                    operations = []
+            
+            if operations:
+                await index_collection.bulk_write(operations, ordered=False)
+                indexed += len(operations)
+            
+            logger.info(f"🔎 Device similarity index rebuilt: {indexed} devices")
+            return {"success": True, "indexed": indexed}
+            
+        except Exception as e:
+            logger.error(f"❌ Device similarity index rebuild error: {e}")
+            return {"success": False, "message": "Technical error occurred", "indexed": indexed}
+
 # -------------------- Enhanced User Model -------------------
+@profiled_queries
 class EnhancedUserModel:
     """Complete user management with device security & wallet operations"""
     
     def __init__(self):
         self.collection_cache = {}
     
-    def get_collection(self, name: str):
-        """Get MongoDB collection with caching"""
+    def get_collection(self, name: str, profile: str = "default"):
+        """Get MongoDB collection with caching
+        
+        ``profile`` selects read preference / write concern overrides from
+        COLLECTION_PROFILES.
+        """
         if not db_client or not db_connected:
             logger.warning(f"Database not connected - collection '{name}' unavailable")
             return None
         
-        if name not in self.collection_cache:
-            self.collection_cache[name] = getattr(db_client.walletbot, name)
+        key = name if profile == "default" else (name, profile)
+        if key not in self.collection_cache:
+            self.collection_cache[key] = db_client.walletbot.get_collection(name, **COLLECTION_PROFILES[profile])
         
-        return self.collection_cache[name]
+        return self.collection_cache[key]
     
     # ==================== USER CREATION & MANAGEMENT ====================
     
@@ -392,6 +2274,7 @@ class EnhancedUserModel:
             }
             
             result = await collection.insert_one(new_user)
+            await dashboard_stats.record_user_created(new_user["created_at"])
             logger.info(f"✅ New user created (UNVERIFIED): {user_id}")
             return True
             
@@ -401,15 +2284,15 @@ class EnhancedUserModel:
     
     async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Get user data with activity update"""
-        collection = self.get_collection('users')
+        collection = self.get_collection('users', 'primary')
         if collection is None:
             return None
         
         try:
             user = await collection.find_one({"user_id": user_id})
             if user:
-                # Update last activity
-                await collection.update_one(
+                # Update last activity (bookkeeping write, relaxed durability)
+                await self.get_collection('users', 'relaxed').update_one(
                     {"user_id": user_id},
                     {"$set": {"last_activity": datetime.utcnow()}}
                 )
@@ -441,7 +2324,17 @@ class EnhancedUserModel:
     
     async def is_user_verified(self, user_id: int) -> bool:
         """STRICT device verification check (PRESERVED SECURITY)"""
-        user = await self.get_user(user_id)
+        return self.user_is_verified(await self.get_user(user_id))
+    
+    # Fields read by user_is_verified
+    VERIFICATION_PROJECTION = {
+        "_id": 0, "user_id": 1, "device_verified": 1, "device_fingerprint": 1,
+        "verification_status": 1, "is_banned": 1, "is_active": 1
+    }
+    
+    @staticmethod
+    def user_is_verified(user: Optional[Dict[str, Any]]) -> bool:
+        """Verification rules applied to an already loaded user document"""
         if not user:
             return False
         
@@ -459,18 +2352,8 @@ class EnhancedUserModel:
         try:
             # Collect all available device characteristics
             components = [
-                str(device_data.get('screen_resolution', '')),
-                str(device_data.get('user_agent_hash', '')),
-                str(device_data.get('timezone_offset', '')),
-                str(device_data.get('platform', '')),
-                str(device_data.get('language', '')),
-                str(device_data.get('canvas_hash', '')),
-                str(device_data.get('webgl_hash', '')),
-                str(device_data.get('hardware_concurrency', '')),
-                str(device_data.get('memory', '')),
-                str(device_data.get('touch_support', '')),
-                str(device_data.get('color_depth', '')),
-                str(device_data.get('screen_orientation', ''))
+                str(device_data.get(name, ''))
+                for name in DEVICE_FINGERPRINT_COMPONENTS
             ]
             
             # Create composite fingerprint
@@ -535,8 +2418,20 @@ class EnhancedUserModel:
                     "message": device_check["message"]
                 }
             
+            # Flag near-duplicates (same device with a few components tweaked)
+            component_hashes = device_similarity_index.component_hashes(device_data)
+            similar_devices = await device_similarity_index.find_similar_devices(
+                component_hashes, exclude_user_id=user_id
+            )
+            if similar_devices:
+                logger.warning(
+                    f"🔎 Device for user {user_id} resembles {len(similar_devices)} registered device(s): "
+                    f"{[device['user_id'] for device in similar_devices]}"
+                )
+            
             # Store device fingerprint
-            await self.store_device_fingerprint(user_id, fingerprint, device_data)
+            await self.store_device_fingerprint(user_id, fingerprint, device_data, similar_devices)
+            await device_similarity_index.add_device(user_id, fingerprint, component_hashes)
             
             # Mark user as verified
             await self.mark_user_verified(user_id, fingerprint)
@@ -554,7 +2449,8 @@ class EnhancedUserModel:
                 "message": "Technical error occurred during device verification"
             }
     
-    async def store_device_fingerprint(self, user_id: int, fingerprint: str, device_data: Dict[str, Any]):
+    async def store_device_fingerprint(self, user_id: int, fingerprint: str, device_data: Dict[str, Any],
+                                       similar_devices: List[Dict[str, Any]] = None):
         """Store device fingerprint in database (PRESERVED)"""
         device_collection = self.get_collection('device_fingerprints')
         if device_collection is None:
@@ -569,7 +2465,9 @@ class EnhancedUserModel:
                 "last_used": datetime.utcnow(),
                 "is_active": True,
                 "verification_ip": device_data.get('ip_address', 'unknown'),
-                "user_agent": device_data.get('user_agent', 'unknown')
+                "user_agent": device_data.get('user_agent', 'unknown'),
+                "similarity_flagged": bool(similar_devices),
+                "similar_devices": similar_devices or []
             }
             
             await device_collection.insert_one(device_record)
@@ -592,12 +2490,15 @@ class EnhancedUserModel:
                 "device_verified_at": datetime.utcnow()
             }
             
-            result = await collection.update_one(
+            previous = await collection.find_one_and_update(
                 {"user_id": user_id},
-                {"$set": verification_update}
+                {"$set": verification_update},
+                projection={"_id": 0, "device_verified": 1}
             )
             
-            if result.modified_count > 0:
+            if previous is not None:
+                if not previous.get("device_verified"):
+                    await dashboard_stats.increment({"users.verified": 1})
                 logger.info(f"✅ User {user_id} marked as VERIFIED")
             else:
                 logger.warning(f"⚠️ Failed to mark user {user_id} as verified")
@@ -621,57 +2522,134 @@ class EnhancedUserModel:
 
     # ==================== WALLET OPERATIONS ====================
     
-    async def add_to_wallet(self, user_id: int, amount: float, transaction_type: str, description: str) -> bool:
-        """Add amount to user wallet with transaction metadata"""
-        if not await self.is_user_verified(user_id):
+    async def add_to_wallet(self, user_id: int, amount: float, transaction_type: str, description: str,
+                            require_balance: Optional[float] = None, idempotency_key: Optional[str] = None,
+                            check_eligibility: bool = True) -> bool:
+        """Add amount to user wallet with transaction metadata
+        
+        Balances move with $inc so concurrent writers (bulk credits, other
+        workers) never overwrite each other. With require_balance the update
+        only applies while the wallet holds at least that much. With an
+        idempotency_key the balance change and its transaction row commit
+        together (on a standalone server the row is written first), and the
+        unique ledger key refuses a second application.
+        check_eligibility=False skips the verified/banned gate (refunds must
+        reach every account that was debited).
+        """
+        if check_eligibility and not await self.is_user_verified(user_id):
             logger.warning(f"Wallet operation denied for unverified user {user_id}")
             return False
         
-        collection = self.get_collection('users')
+        collection = self.get_collection('users', 'primary')
         if collection is None:
             return False
         
         try:
-            user = await self.get_user(user_id)
-            if not user or user.get('is_banned', False):
-                logger.warning(f"Wallet operation denied for banned or missing user {user_id}")
-                return False
-            
-            new_balance = user.get('wallet_balance', 0) + amount
-            total_earned = user.get('total_earned', 0)
-            referral_earnings = user.get('referral_earnings', 0)
-            total_referrals = user.get('total_referrals', 0)
-            
-            if amount > 0:
-                total_earned += amount
-            
-            update_fields = {
-                'wallet_balance': new_balance,
-                'total_earned': total_earned,
-                'updated_at': datetime.utcnow()
-            }
+            # Refunds of a failed payout give back a debit; they are not earnings
+            earned = amount > 0 and transaction_type != 'withdrawal_refund'
+            increments = {'wallet_balance': amount}
+            if earned:
+                increments['total_earned'] = amount
             
             # Handle referral bonus logic
             if transaction_type == 'referral':
-                referral_earnings += amount
-                total_referrals += 1
-                update_fields['referral_earnings'] = referral_earnings
-                update_fields['total_referrals'] = total_referrals
+                increments['referral_earnings'] = amount
+                increments['total_referrals'] = 1
             elif transaction_type == 'campaign':
-                update_fields['campaigns_completed'] = user.get('campaigns_completed', 0) + 1
+                increments['campaigns_completed'] = 1
             elif transaction_type == 'gift_code':
-                update_fields['gift_codes_redeemed'] = user.get('gift_codes_redeemed', 0) + 1
-                update_fields['gift_code_earnings'] = user.get('gift_code_earnings', 0) + amount
+                increments['gift_codes_redeemed'] = 1
+                increments['gift_code_earnings'] = amount
+            
+            query = {'user_id': user_id}
+            if check_eligibility:
+                query['is_banned'] = {'$ne': True}
+            if require_balance is not None:
+                query['wallet_balance'] = {'$gte': require_balance}
+            
+            async def apply_change(session=None):
+                now = datetime.utcnow()
+                user = await collection.find_one_and_update(
+                    query,
+                    {'$inc': increments, '$set': {'updated_at': now}},
+                    projection={'_id': 0, 'wallet_balance': 1, 'total_earned': 1},
+                    return_document=True,
+                    session=session
+                )
+                if user is not None and idempotency_key:
+                    await self.get_collection('transactions', 'primary').insert_one({
+                        'transaction_id': str(uuid.uuid4()),
+                        'user_id': user_id,
+                        'amount': amount,
+                        'type': transaction_type,
+                        'description': description,
+                        'timestamp': now,
+                        'status': 'completed',
+                        'idempotency_key': idempotency_key
+                    }, session=session)
+                return user
+            
+            async def apply_change_standalone():
+                # No transactions: claim the ledger key first, release it if the balance update is refused
+                now = datetime.utcnow()
+                transactions = self.get_collection('transactions', 'primary')
+                transaction_id = str(uuid.uuid4())
+                await transactions.insert_one({
+                    'transaction_id': transaction_id,
+                    'user_id': user_id,
+                    'amount': amount,
+                    'type': transaction_type,
+                    'description': description,
+                    'timestamp': now,
+                    'status': 'completed',
+                    'idempotency_key': idempotency_key
+                })
+                user = await collection.find_one_and_update(
+                    query,
+                    {'$inc': increments, '$set': {'updated_at': now}},
+                    projection={'_id': 0, 'wallet_balance': 1, 'total_earned': 1},
+                    return_document=True
+                )
+                if user is None:
+                    await transactions.delete_one({'transaction_id': transaction_id})
+                return user
             
-            await collection.update_one(
-                {'user_id': user_id},
-                {'$set': update_fields}
-            )
+            if idempotency_key:
+                try:
+                    if db_supports_transactions:
+                        async with await db_client.start_session() as session:
+                            user = await session.with_transaction(apply_change)
+                    else:
+                        user = await apply_change_standalone()
+                except DuplicateKeyError:
+                    logger.warning(f"Wallet operation {idempotency_key} for user {user_id} was already applied")
+                    return False
+            else:
+                user = await apply_change()
+            if user is None:
+                logger.warning(f"Wallet operation denied for banned, missing or underfunded user {user_id}")
+                return False
+            
+            new_balance = user.get('wallet_balance', 0)
+            total_earned = user.get('total_earned', 0)
+            
+            await dashboard_stats.record_wallet_change(amount, earned=earned)
+            mutations, moved = WALLET_MUTATIONS_BY_DIRECTION["credit" if amount >= 0 else "debit"]
+            mutations.inc()
+            moved.inc(abs(amount))
             
-            # Record transaction history
-            await self.record_transaction(user_id, amount, transaction_type, description)
+            # Record transaction history (keyed changes wrote theirs in the transaction)
+            if not idempotency_key:
+                await self.record_transaction(user_id, amount, transaction_type, description)
             
-            logger.info(f"💰 Wallet updated: User {user_id}, Amount {amount:+.2f}, Type {transaction_type}")
+            partner_webhooks.emit("wallet.updated", {
+                "user_id": user_id,
+                "amount": amount,
+                "transaction_type": transaction_type,
+                "wallet_balance": new_balance,
+                "total_earned": total_earned
+            })
+            wallet_logger.info("💰 Wallet updated: User %s, Amount %+.2f, Type %s", user_id, amount, transaction_type)
             return True
             
         except Exception as e:
@@ -699,6 +2677,135 @@ class EnhancedUserModel:
         except Exception as e:
             logger.error(f"❌ Transaction recording error: {e}")
     
+    async def find_ledger_entry(self, idempotency_key: str) -> Optional[Dict[str, Any]]:
+        """Transaction committed under an idempotency key, read from the primary"""
+        collection = self.get_collection('transactions', 'primary')
+        if collection is None:
+            raise RuntimeError("Database not available")
+        return await collection.find_one(
+            {"idempotency_key": idempotency_key}, {"_id": 0, "transaction_id": 1, "user_id": 1, "amount": 1}
+        )
+    
+    async def verified_user_ids(self, user_ids: List[int]) -> set:
+        """Which of user_ids are verified, in one $in lookup (no last_activity writes)"""
+        collection = self.get_collection('users', 'primary')
+        if collection is None or not user_ids:
+            return set()
+        
+        cursor = collection.find({"user_id": {"$in": list(set(user_ids))}}, self.VERIFICATION_PROJECTION)
+        return {user["user_id"] async for user in cursor if self.user_is_verified(user)}
+    
+    async def add_to_wallets_bulk(self, credits: List[Dict[str, Any]], transaction_type: str) -> List[Dict[str, Any]]:
+        """Credit many (already verified) users with one insert_many and one bulk_write
+        
+        Each credit has user_id, amount, description and an optional
+        idempotency_key. On a replica set both writes run in one
+        multi-document transaction, so either every new transaction and its
+        balance change is committed or nothing is. A standalone server writes
+        the ledger rows first and then the balances. Keys already in the ledger
+        are skipped. Returns {"status": "credited" | "duplicate",
+        "transaction_id"} per credit, in order; a duplicate carries the
+        original ledger row's transaction_id. Raises when the writes cannot
+        commit (safe to retry).
+        """
+        transactions = self.get_collection('transactions', 'primary')
+        users = self.get_collection('users', 'primary')
+        if transactions is None or users is None:
+            raise RuntimeError("Database not available")
+        
+        async def ledger_ids(keys: List[str], session=None) -> Dict[str, str]:
+            if not keys:
+                return {}
+            return {
+                doc['idempotency_key']: doc['transaction_id'] async for doc in transactions.find(
+                    {"idempotency_key": {"$in": keys}}, {"_id": 0, "idempotency_key": 1, "transaction_id": 1},
+                    session=session
+                )
+            }
+        
+        async def write_credits(session=None):
+            # May run more than once (transient transaction errors are retried)
+            now = datetime.utcnow()
+            existing = await ledger_ids(
+                [credit['idempotency_key'] for credit in credits if credit.get('idempotency_key')], session
+            )
+            
+            documents, statuses = [], []
+            for credit in credits:
+                if credit.get('idempotency_key') in existing:
+                    documents.append({'transaction_id': existing[credit['idempotency_key']]})
+                    statuses.append("duplicate")
+                    continue
+                document = {
+                    'transaction_id': str(uuid.uuid4()),
+                    'user_id': credit['user_id'],
+                    'amount': credit['amount'],
+                    'type': transaction_type,
+                    'description': credit['description'],
+                    'timestamp': now,
+                    'status': 'completed'
+                }
+                if credit.get('idempotency_key'):
+                    document['idempotency_key'] = credit['idempotency_key']
+                documents.append(document)
+                statuses.append("credited")
+            
+            positions = [index for index, status in enumerate(statuses) if status == "credited"]
+            if positions:
+                try:
+                    await transactions.insert_many(
+                        [documents[index] for index in positions], ordered=False, session=session
+                    )
+                except BulkWriteError as e:
+                    # Without a transaction a concurrent request can commit the same key first
+                    errors = e.details.get('writeErrors', [])
+                    if session is not None or any(error.get('code') != 11000 for error in errors):
+                        raise
+                    raced = [positions[error['index']] for error in errors]
+                    original = await ledger_ids([documents[index]['idempotency_key'] for index in raced])
+                    for index in raced:
+                        documents[index] = {'transaction_id': original.get(documents[index]['idempotency_key'])}
+                        statuses[index] = "duplicate"
+            
+            totals = {}
+            for document, status in zip(documents, statuses):
+                if status == "credited":
+                    totals[document['user_id']] = totals.get(document['user_id'], 0) + document['amount']
+            if totals:
+                await users.bulk_write([
+                    UpdateOne(
+                        {'user_id': user_id},
+                        {'$inc': {'wallet_balance': amount, 'total_earned': amount}, '$set': {'updated_at': now}}
+                    )
+                    for user_id, amount in totals.items()
+                ], session=session)
+            return documents, statuses, totals
+        
+        if db_supports_transactions:
+            async with await db_client.start_session() as session:
+                documents, statuses, totals = await session.with_transaction(write_credits)
+        else:
+            documents, statuses, totals = await write_credits()
+        
+        if totals:
+            credited_amount = sum(totals.values())
+            for user_id, amount in totals.items():
+                partner_webhooks.emit("wallet.updated", {
+                    "user_id": user_id, "amount": amount, "transaction_type": transaction_type
+                })
+            await dashboard_stats.record_wallet_change(credited_amount)
+            mutations, moved = WALLET_MUTATIONS_BY_DIRECTION["credit"]
+            mutations.inc(statuses.count("credited"))
+            moved.inc(credited_amount)
+            wallet_logger.info(
+                "💰 Bulk wallet credit: %d users, Amount %.2f, Type %s", len(totals), credited_amount, transaction_type
+            )
+        
+        return [
+            {"status": status, "transaction_id": document['transaction_id']}
+            for status, document in zip(statuses, documents)
+        ]
+    
     async def get_wallet_balance(self, user_id: int) -> float:
         """Get user's current wallet balance"""
         user = await self.get_user(user_id)
@@ -706,21 +2813,16 @@ class EnhancedUserModel:
             return 0.0
         return user.get('wallet_balance', 0.0)
     
-    async def subtract_from_wallet(self, user_id: int, amount: float, transaction_type: str, description: str) -> bool:
+    async def subtract_from_wallet(self, user_id: int, amount: float, transaction_type: str, description: str,
+                                   idempotency_key: Optional[str] = None) -> bool:
         """Subtract amount from wallet (for withdrawals)"""
         if amount <= 0:
             return False
             
-        user = await self.get_user(user_id)
-        if not user:
-            return False
-        
-        current_balance = user.get('wallet_balance', 0)
-        if current_balance < amount:
-            logger.warning(f"Insufficient balance for user {user_id}: {current_balance} < {amount}")
-            return False
-        
-        return await self.add_to_wallet(user_id, -amount, transaction_type, description)
+        # The balance check and the debit are one conditional update
+        return await self.add_to_wallet(
+            user_id, -amount, transaction_type, description, require_balance=amount, idempotency_key=idempotency_key
+        )
     
     # ==================== WITHDRAWAL OPERATIONS ====================
     
@@ -752,10 +2854,11 @@ class EnhancedUserModel:
         withdrawal_collection = self.get_collection('withdrawal_requests')
         if withdrawal_collection:
             since_midnight = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+            # A request being paid out automatically is still open
             pending_today = await withdrawal_collection.count_documents({
                 'user_id': user_id,
                 'request_time': {'$gte': since_midnight},
-                'status': 'pending'
+                'status': {'$in': ['pending', 'processing']}
             })
             
             if pending_today > 0:
@@ -789,6 +2892,7 @@ class EnhancedUserModel:
             }
             
             await collection.insert_one(withdrawal_doc)
+            await dashboard_stats.record_withdrawal_status(amount, None, 'pending')
             
             # Update user's pending withdrawal amount
             await self.update_user(user_id, {
@@ -859,6 +2963,7 @@ class EnhancedUserModel:
             }
             
             await collection.insert_one(screenshot_doc)
+            await dashboard_stats.increment({"screenshots.pending": 1})
             
             # Update user stats
             await self.update_user(user_id, {
@@ -911,6 +3016,7 @@ class EnhancedUserModel:
 
 # ==================== GIFT CODE SYSTEM ====================
 
+@profiled_queries
 class GiftCodeManager:
     """Manage gift codes creation, validation and redemption"""
     
@@ -1009,9 +3115,920 @@ class GiftCodeManager:
             logger.error(f"❌ Gift code redemption error: {e}")
             return {"success": False, "message": "Technical error occurred"}
 
+# ==================== DASHBOARD STATISTICS ====================
+
+@profiled_queries
+class DashboardStatsManager:
+    """Materialized admin dashboard counters kept in a single document
+    
+    Mutations apply small $inc deltas; a periodic full recount corrects any
+    drift (failed hooks, writes made outside the model methods).
+    """
+    
+    STATS_ID = "dashboard"
+    WITHDRAWAL_STATUSES = ("pending", "processing", "approved", "rejected", "completed")
+    SIGNUP_HISTORY_DAYS = 30
+    
+    def __init__(self, user_model_instance):
+        self.user_model = user_model_instance
+    
+    async def increment(self, counters: Dict[str, float]):
+        """Apply counter deltas (dotted field paths) to the stats document"""
+        collection = self.user_model.get_collection('admin_stats')
+        if collection is None:
+            return
+        
+        try:
+            await collection.update_one(
+                {"_id": self.STATS_ID},
+                {"$inc": counters, "$set": {"updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"❌ Dashboard stats update error: {e}")
+    
+    async def record_user_created(self, created_at: datetime):
+        """Count a signup in the totals and its day bucket"""
+        await self.increment({
+            "users.total": 1,
+            f"signups_by_day.{created_at.strftime('%Y-%m-%d')}": 1
+        })
+    
+    async def record_user_banned(self, banned: bool):
+        """Count a ban (or unban)"""
+        await self.increment({"users.banned": 1 if banned else -1})
+    
+    async def record_wallet_change(self, amount: float, earned: bool = True):
+        """Track the platform-wide balance and lifetime earnings"""
+        counters = {"wallet.total_balance": amount}
+        if amount > 0 and earned:
+            counters["wallet.total_earned"] = amount
+        await self.increment(counters)
+    
+    async def record_withdrawal_status(self, amount: float, old_status: Optional[str], new_status: str):
+        """Move a withdrawal between status buckets"""
+        counters = {}
+        if old_status in self.WITHDRAWAL_STATUSES:
+            counters[f"withdrawals.{old_status}.count"] = -1
+            counters[f"withdrawals.{old_status}.amount"] = -amount
+        if new_status in self.WITHDRAWAL_STATUSES:
+            counters[f"withdrawals.{new_status}.count"] = 1
+            counters[f"withdrawals.{new_status}.amount"] = amount
+        if counters:
+            await self.increment(counters)
+    
+    async def record_campaign_status(self, old_status: Optional[str], new_status: str):
+        """Track the active campaign count across status changes"""
+        delta = (1 if new_status == 'active' else 0) - (1 if old_status == 'active' else 0)
+        if delta:
+            await self.increment({"campaigns.active": delta})
+    
+    @classmethod
+    def _flatten(cls, document: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
+        """Nested counters as dotted paths ({"users": {"total": 3}} -> {"users.total": 3})"""
+        flat = {}
+        for key, value in document.items():
+            if isinstance(value, dict):
+                flat.update(cls._flatten(value, f"{prefix}{key}."))
+            else:
+                flat[f"{prefix}{key}"] = value
+        return flat
+    
+    async def reconcile(self) -> Dict[str, Any]:
+        """Recount everything from the source collections and correct the document
+        
+        The document is read in the same gather as the recounts and each
+        counter gets $inc (recount - snapshot), so deltas applied while the
+        correction is in flight are kept. Events landing between the
+        individual reads can still skew one run; the next run picks them up.
+        """
+        stats_collection = self.user_model.get_collection('admin_stats')
+        users_collection = self.user_model.get_collection('users')
+        campaigns_collection = self.user_model.get_collection('campaigns')
+        screenshots_collection = self.user_model.get_collection('screenshots')
+        if stats_collection is None or users_collection is None:
+            return {}
+        
+        async def count(collection, query):
+            return await collection.count_documents(query) if collection is not None else 0
+        
+        started = datetime.utcnow()
+        history_start = (started - timedelta(days=self.SIGNUP_HISTORY_DAYS)).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        
+        (snapshot, total_users, verified_users, banned_users, wallet_stats, signups,
+         total_campaigns, active_campaigns, pending_screenshots, withdrawal_stats) = await asyncio.gather(
+            stats_collection.find_one({"_id": self.STATS_ID}, {"_id": 0}),
+            count(users_collection, {}),
+            count(users_collection, {"device_verified": True}),
+            count(users_collection, {"is_banned": True}),
+            users_collection.aggregate([
+                {"$group": {
+                    "_id": None,
+                    "total_balance": {"$sum": "$wallet_balance"},
+                    "total_earned": {"$sum": "$total_earned"},
+                    "total_withdrawals": {"$sum": "$withdrawal_total"}
+                }}
+            ]).to_list(1),
+            users_collection.aggregate([
+                {"$match": {"created_at": {"$gte": history_start}}},
+                {"$group": {
+                    "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                    "count": {"$sum": 1}
+                }}
+            ]).to_list(self.SIGNUP_HISTORY_DAYS + 1),
+            count(campaigns_collection, {}),
+            count(campaigns_collection, {"status": "active"}),
+            count(screenshots_collection, {"status": "pending"}),
+            payment_manager.get_withdrawal_statistics()
+        )
+        
+        before = self._flatten(snapshot or {})
+        wallet_data = wallet_stats[0] if wallet_stats else {}
+        stats_doc = {
+            "users": {"total": total_users, "verified": verified_users, "banned": banned_users},
+            "wallet": {
+                "total_balance": wallet_data.get("total_balance", 0),
+                "total_earned": wallet_data.get("total_earned", 0),
+                "total_withdrawals": wallet_data.get("total_withdrawals", 0)
+            },
+            "campaigns": {"total": total_campaigns, "active": active_campaigns},
+            "screenshots": {"pending": pending_screenshots},
+            "withdrawals": {
+                status: withdrawal_stats.get(status, {"count": 0, "amount": 0.0})
+                for status in self.WITHDRAWAL_STATUSES
+            },
+            "signups_by_day": {bucket["_id"]: bucket["count"] for bucket in signups},
+            "reconciled_at": started,
+            "updated_at": datetime.utcnow()
+        }
+        
+        counters = self._flatten(stats_doc)
+        for path in ("reconciled_at", "updated_at"):
+            counters.pop(path)
+        # Days that fell out of the history window (or have no signups any more)
+        expired_days = [path for path in before if path.startswith("signups_by_day.") and path not in counters]
+        counters.update({path: 0 for path in expired_days})
+        
+        deltas = {}
+        for path, value in counters.items():
+            delta = value - (before.get(path) or 0)
+            if delta:
+                deltas[path] = delta
+        
+        update = {"$set": {"reconciled_at": started, "updated_at": datetime.utcnow()}}
+        if deltas:
+            update["$inc"] = deltas
+        await stats_collection.update_one({"_id": self.STATS_ID}, update, upsert=True)
+        if expired_days:
+            # Drop the expired days once their $inc has brought them to zero
+            await stats_collection.update_one({"_id": self.STATS_ID}, [
+                {"$set": {"signups_by_day": {"$arrayToObject": {"$filter": {
+                    "input": {"$objectToArray": "$signups_by_day"},
+                    "cond": {"$or": [
+                        {"$gte": ["$$this.k", history_start.strftime('%Y-%m-%d')]},
+                        {"$ne": ["$$this.v", 0]}
+                    ]}
+                }}}}}
+            ])
+        logger.info(f"📊 Dashboard stats reconciled in {(datetime.utcnow() - started).total_seconds():.2f}s")
+        return stats_doc
+    
+    async def get_stats(self) -> Dict[str, Any]:
+        """Read the materialized document (recounting once if it doesn't exist yet)"""
+        collection = query_router.collection('admin_stats', 'analytics')
+        if collection is None:
+            return {}
+        
+        stats = await collection.find_one({"_id": self.STATS_ID})
+        if not stats or "reconciled_at" not in stats:
+            stats = await self.reconcile()
+        return stats or {}
+    
+    def recent_signups(self, stats: Dict[str, Any], days: int = 7) -> int:
+        """Signups over the last ``days`` calendar days (today included)"""
+        by_day = stats.get("signups_by_day", {})
+        today = datetime.utcnow().date()
+        return sum(
+            by_day.get((today - timedelta(days=offset)).strftime('%Y-%m-%d'), 0)
+            for offset in range(days)
+        )
+
+# ==================== ANALYTICS ROLLUPS ====================
+
+@profiled_queries
+class AnalyticsRollupManager:
+    """Incremental minute/hour/day rollups of signups, credits and withdrawals
+    
+    Each source keeps a high-watermark in ``analytics_state``. A run only
+    reads events in complete minutes after the watermark, writes the minute
+    buckets with $set and then re-derives the touched hour and day buckets
+    from the finer level, so re-running a window is harmless.
+    """
+    
+    SOURCES = {
+        "signups": {
+            "collection": "users", "time_field": "created_at",
+            "match": {}, "dimensions": {}, "amount": None
+        },
+        "verifications": {
+            "collection": "users", "time_field": "device_verified_at",
+            "match": {"device_verified": True}, "dimensions": {}, "amount": None
+        },
+        "credits": {
+            "collection": "transactions", "time_field": "timestamp",
+            "match": {"amount": {"$gt": 0}}, "dimensions": {"type": "$type"}, "amount": "$amount"
+        },
+        "withdrawal_requests": {
+            "collection": "withdrawal_requests", "time_field": "request_time",
+            "match": {}, "dimensions": {"method": "$payment_method"}, "amount": "$amount"
+        },
+        "withdrawals_processed": {
+            "collection": "withdrawal_requests", "time_field": "processed_time",
+            "match": {}, "dimensions": {"status": "$status", "method": "$payment_method"}, "amount": "$amount"
+        }
+    }
+    GRANULARITIES = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}
+    PAGE_SIZE = 500  # cursor batch size and upserts per bulk_write
+    
+    def __init__(self, user_model_instance, lag_seconds: int = 30, max_window: timedelta = timedelta(hours=6),
+                 max_query_buckets: int = ANALYTICS_MAX_QUERY_BUCKETS):
+        self.user_model = user_model_instance
+        self.max_query_buckets = max_query_buckets
+        self.lag = timedelta(seconds=lag_seconds)  # allow for slightly late inserts
+        self.max_window = max_window
+        self._lock = asyncio.Lock()
+    
+    @staticmethod
+    def truncate(moment: datetime, granularity: str) -> datetime:
+        """Floor a timestamp to the start of its bucket"""
+        if granularity == "day":
+            return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        if granularity == "hour":
+            return moment.replace(minute=0, second=0, microsecond=0)
+        return moment.replace(second=0, microsecond=0)
+    
+    @staticmethod
+    def minute_bucket(field: str) -> Dict[str, Any]:
+        """Aggregation expression flooring a date field to its minute
+        
+        Built from date parts rather than $dateTrunc, which needs MongoDB 5.0.
+        """
+        return {"$dateFromParts": {
+            "year": {"$year": field}, "month": {"$month": field}, "day": {"$dayOfMonth": field},
+            "hour": {"$hour": field}, "minute": {"$minute": field}
+        }}
+    
+    @staticmethod
+    def bucket_id(granularity: str, metric: str, bucket: datetime, dimensions: Dict[str, Any]) -> str:
+        """Deterministic rollup document id"""
+        dimension_key = ",".join(f"{key}={dimensions[key]}" for key in sorted(dimensions))
+        return f"{granularity}|{metric}|{bucket.strftime('%Y%m%d%H%M')}|{dimension_key}"
+    
+    async def run(self, max_windows: int = 20) -> Dict[str, int]:
+        """Fold new events from every source into the rollups"""
+        async with self._lock:
+            processed = {}
+            for metric in self.SOURCES:
+                try:
+                    processed[metric] = await self._process_source(metric, max_windows)
+                except Exception as e:
+                    logger.error(f"❌ Analytics rollup error for {metric}: {e}")
+                    processed[metric] = 0
+            return processed
+    
+    async def _process_source(self, metric: str, max_windows: int) -> int:
+        source = self.SOURCES[metric]
+        state_collection = self.user_model.get_collection('analytics_state')
+        source_collection = self.user_model.get_collection(source["collection"])
+        if state_collection is None or source_collection is None:
+            return 0
+        
+        time_field = source["time_field"]
+        horizon = self.truncate(datetime.utcnow() - self.lag, "minute")
+        
+        state = await state_collection.find_one({"_id": metric})
+        watermark = state.get("watermark") if state else None
+        if watermark is None:
+            # First run: start from the oldest event
+            first = await source_collection.find(
+                {**source["match"], time_field: {"$type": "date"}}, {"_id": 0, time_field: 1}
+            ).sort(time_field, 1).limit(1).to_list(1)
+            if not first:
+                return 0
+            watermark = self.truncate(first[0][time_field], "minute")
+        
+        events = 0
+        for _ in range(max_windows):
+            if watermark >= horizon:
+                break
+            window_end = min(watermark + self.max_window, horizon)
+            events += await self._rollup_window(metric, source, source_collection, watermark, window_end)
+            
+            await state_collection.update_one(
+                {"_id": metric},
+                {"$set": {"watermark": window_end, "updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+            watermark = window_end
+        
+        return events
+    
+    async def _rollup_window(self, metric: str, source: Dict[str, Any], source_collection,
+                             window_start: datetime, window_end: datetime) -> int:
+        rollups = self.user_model.get_collection('analytics_rollups')
+        time_field = source["time_field"]
+        
+        cursor = source_collection.aggregate([
+            {"$match": {**source["match"], time_field: {"$gte": window_start, "$lt": window_end}}},
+            {"$group": {
+                "_id": {
+                    "bucket": self.minute_bucket(f"${time_field}"),
+                    **{key: {"$ifNull": [expression, "unknown"]} for key, expression in source["dimensions"].items()}
+                },
+                "count": {"$sum": 1},
+                "amount": {"$sum": source["amount"] or 0}
+            }}
+        ], batchSize=self.PAGE_SIZE)
+        
+        now = datetime.utcnow()
+        minute_expiry = timedelta(days=ANALYTICS_MINUTE_RETENTION_DAYS)
+        operations = []
+        touched_hours = set()
+        events = 0
+        async for group in cursor:
+            bucket = group["_id"].pop("bucket")
+            dimensions = group["_id"]
+            touched_hours.add(self.truncate(bucket, "hour"))
+            events += group["count"]
+            operations.append(UpdateOne(
+                {"_id": self.bucket_id("minute", metric, bucket, dimensions)},
+                {"$set": {
+                    "granularity": "minute", "metric": metric, "bucket": bucket,
+                    "dimensions": dimensions, "count": group["count"], "amount": group["amount"],
+                    "expires_at": max(bucket, now) + minute_expiry, "updated_at": now
+                }},
+                upsert=True
+            ))
+            if len(operations) >= self.PAGE_SIZE:
+                await rollups.bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            await rollups.bulk_write(operations, ordered=False)
+        
+        if not touched_hours:
+            return 0
+        
+        touched_days = {self.truncate(hour, "day") for hour in touched_hours}
+        await self._derive(metric, "minute", "hour", touched_hours)
+        await self._derive(metric, "hour", "day", touched_days)
+        
+        return events
+    
+    async def _derive(self, metric: str, source_granularity: str, target_granularity: str, buckets):
+        """Recompute coarse buckets from the finer level ($set, so idempotent)"""
+        rollups = self.user_model.get_collection('analytics_rollups')
+        span = self.GRANULARITIES[target_granularity]
+        now = datetime.utcnow()
+        operations = []
+        
+        for bucket in buckets:
+            totals = rollups.aggregate([
+                {"$match": {
+                    "metric": metric, "granularity": source_granularity,
+                    "bucket": {"$gte": bucket, "$lt": bucket + span}
+                }},
+                {"$group": {"_id": "$dimensions", "count": {"$sum": "$count"}, "amount": {"$sum": "$amount"}}}
+            ], batchSize=self.PAGE_SIZE)
+            
+            async for total in totals:
+                dimensions = total["_id"] or {}
+                operations.append(UpdateOne(
+                    {"_id": self.bucket_id(target_granularity, metric, bucket, dimensions)},
+                    {"$set": {
+                        "granularity": target_granularity, "metric": metric, "bucket": bucket,
+                        "dimensions": dimensions, "count": total["count"], "amount": total["amount"],
+                        "updated_at": now
+                    }},
+                    upsert=True
+                ))
+                if len(operations) >= self.PAGE_SIZE:
+                    await rollups.bulk_write(operations, ordered=False)
+                    operations = []
+        
+        if operations:
+            await rollups.bulk_write(operations, ordered=False)
+    
+    async def query(self, metric: str, granularity: str, start: datetime, end: datetime,
+                    group_by: List[str] = None, step: int = 1) -> List[Dict[str, Any]]:
+        """Read a bucket series, optionally merging ``step`` buckets and grouping by dimensions
+        
+        Raises ValueError when the range spans more than ``max_query_buckets``
+        buckets of ``granularity``.
+        """
+        if (end - start) / self.GRANULARITIES[granularity] > self.max_query_buckets:
+            raise ValueError(f"Range covers more than {self.max_query_buckets} {granularity} buckets")
+        
+        rollups = self.user_model.get_collection('analytics_rollups')
+        if rollups is None:
+            return []
+        
+        documents = rollups.find(
+            {"metric": metric, "granularity": granularity, "bucket": {"$gte": start, "$lt": end}},
+            {"_id": 0, "bucket": 1, "dimensions": 1, "count": 1, "amount": 1}
+        ).sort("bucket", 1).batch_size(self.PAGE_SIZE)
+        
+        span = self.GRANULARITIES[granularity] * max(1, step)
+        origin = self.truncate(start, granularity)
+        series: Dict[tuple, Dict[str, Any]] = {}
+        async for document in documents:
+            bucket = origin + span * ((document["bucket"] - origin) // span)
+            dimensions = {key: document["dimensions"].get(key) for key in (group_by or [])}
+            key = (bucket, tuple(sorted(dimensions.items())))
+            point = series.setdefault(key, {"bucket": bucket, "dimensions": dimensions, "count": 0, "amount": 0.0})
+            point["count"] += document["count"]
+            point["amount"] += document["amount"]
+        
+        return sorted(series.values(), key=lambda point: point["bucket"])
+
+# ==================== TRANSACTION ARCHIVE ====================
+
+@profiled_queries
+class TransactionArchiveManager:
+    """Hot/cold partitioning of the transactions history
+    
+    Recent rows stay in ``transactions``; older ones are moved in batches
+    into ``transactions_archive_YYYY_MM``. ``transaction_archive_index``
+    records, per user, which months hold archived rows plus per-month and
+    overall count and sum (each moved month is recounted from its archive),
+    so readers only touch the months they need.
+    """
+    
+    ARCHIVE_PREFIX = "transactions_archive_"
+    # shared_state leases: readers spanning both tiers pause archival on every
+    # replica; the archiver flags each batch it is moving
+    PAUSE_KEY = "transaction_archive:paused"
+    MOVING_KEY = "transaction_archive:moving"
+    PAUSE_SECONDS = 60
+    
+    def __init__(self, user_model_instance, hot_days: int = TRANSACTION_HOT_DAYS, batch_size: int = 1000):
+        self.user_model = user_model_instance
+        self.hot_days = hot_days
+        self.batch_size = batch_size
+        self._indexed_archives = set()
+        self.lock = asyncio.Lock()  # one archival run at a time in this process
+        self._pause_renewed = 0.0
+    
+    def archive_name(self, moment: datetime) -> str:
+        """Archive collection holding a given month"""
+        return f"{self.ARCHIVE_PREFIX}{moment.strftime('%Y_%m')}"
+    
+    async def _archive_collection(self, name: str):
+        collection = self.user_model.get_collection(name)
+        if collection is not None and name not in self._indexed_archives:
+            await collection.create_index([("user_id", 1), ("timestamp", -1)])
+            self._indexed_archives.add(name)
+        return collection
+    
+    async def archive_old_transactions(self, max_batches: int = 50) -> int:
+        """Move transactions older than the hot window into monthly archives"""
+        async with self.lock:
+            hot = self.user_model.get_collection('transactions')
+            archive_index = self.user_model.get_collection('transaction_archive_index')
+            if hot is None or archive_index is None:
+                return 0
+            
+            cutoff = datetime.utcnow() - timedelta(days=self.hot_days)
+            moved = 0
+            
+            try:
+                for _ in range(max_batches):
+                    # Flag first, then check for readers (who pause first, then wait for the flag)
+                    await shared_state.set(self.MOVING_KEY, True, self.PAUSE_SECONDS)
+                    if await shared_state.get(self.PAUSE_KEY) is not None:
+                        logger.info("🗄️ Transaction archival paused by a reader; resuming next run")
+                        break
+                    
+                    batch = await hot.find(
+                        {"timestamp": {"$lt": cutoff}}
+                    ).sort([("timestamp", 1), ("_id", 1)]).limit(self.batch_size).to_list(self.batch_size)
+                    if not batch:
+                        break
+                    
+                    await self._move_batch(hot, archive_index, batch)
+                    moved += len(batch)
+            finally:
+                await shared_state.delete(self.MOVING_KEY)
+            
+            if moved:
+                logger.info(f"🗄️ Archived {moved} transactions older than {cutoff.date()}")
+            return moved
+    
+    async def _move_batch(self, hot, archive_index, batch: List[Dict[str, Any]]):
+        # 1) Copy into the monthly archives (re-inserting the same _id is ignored)
+        by_month: Dict[str, List[Dict[str, Any]]] = {}
+        for transaction in batch:
+            by_month.setdefault(self.archive_name(transaction['timestamp']), []).append(transaction)
+        for name, documents in by_month.items():
+            collection = await self._archive_collection(name)
+            try:
+                await collection.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                    raise
+        
+        # 2) Recount the touched (user, month) pairs from the rows the archives
+        #    actually hold, so a retried or partially applied batch can never be
+        #    counted twice; totals are re-derived from the per-month subtotals
+        user_ids = list({transaction['user_id'] for transaction in batch})
+        months_by_user: Dict[int, set] = {user_id: set() for user_id in user_ids}
+        for transaction in batch:
+            months_by_user[transaction['user_id']].add(self.archive_name(transaction['timestamp'])[len(self.ARCHIVE_PREFIX):])
+        # Entries written before per-month subtotals existed are backfilled once
+        async for entry in archive_index.find(
+            {"user_id": {"$in": user_ids}}, {"_id": 0, "user_id": 1, "months": 1, "monthly": 1}
+        ):
+            months_by_user[entry["user_id"]] |= set(entry.get("months", [])) - set(entry.get("monthly", {}))
+        
+        users_by_month: Dict[str, List[int]] = {}
+        for user_id, months in months_by_user.items():
+            for month in months:
+                users_by_month.setdefault(month, []).append(user_id)
+        
+        subtotals: Dict[int, Dict[str, Any]] = {}
+        for month, month_user_ids in sorted(users_by_month.items()):
+            collection = await self._archive_collection(f"{self.ARCHIVE_PREFIX}{month}")
+            async for row in collection.aggregate([
+                {"$match": {"user_id": {"$in": month_user_ids}}},
+                {"$group": {
+                    "_id": "$user_id",
+                    "count": {"$sum": 1},
+                    "total": {"$sum": "$amount"},
+                    "through": {"$max": "$timestamp"}
+                }}
+            ]):
+                subtotals.setdefault(row["_id"], {})[month] = {
+                    "count": row["count"], "total": row["total"], "through": row["through"]
+                }
+        
+        monthly = {"$objectToArray": "$monthly"}
+        await archive_index.bulk_write([
+            UpdateOne(
+                {"user_id": user_id},
+                [
+                    {"$set": {f"monthly.{month}": {"$literal": subtotal} for month, subtotal in months.items()}},
+                    {"$set": {
+                        "months": {"$map": {"input": monthly, "in": "$$this.k"}},
+                        "archived_count": {"$sum": {"$map": {"input": monthly, "in": "$$this.v.count"}}},
+                        "archived_total": {"$sum": {"$map": {"input": monthly, "in": "$$this.v.total"}}},
+                        "archived_through": {"$max": {"$map": {"input": monthly, "in": "$$this.v.through"}}}
+                    }},
+                    {"$unset": "recent_batches"}
+                ],
+                upsert=True
+            )
+            for user_id, months in subtotals.items()
+        ], ordered=False)
+        
+        # 3) Only now drop the rows from the hot collection
+        await hot.delete_many({"_id": {"$in": [transaction['_id'] for transaction in batch]}})
+    
+    async def get_user_transactions(self, user_id: int, limit: int = 10,
+                                    projection: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """Newest-first transactions for a user across the hot and archived tiers"""
+        hot = self.user_model.get_collection('transactions')
+        if hot is None:
+            return []
+        
+        transactions = await hot.find(
+            {"user_id": user_id}, projection
+        ).sort("timestamp", -1).limit(limit).to_list(limit)
+        if len(transactions) >= limit:
+            return transactions
+        
+        # Archived rows are always older than anything still in the hot tier
+        archive_index = self.user_model.get_collection('transaction_archive_index')
+        entry = await archive_index.find_one({"user_id": user_id}, {"_id": 0, "months": 1}) if archive_index is not None else None
+        for month in sorted((entry or {}).get("months", []), reverse=True):
+            remaining = limit - len(transactions)
+            collection = self.user_model.get_collection(f"{self.ARCHIVE_PREFIX}{month}")
+            transactions.extend(await collection.find(
+                {"user_id": user_id}, projection
+            ).sort("timestamp", -1).limit(remaining).to_list(remaining))
+            if len(transactions) >= limit:
+                break
+        
+        return transactions
+    
+    async def renew_pause(self, force: bool = False):
+        """Extend the archival pause lease (cheap to call once per batch read)"""
+        now = time.monotonic()
+        if force or now - self._pause_renewed > self.PAUSE_SECONDS / 3:
+            await shared_state.set(self.PAUSE_KEY, True, self.PAUSE_SECONDS)
+            self._pause_renewed = now
+    
+    @contextlib.asynccontextmanager
+    async def paused(self):
+        """Keep archival off on every replica while reading across both tiers
+        
+        Waits for a batch already being moved to finish. The lease lapses
+        PAUSE_SECONDS after the last renew_pause(), so a reader that stalls
+        (or dies) never blocks archival for longer than that.
+        """
+        await self.renew_pause(force=True)
+        deadline = time.monotonic() + self.PAUSE_SECONDS
+        while await shared_state.get(self.MOVING_KEY) is not None and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        yield
+    
+    async def archive_collections(self, workload: str = "oltp") -> List[Any]:
+        """Every monthly archive collection, oldest month first"""
+        if not db_client or not db_connected:
+            return []
+        names = await db_client.walletbot.list_collection_names(
+            filter={"name": {"$regex": f"^{self.ARCHIVE_PREFIX}"}}
+        )
+        return [query_router.collection(name, workload) for name in sorted(names)]
+    
+    async def get_archive_summary(self, user_id: int) -> Dict[str, Any]:
+        """Archived row count, sum and months for a user"""
+        archive_index = self.user_model.get_collection('transaction_archive_index')
+        if archive_index is None:
+            return {}
+        entry = await archive_index.find_one(
+            {"user_id": user_id}, {"_id": 0}
+        )
+        return entry or {"user_id": user_id, "months": [], "archived_count": 0, "archived_total": 0.0}
+
+# ==================== LEDGER VERIFICATION ====================
+
+@profiled_queries
+class LedgerVerifier:
+    """Verify every wallet_balance against checkpoints plus replayed transactions
+    
+    The expected balance is a baseline plus the hot transactions after it:
+    the user's last balance checkpoint, or else the archived total from
+    ``transaction_archive_index`` (or zero). Users are processed in user_id
+    ranges by a bounded pool, each range being one aggregation pipeline.
+    Users whose wallet changed after the run's cutoff are skipped. Clean
+    users get a fresh checkpoint so the next run replays less.
+    """
+    
+    EPOCH = datetime(1970, 1, 1)
+    TOLERANCE = 0.01
+    # add_to_wallet writes the balance before the transaction row
+    WRITE_GRACE = timedelta(seconds=60)
+    
+    def __init__(self, user_model_instance, concurrency: int = LEDGER_VERIFY_CONCURRENCY,
+                 batch_size: int = LEDGER_VERIFY_BATCH_SIZE):
+        self.user_model = user_model_instance
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.current_report_id: Optional[str] = None
+    
+    def build_pipeline(self, low: int, high: int, cutoff: datetime) -> List[Dict[str, Any]]:
+        """Aggregation computing expected vs. actual balance for one user_id range"""
+        user_cutoff = cutoff - self.WRITE_GRACE
+        return [
+            {"$match": {
+                "user_id": {"$gte": low, "$lte": high},
+                "$or": [{"updated_at": {"$lt": user_cutoff}}, {"updated_at": {"$exists": False}}]
+            }},
+            {"$project": {"_id": 0, "user_id": 1, "wallet_balance": {"$ifNull": ["$wallet_balance", 0]}}},
+            {"$lookup": {
+                "from": "balance_checkpoints", "localField": "user_id",
+                "foreignField": "user_id", "as": "checkpoint"
+            }},
+            {"$lookup": {
+                "from": "transaction_archive_index", "localField": "user_id",
+                "foreignField": "user_id", "as": "archive"
+            }},
+            {"$set": {"checkpoint": {"$first": "$checkpoint"}, "archive": {"$first": "$archive"}}},
+            {"$set": {"archived_through": {"$ifNull": ["$archive.archived_through", self.EPOCH]}}},
+            {"$set": {"baseline": {"$cond": [
+                # A checkpoint is only usable if nothing after it was archived
+                {"$and": [
+                    {"$ne": [{"$type": "$checkpoint"}, "missing"]},
+                    {"$gte": ["$checkpoint.as_of", "$archived_through"]}
+                ]},
+                {"source": "checkpoint", "balance": "$checkpoint.balance", "since": "$checkpoint.as_of"},
+                {
+                    "source": {"$cond": [{"$eq": [{"$type": "$archive"}, "missing"]}, "genesis", "archive"]},
+                    "balance": {"$ifNull": ["$archive.archived_total", 0]},
+                    "since": "$archived_through"
+                }
+            ]}}},
+            {"$lookup": {
+                "from": "transactions",
+                "let": {"uid": "$user_id", "since": "$baseline.since"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$and": [
+                        {"$eq": ["$user_id", "$$uid"]},
+                        {"$gt": ["$timestamp", "$$since"]},
+                        {"$lt": ["$timestamp", cutoff]}
+                    ]}}},
+                    {"$group": {"_id": None, "total": {"$sum": "$amount"}, "count": {"$sum": 1}}}
+                ],
+                "as": "replayed"
+            }},
+            {"$set": {"replayed": {"$first": "$replayed"}}},
+            {"$project": {
+                "user_id": 1,
+                "wallet_balance": 1,
+                "baseline_source": "$baseline.source",
+                "replayed_count": {"$ifNull": ["$replayed.count", 0]},
+                "expected_balance": {"$add": ["$baseline.balance", {"$ifNull": ["$replayed.total", 0]}]}
+            }},
+            {"$set": {"drift": {"$subtract": ["$wallet_balance", "$expected_balance"]}}}
+        ]
+    
+    async def _user_id_ranges(self):
+        """Split the user_id index into contiguous ranges of batch_size users"""
+        users = self.user_model.get_collection('users')
+        ranges = []
+        chunk = []
+        async for user in users.find({}, {"_id": 0, "user_id": 1}).sort("user_id", 1).batch_size(10000):
+            chunk.append(user["user_id"])
+            if len(chunk) >= self.batch_size:
+                ranges.append((chunk[0], chunk[-1], len(chunk)))
+                chunk = []
+        if chunk:
+            ranges.append((chunk[0], chunk[-1], len(chunk)))
+        return ranges
+    
+    async def _verify_range(self, report_id: str, low: int, high: int, size: int, cutoff: datetime) -> Dict[str, Any]:
+        users = self.user_model.get_collection('users')
+        results = await users.aggregate(self.build_pipeline(low, high, cutoff), allowDiskUse=True).to_list(None)
+        
+        discrepancies = []
+        checkpoints = []
+        now = datetime.utcnow()
+        for result in results:
+            if abs(result["drift"]) > self.TOLERANCE:
+                discrepancies.append({"report_id": report_id, **result, "detected_at": now})
+            elif result["replayed_count"] or result["baseline_source"] != "checkpoint":
+                checkpoints.append(UpdateOne(
+                    {"user_id": result["user_id"]},
+                    {"$set": {"balance": result["wallet_balance"], "as_of": cutoff, "updated_at": now}},
+                    upsert=True
+                ))
+        
+        if discrepancies:
+            await self.user_model.get_collection('ledger_discrepancies').insert_many(discrepancies, ordered=False)
+        if checkpoints:
+            await self.user_model.get_collection('balance_checkpoints').bulk_write(checkpoints, ordered=False)
+        
+        return {
+            "checked": len(results),
+            "skipped": size - len(results),
+            "discrepancies": len(discrepancies),
+            "total_drift": sum(item["drift"] for item in discrepancies),
+            "checkpoints_written": len(checkpoints)
+        }
+    
+    async def run(self) -> Dict[str, Any]:
+        """Verify all users and store a report in ``ledger_reports``"""
+        reports = self.user_model.get_collection('ledger_reports')
+        if reports is None or self.user_model.get_collection('users') is None:
+            return {"success": False, "message": "Database not available"}
+        if self.current_report_id:
+            return {"success": False, "message": "Verification already running", "report_id": self.current_report_id}
+        
+        report_id = f"LEDGER{datetime.utcnow().strftime('%Y%m%d%H%M%S')}{uuid.uuid4().hex[:4].upper()}"
+        self.current_report_id = report_id
+        started = datetime.utcnow()
+        cutoff = started
+        totals = {"checked": 0, "skipped": 0, "discrepancies": 0, "total_drift": 0.0, "checkpoints_written": 0}
+        
+        try:
+            await reports.insert_one({
+                "report_id": report_id, "status": "running", "started_at": started, "cutoff": cutoff
+            })
+            
+            ranges = await self._user_id_ranges()
+            semaphore = asyncio.Semaphore(self.concurrency)
+            
+            async def verify(low, high, size):
+                async with semaphore:
+                    await transaction_archive.renew_pause()
+                    return await self._verify_range(report_id, low, high, size, cutoff)
+            
+            # Archival moves rows between tiers; keep it paused while replaying
+            async with transaction_archive.paused():
+                results = await asyncio.gather(*(verify(*user_range) for user_range in ranges))
+            for result in results:
+                for key in totals:
+                    totals[key] += result[key]
+            
+            finished = datetime.utcnow()
+            summary = {
+                "status": "completed",
+                "finished_at": finished,
+                "duration_seconds": (finished - started).total_seconds(),
+                "batches": len(ranges),
+                **totals
+            }
+            await reports.update_one({"report_id": report_id}, {"$set": summary})
+            
+            log = logger.warning if totals["discrepancies"] else logger.info
+            log(f"📒 Ledger verification {report_id}: {totals['checked']} users checked, "
+                f"{totals['discrepancies']} discrepancies, {summary['duration_seconds']:.1f}s")
+            return {"success": True, "report_id": report_id, **summary}
+            
+        except Exception as e:
+            logger.error(f"❌ Ledger verification error: {e}")
+            await reports.update_one(
+                {"report_id": report_id},
+                {"$set": {"status": "failed", "error": str(e), "finished_at": datetime.utcnow(), **totals}}
+            )
+            return {"success": False, "message": "Technical error occurred", "report_id": report_id}
+        finally:
+            self.current_report_id = None
+
+class QueryRouter:
+    """Pick a collection profile by workload class
+    
+    - ``oltp``: bot traffic, client defaults
+    - ``critical``: wallet and verification reads, always primary (even if
+      MONGODB_URL sets a readPreference)
+    - ``analytics``: dashboards, statistics and admin lists, secondaryPreferred
+      with bounded staleness - except within MONGO_READ_YOUR_WRITES_SECONDS of
+      an admin write on any replica, when they fall back to the primary
+    
+    The last admin write time is published in ``shared_state``, and every
+    admin read picks it up first, so the follow-up read can land on another
+    replica than the write.
+    """
+    
+    WORKLOAD_PROFILES = {"oltp": "default", "critical": "primary", "analytics": "analytics"}
+    ADMIN_WRITE_KEY = "query_router:last_admin_write"
+    
+    def __init__(self, user_model_instance, read_your_writes_seconds: float = MONGO_READ_YOUR_WRITES_SECONDS):
+        self.user_model = user_model_instance
+        self.read_your_writes_seconds = read_your_writes_seconds
+        self.last_admin_write: Optional[float] = None  # wall clock, comparable across replicas
+        self.routed: Dict[str, int] = {profile: 0 for profile in COLLECTION_PROFILES}
+    
+    async def mark_admin_write(self):
+        self.last_admin_write = time.time()
+        try:
+            await shared_state.set(self.ADMIN_WRITE_KEY, self.last_admin_write, self.read_your_writes_seconds)
+        except Exception as e:
+            logger.warning(f"⚠️ Could not publish admin write marker: {e}")
+    
+    async def sync_admin_write(self):
+        """Adopt a newer admin write marker published by another replica"""
+        try:
+            marker = await shared_state.get(self.ADMIN_WRITE_KEY)
+        except Exception as e:
+            logger.warning(f"⚠️ Could not read admin write marker: {e}")
+            return
+        if marker is not None and marker > (self.last_admin_write or 0):
+            self.last_admin_write = marker
+    
+    def profile_for(self, workload: str) -> str:
+        profile = self.WORKLOAD_PROFILES[workload]
+        if profile == "analytics" and self.last_admin_write is not None and (
+            time.time() - self.last_admin_write < self.read_your_writes_seconds
+        ):
+            return "primary"
+        return profile
+    
+    def collection(self, name: str, workload: str = "oltp"):
+        profile = self.profile_for(workload)
+        self.routed[profile] += 1
+        return self.user_model.get_collection(name, profile)
+
 # Initialize models
 user_model = EnhancedUserModel()
+query_router = QueryRouter(user_model)
+leader_election = LeaderElection(user_model)
+shared_state = create_shared_state_store(user_model)
+if CLUSTER_MODE:
+    periodic_tasks.append(PeriodicTask("leader_lease", leader_election.campaign, max(1, CLUSTER_LEASE_SECONDS // 3)))
 gift_code_manager = GiftCodeManager(user_model)
+device_similarity_index = DeviceSimilarityIndex(user_model)
+dashboard_stats = DashboardStatsManager(user_model)
+periodic_tasks.append(PeriodicTask(
+    "dashboard_stats_reconcile", dashboard_stats.reconcile,
+    DASHBOARD_STATS_RECONCILE_SECONDS, initial_delay=DASHBOARD_STATS_RECONCILE_SECONDS, leader_only=True
+))
+analytics_rollups = AnalyticsRollupManager(user_model)
+transaction_archive = TransactionArchiveManager(user_model)
+ledger_verifier = LedgerVerifier(user_model)
+periodic_tasks.append(PeriodicTask(
+    "ledger_verification", ledger_verifier.run,
+    LEDGER_VERIFY_INTERVAL_SECONDS, initial_delay=LEDGER_VERIFY_INTERVAL_SECONDS, leader_only=True
+))
+periodic_tasks.append(PeriodicTask(
+    "transaction_archive", transaction_archive.archive_old_transactions,
+    TRANSACTION_ARCHIVE_INTERVAL_SECONDS, initial_delay=300, leader_only=True
+))
+periodic_tasks.append(PeriodicTask(
+    "analytics_rollups", analytics_rollups.run, ANALYTICS_ROLLUP_INTERVAL_SECONDS, initial_delay=15,
+    leader_only=True
+))
 
 
 
@@ -1027,6 +4044,7 @@ gift_code_manager = GiftCodeManager(user_model)
 
 # ==================== CAMPAIGN MANAGEMENT CLASS ====================
 
+@profiled_queries
 class CampaignManager:
     """Complete campaign management with admin controls"""
     
@@ -1068,6 +4086,7 @@ class CampaignManager:
             }
             
             await collection.insert_one(campaign_doc)
+            await dashboard_stats.increment({"campaigns.total": 1, "campaigns.active": 1})
             
             logger.info(f"📊 New campaign created: {campaign_id} - {campaign_data.get('name')}")
             return {"success": True, "campaign_id": campaign_id}
@@ -1084,6 +4103,20 @@ class CampaignManager:
         
         try:
             updates['updated_at'] = datetime.utcnow()
+            
+            if 'status' in updates:
+                # Fetch the previous status in the same round trip to keep counters exact
+                previous = await collection.find_one_and_update(
+                    {"campaign_id": campaign_id},
+                    {"$set": updates},
+                    projection={"_id": 0, "status": 1}
+                )
+                if previous is None:
+                    return False
+                await dashboard_stats.record_campaign_status(previous.get('status'), updates['status'])
+                logger.info(f"📝 Campaign updated: {campaign_id}")
+                return True
+            
             result = await collection.update_one(
                 {"campaign_id": campaign_id},
                 {"$set": updates}
@@ -1125,8 +4158,8 @@ class CampaignManager:
     
     async def get_campaign_stats(self, campaign_id: str) -> Dict[str, Any]:
         """Get campaign statistics"""
-        collection = self.user_model.get_collection('campaigns')
-        screenshots_collection = self.user_model.get_collection('screenshots')
+        collection = query_router.collection('campaigns', 'analytics')
+        screenshots_collection = query_router.collection('screenshots', 'analytics')
         
         if not collection or not screenshots_collection:
             return {}
@@ -1207,6 +4240,7 @@ class CampaignManager:
 
 # ==================== SCREENSHOT MANAGEMENT CLASS ====================
 
+@profiled_queries
 class ScreenshotManager:
     """Handle screenshot uploads, approvals, and file management"""
     
@@ -1224,8 +4258,9 @@ class ScreenshotManager:
             file_path = os.path.join(self.upload_dir, filename)
             
             # Save file
-            async with aiofiles.open(file_path, 'wb') as f:
-                await f.write(file_content)
+            with update_tracer.span("file.write", {"file.path": file_path, "file.size": len(file_content)}):
+                async with aiofiles.open(file_path, 'wb') as f:
+                    await f.write(file_content)
             
             file_size = len(file_content)
             
@@ -1352,6 +4387,7 @@ class ScreenshotManager:
                     }
                 }
             )
+            await dashboard_stats.increment({"screenshots.pending": -1})
             
             # Add reward to user wallet
             await self.user_model.add_to_wallet(
@@ -1409,6 +4445,7 @@ class ScreenshotManager:
                     }
                 }
             )
+            await dashboard_stats.increment({"screenshots.pending": -1})
             
             # Update user and campaign stats
             await self.user_model.update_user(screenshot['user_id'], {
@@ -1509,6 +4546,103 @@ screenshot_manager = ScreenshotManager(user_model)
 #  Complete payment system with multiple gateways and manual/auto processing.
 # ============================================================
 
+# ==================== GATEWAY HTTP CLIENT ====================
+
+class GatewayHTTPClient:
+    """Long-lived aiohttp session for one payment gateway
+    
+    Keeps TCP/TLS connections alive between payouts, caches DNS lookups and
+    sends a fixed set of default headers (auth is encoded once). The session
+    is created lazily so it binds to the running event loop.
+    """
+    
+    def __init__(self, name: str, base_url: str, headers: Dict[str, str] = None,
+                 pool_size: int = GATEWAY_HTTP_POOL_SIZE, timeout: float = GATEWAY_HTTP_TIMEOUT_SECONDS,
+                 dns_cache_seconds: int = GATEWAY_DNS_CACHE_SECONDS, keepalive_seconds: float = 30.0):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.headers = dict(headers or {})
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=min(timeout, 10.0))
+        self.dns_cache_seconds = dns_cache_seconds
+        self.keepalive_seconds = keepalive_seconds
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.requests_sent = 0
+    
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                ttl_dns_cache=self.dns_cache_seconds,
+                keepalive_timeout=self.keepalive_seconds
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers=self.headers,
+                json_serialize=lambda value: dump_json(value).decode("utf-8")
+            )
+        return self._session
+    
+    async def post_json(self, path: str, payload: Dict[str, Any],
+                        headers: Dict[str, str] = None) -> tuple:
+        """POST a JSON body; returns (status, parsed JSON or {})"""
+        self.requests_sent += 1
+        async with self.session.post(f"{self.base_url}{path}", json=payload, headers=headers) as response:
+            try:
+                body = await response.json(content_type=None)
+            except (aiohttp.ContentTypeError, ValueError):
+                body = {}
+            return response.status, body or {}
+    
+    async def post_body(self, path: str, body: bytes, headers: Dict[str, str] = None,
+                        timeout: float = None) -> int:
+        """POST pre-serialized bytes (e.g. a signed payload); returns the status code"""
+        self.requests_sent += 1
+        options = {"timeout": aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+        async with self.session.post(f"{self.base_url}{path}", data=body, headers=headers, **options) as response:
+            await response.read()
+            return response.status
+    
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+class GatewayHTTPPool:
+    """Registry of per-gateway HTTP clients, closed together on shutdown"""
+    
+    def __init__(self):
+        self.clients: Dict[str, GatewayHTTPClient] = {}
+    
+    def client(self, name: str, base_url: str, headers: Dict[str, str] = None) -> GatewayHTTPClient:
+        """Return the client for a gateway, replacing it only if its endpoint or credentials changed"""
+        existing = self.clients.get(name)
+        if existing is not None and existing.base_url == base_url.rstrip("/") and existing.headers == (headers or {}):
+            return existing
+        if existing is not None:
+            # Gateway was reconfigured; let the old session drain in the background
+            asyncio.get_event_loop().create_task(existing.close())
+        self.clients[name] = GatewayHTTPClient(name, base_url, headers)
+        return self.clients[name]
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            name: {
+                "requests_sent": client.requests_sent,
+                "open": client._session is not None and not client._session.closed
+            }
+            for name, client in self.clients.items()
+        }
+    
+    async def close_all(self):
+        for client in self.clients.values():
+            await client.close()
+
+gateway_http = GatewayHTTPPool()
+
 # ==================== PAYMENT GATEWAY BASE CLASS ====================
 
 class PaymentGatewayBase:
@@ -1519,8 +4653,13 @@ class PaymentGatewayBase:
         self.is_test_mode = is_test_mode
         self.gateway_name = "base"
     
-    async def process_payment(self, amount: float, recipient_details: Dict[str, Any]) -> Dict[str, Any]:
-        """Process payment - to be implemented by subclasses"""
+    async def process_payment(self, amount: float, recipient_details: Dict[str, Any],
+                              idempotency_key: str = None) -> Dict[str, Any]:
+        """Process payment - to be implemented by subclasses
+        
+        ``idempotency_key`` is stable across retries of the same withdrawal so
+        the gateway can drop duplicate payouts.
+        """
         raise NotImplementedError("Subclasses must implement process_payment")
     
     async def verify_recipient(self, recipient_details: Dict[str, Any]) -> Dict[str, Any]:
@@ -1536,62 +4675,67 @@ class PaymentGatewayBase:
 class RazorpayGateway(PaymentGatewayBase):
     """Razorpay payment gateway integration"""
     
-    def __init__(self, api_key: str, api_secret: str, is_test_mode: bool = False):
+    def __init__(self, api_key: str, api_secret: str, is_test_mode: bool = False,
+                 base_url: str = RAZORPAY_BASE_URL):
         super().__init__(api_key, is_test_mode)
         self.api_secret = api_secret
         self.gateway_name = "razorpay"
-        self.base_url = "https://api.razorpay.com/v1"
+        self.base_url = base_url
+        
+        auth_b64 = base64.b64encode(f"{api_key}:{api_secret}".encode('ascii')).decode('ascii')
+        self.http = gateway_http.client(self.gateway_name, self.base_url, {
+            "Authorization": f"Basic {auth_b64}",
+            "Content-Type": "application/json"
+        })
+    
+    # Razorpay has no bulk payout endpoint: each payout is its own POST /payouts
+    # carrying X-Payout-Idempotency, which the gateway deduplicates on
+    
+    def build_payout(self, amount: float, recipient_details: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Razorpay payout body for a recipient, or None for unsupported methods"""
+        payment_method = recipient_details.get('method', 'upi')
+        
+        if payment_method == 'upi':
+            return {
+                "account_number": "2323230001548326",  # Your account
+                "fund_account": {
+                    "account_type": "vpa",
+                    "vpa": {
+                        "address": recipient_details.get('upi_id')
+                    }
+                },
+                "amount": int(amount * 100),  # Convert to paise
+                "currency": "INR",
+                "mode": "UPI",
+                "purpose": "payout"
+            }
+        if payment_method == 'bank':
+            return {
+                "account_number": "2323230001548326",
+                "fund_account": {
+                    "account_type": "bank_account",
+                    "bank_account": {
+                        "name": recipient_details.get('account_name'),
+                        "ifsc": recipient_details.get('ifsc_code'),
+                        "account_number": recipient_details.get('account_number')
+                    }
+                },
+                "amount": int(amount * 100),
+                "currency": "INR",
+                "mode": "NEFT",
+                "purpose": "payout"
+            }
+        return None
     
-    async def process_payment(self, amount: float, recipient_details: Dict[str, Any]) -> Dict[str, Any]:
+    async def process_payment(self, amount: float, recipient_details: Dict[str, Any],
+                              idempotency_key: str = None) -> Dict[str, Any]:
         """Process Razorpay payment"""
         try:
-            import aiohttp
-            import base64
-            
-            # Create auth header
-            auth_string = f"{self.api_key}:{self.api_secret}"
-            auth_bytes = auth_string.encode('ascii')
-            auth_b64 = base64.b64encode(auth_bytes).decode('ascii')
-            
-            headers = {
-                "Authorization": f"Basic {auth_b64}",
-                "Content-Type": "application/json"
-            }
-            
-            # Prepare payment data based on method
-            payment_method = recipient_details.get('method', 'upi')
+            # Auth and content type are session defaults; only per-payout headers here
+            headers = {"X-Payout-Idempotency": idempotency_key} if idempotency_key else None
             
-            if payment_method == 'upi':
-                payment_data = {
-                    "account_number": "2323230001548326",  # Your account
-                    "fund_account": {
-                        "account_type": "vpa",
-                        "vpa": {
-                            "address": recipient_details.get('upi_id')
-                        }
-                    },
-                    "amount": int(amount * 100),  # Convert to paise
-                    "currency": "INR",
-                    "mode": "UPI",
-                    "purpose": "payout"
-                }
-            elif payment_method == 'bank':
-                payment_data = {
-                    "account_number": "2323230001548326",
-                    "fund_account": {
-                        "account_type": "bank_account",
-                        "bank_account": {
-                            "name": recipient_details.get('account_name'),
-                            "ifsc": recipient_details.get('ifsc_code'),
-                            "account_number": recipient_details.get('account_number')
-                        }
-                    },
-                    "amount": int(amount * 100),
-                    "currency": "INR",
-                    "mode": "NEFT",
-                    "purpose": "payout"
-                }
-            else:
+            payment_data = self.build_payout(amount, recipient_details)
+            if payment_data is None:
                 return {"success": False, "message": "Unsupported payment method"}
             
             if self.is_test_mode:
@@ -1602,30 +4746,20 @@ class RazorpayGateway(PaymentGatewayBase):
                     "message": "Payment processed successfully (TEST MODE)"
                 }
             
-            # Make API request (commented for safety - implement when you have valid credentials)
-            """
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.base_url}/payouts",
-                    headers=headers,
-                    json=payment_data
-                ) as response:
-                    result = await response.json()
-                    
-                    if response.status == 200:
-                        return {
-                            "success": True,
-                            "transaction_id": result.get("id"),
-                            "message": "Payment processed successfully"
-                        }
-                    else:
-                        return {
-                            "success": False,
-                            "message": result.get("error", {}).get("description", "Payment failed")
-                        }
-            """
-            
-            # For now, return test success
+            if RAZORPAY_LIVE_PAYOUTS:
+                status, result = await self.http.post_json("/payouts", payment_data, headers=headers)
+                if status == 200:
+                    return {
+                        "success": True,
+                        "transaction_id": result.get("id"),
+                        "message": "Payment processed successfully"
+                    }
+                return {
+                    "success": False,
+                    "message": result.get("error", {}).get("description", "Payment failed")
+                }
+            
+            # Live payouts disabled - return simulated success
             return {
                 "success": True,
                 "transaction_id": f"rzp_live_{uuid.uuid4().hex[:12]}",
@@ -1639,6 +4773,40 @@ class RazorpayGateway(PaymentGatewayBase):
     def get_supported_methods(self) -> List[str]:
         return ["upi", "bank", "wallet"]
 
+# ==================== SIMULATED GATEWAY ====================
+
+class SimulatedPayoutGateway(PaymentGatewayBase):
+    """In-process gateway with configurable latency and failure rate
+    
+    Every call is recorded in ``calls`` so load tests can inspect gateway traffic.
+    """
+    
+    def __init__(self, latency_ms: float = 50.0, failure_rate: float = 0.0, methods=("upi", "bank", "wallet")):
+        super().__init__("simulated", is_test_mode=True)
+        self.gateway_name = "simulated"
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self.methods = list(methods)
+        self.calls: List[Dict[str, Any]] = []
+    
+    def _result(self) -> Dict[str, Any]:
+        if random.random() < self.failure_rate:
+            return {"success": False, "message": "Simulated payout failure"}
+        return {
+            "success": True,
+            "transaction_id": f"sim_{uuid.uuid4().hex[:12]}",
+            "message": "Payment processed successfully (SIMULATED)"
+        }
+    
+    async def process_payment(self, amount: float, recipient_details: Dict[str, Any],
+                              idempotency_key: str = None) -> Dict[str, Any]:
+        self.calls.append({"amount": amount, "idempotency_key": idempotency_key, "at": datetime.utcnow()})
+        await asyncio.sleep(self.latency_ms / 1000)
+        return self._result()
+    
+    def get_supported_methods(self) -> List[str]:
+        return self.methods
+
 # ==================== PAYTM GATEWAY ====================
 
 class PaytmGateway(PaymentGatewayBase):
@@ -1650,7 +4818,8 @@ class PaytmGateway(PaymentGatewayBase):
         self.gateway_name = "paytm"
         self.base_url = "https://secure.paytm.in/oltp-web/processTransaction" if not is_test_mode else "https://pguat.paytm.com/oltp-web/processTransaction"
     
-    async def process_payment(self, amount: float, recipient_details: Dict[str, Any]) -> Dict[str, Any]:
+    async def process_payment(self, amount: float, recipient_details: Dict[str, Any],
+                              idempotency_key: str = None) -> Dict[str, Any]:
         """Process Paytm payment"""
         try:
             # Paytm wallet transfer logic
@@ -1686,6 +4855,7 @@ class PaytmGateway(PaymentGatewayBase):
 
 # ==================== MANUAL PAYMENT PROCESSOR ====================
 
+@profiled_queries
 class ManualPaymentProcessor:
     """Handle manual payment approvals through admin bot"""
     
@@ -1810,10 +4980,17 @@ class ManualPaymentProcessor:
                 )
                 
                 # Update user withdrawal stats
-                await self.user_model.update_user(withdrawal['user_id'], {
-                    "withdrawal_total": {"$inc": withdrawal['amount']},
-                    "pending_withdrawals": 0
-                })
+                users_collection = self.user_model.get_collection('users')
+                if users_collection is not None:
+                    await users_collection.update_one(
+                        {"user_id": withdrawal['user_id']},
+                        {
+                            "$inc": {"withdrawal_total": withdrawal['amount']},
+                            "$set": {"pending_withdrawals": 0}
+                        }
+                    )
+                await dashboard_stats.record_withdrawal_status(withdrawal['amount'], 'pending', 'approved')
+                await dashboard_stats.increment({"wallet.total_withdrawals": withdrawal['amount']})
                 
                 logger.info(f"✅ Withdrawal approved: {request_id} (Rs.{withdrawal['amount']})")
                 return {
@@ -1839,6 +5016,7 @@ class ManualPaymentProcessor:
                 await self.user_model.update_user(withdrawal['user_id'], {
                     "pending_withdrawals": 0
                 })
+                await dashboard_stats.record_withdrawal_status(withdrawal['amount'], 'pending', 'rejected')
                 
                 logger.info(f"❌ Withdrawal rejected: {request_id}")
                 return {
@@ -1855,12 +5033,15 @@ class ManualPaymentProcessor:
 
 # ==================== PAYMENT MANAGER ====================
 
+@profiled_queries
 class PaymentManager:
     """Main payment processing manager"""
     
     def __init__(self, user_model_instance):
         self.user_model = user_model_instance
         self.gateways = {}
+        self.gateways_config_hash: Optional[str] = None
+        self.gateways_initialized_at: Optional[datetime] = None
         self.manual_processor = ManualPaymentProcessor(user_model_instance, ADMIN_CHAT_ID)
         self.payment_methods = {
             'upi': {
@@ -1891,16 +5072,29 @@ class PaymentManager:
             }
         }
     
-    async def initialize_gateways(self):
-        """Initialize payment gateways from bot settings"""
+    async def initialize_gateways(self, force: bool = False) -> bool:
+        """Initialize payment gateways from bot settings
+        
+        Gateways are only rebuilt when their configuration changes; the new
+        set replaces the old dict in one assignment so in-flight payouts keep
+        the instance they started with. Returns True when rebuilt.
+        """
         try:
             settings = await self.user_model.get_bot_settings()
             gateways_config = settings.get('payment_gateways', {})
             
+            config_hash = hashlib.sha256(
+                json.dumps([gateways_config, PAYOUT_SIMULATED_GATEWAY], sort_keys=True, default=str).encode()
+            ).hexdigest()
+            if not force and config_hash == self.gateways_config_hash:
+                return False
+            
+            gateways = {}
+            
             # Initialize Razorpay
             razorpay_config = gateways_config.get('razorpay', {})
             if razorpay_config.get('enabled') and razorpay_config.get('api_key'):
-                self.gateways['razorpay'] = RazorpayGateway(
+                gateways['razorpay'] = RazorpayGateway(
                     razorpay_config['api_key'],
                     razorpay_config.get('api_secret', ''),
                     is_test_mode=True  # Set to False in production
@@ -1910,17 +5104,26 @@ class PaymentManager:
             # Initialize Paytm
             paytm_config = gateways_config.get('paytm', {})
             if paytm_config.get('enabled') and paytm_config.get('api_key'):
-                self.gateways['paytm'] = PaytmGateway(
+                gateways['paytm'] = PaytmGateway(
                     paytm_config['api_key'],
                     paytm_config.get('merchant_id', ''),
                     is_test_mode=True
                 )
                 logger.info("💳 Paytm gateway initialized")
             
+            if PAYOUT_SIMULATED_GATEWAY:
+                gateways['simulated'] = SimulatedPayoutGateway()
+                logger.info("💳 Simulated payout gateway initialized")
+            
+            self.gateways = gateways
+            self.gateways_config_hash = config_hash
+            self.gateways_initialized_at = datetime.utcnow()
             logger.info(f"💳 Payment system initialized with {len(self.gateways)} gateways")
+            return True
             
         except Exception as e:
             logger.error(f"❌ Payment gateway initialization error: {e}")
+            return False
     
     async def get_available_payment_methods(self) -> Dict[str, Any]:
         """Get available payment methods with their configurations"""
@@ -1958,17 +5161,13 @@ class PaymentManager:
                 return {"success": False, "message": "Unable to send approval request"}
                 
             elif payment_mode == 'automatic':
-                # Process automatically using available gateways
                 payment_method = withdrawal_request['payment_method']
+                has_gateway = any(
+                    payment_method in gateway.get_supported_methods()
+                    for gateway in self.gateways.values()
+                )
                 
-                # Find suitable gateway
-                selected_gateway = None
-                for gateway_name, gateway in self.gateways.items():
-                    if payment_method in gateway.get_supported_methods():
-                        selected_gateway = gateway
-                        break
-                
-                if not selected_gateway:
+                if not has_gateway:
                     # Fallback to manual processing
                     if bot_instance:
                         success = await self.manual_processor.send_approval_request(withdrawal_request, bot_instance)
@@ -1979,42 +5178,8 @@ class PaymentManager:
                             }
                     return {"success": False, "message": "No payment gateway available"}
                 
-                # Process automatic payment
-                payment_result = await selected_gateway.process_payment(
-                    withdrawal_request['amount'],
-                    withdrawal_request['payment_details']
-                )
-                
-                if payment_result['success']:
-                    # Update withdrawal as completed
-                    collection = self.user_model.get_collection('withdrawal_requests')
-                    if collection is not None:
-                        await collection.update_one(
-                            {"request_id": withdrawal_request['request_id']},
-                            {
-                                "$set": {
-                                    "status": "completed",
-                                    "processed_time": datetime.utcnow(),
-                                    "transaction_id": payment_result.get('transaction_id'),
-                                    "gateway_used": selected_gateway.gateway_name
-                                }
-                            }
-                        )
-                    
-                    # Deduct from user wallet
-                    await self.user_model.subtract_from_wallet(
-                        withdrawal_request['user_id'],
-                        withdrawal_request['amount'],
-                        "withdrawal",
-                        f"Automatic withdrawal: {withdrawal_request['request_id']}"
-                    )
-                    
-                    return {
-                        "success": True,
-                        "message": f"Payment processed successfully via {selected_gateway.gateway_name}"
-                    }
-                else:
-                    return {"success": False, "message": payment_result['message']}
+                # Gateway calls happen in the withdrawal worker pool
+                return await withdrawal_queue.enqueue(withdrawal_request)
             
             return {"success": False, "message": "Invalid payment mode configuration"}
             
@@ -2025,7 +5190,7 @@ class PaymentManager:
     async def get_withdrawal_statistics(self) -> Dict[str, Any]:
         """Get withdrawal statistics for admin dashboard"""
         try:
-            collection = self.user_model.get_collection('withdrawal_requests')
+            collection = query_router.collection('withdrawal_requests', 'analytics')
             if collection is None:
                 return {}
             
@@ -2042,6 +5207,7 @@ class PaymentManager:
             
             result = {
                 "pending": {"count": 0, "amount": 0.0},
+                "processing": {"count": 0, "amount": 0.0},
                 "approved": {"count": 0, "amount": 0.0},
                 "rejected": {"count": 0, "amount": 0.0},
                 "completed": {"count": 0, "amount": 0.0}
@@ -2067,8 +5233,455 @@ class PaymentManager:
             logger.error(f"❌ Error getting withdrawal statistics: {e}")
             return {}
 
+# ==================== WITHDRAWAL JOB QUEUE ====================
+
+class CircuitBreaker:
+    """Stops calling a gateway after repeated failures, probing again after a cool-down"""
+    
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.state = "closed"
+        self.opened_at: Optional[datetime] = None
+    
+    def allow(self) -> bool:
+        """Whether a call may go through (one probe at a time when half-open)"""
+        if self.state == "open":
+            if (datetime.utcnow() - self.opened_at).total_seconds() >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            return False
+        return self.state == "closed"
+    
+    def record_success(self):
+        self.failures = 0
+        self.state = "closed"
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = datetime.utcnow()
+
+@profiled_queries
+class WithdrawalJobQueue:
+    """Mongo-backed queue of automatic payouts processed by a bounded worker pool
+    
+    Each withdrawal becomes one ``withdrawal_jobs`` document. Idle workers
+    claim due jobs atomically (so a job is only locked once a worker can run
+    it); every gateway has its own concurrency semaphore and circuit breaker.
+    The wallet is debited before the first gateway call and refunded if the
+    job finally fails, both under per-request ledger keys (wd-debit-,
+    wd-refund-). Failed payouts are retried with exponential backoff and
+    jitter, reusing one idempotency key per withdrawal so a retried payout
+    cannot be paid twice.
+    """
+    
+    RUNNABLE = ("queued", "retry")
+    LOCK_TIMEOUT = timedelta(minutes=5)
+    STAGED_TIMEOUT = timedelta(minutes=1)
+    
+    def __init__(self, payment_manager_instance, user_model_instance,
+                 workers: int = WITHDRAWAL_WORKERS, gateway_concurrency: int = WITHDRAWAL_GATEWAY_CONCURRENCY,
+                 max_attempts: int = WITHDRAWAL_MAX_ATTEMPTS, base_delay: float = 10.0, max_delay: float = 900.0):
+        self.payment_manager = payment_manager_instance
+        self.user_model = user_model_instance
+        self.worker_count = workers
+        self.gateway_concurrency = gateway_concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._busy = 0
+    
+    # -------- enqueue --------
+    
+    async def enqueue(self, withdrawal_request: Dict[str, Any]) -> Dict[str, Any]:
+        """Queue a pending withdrawal for automatic payout"""
+        jobs = self.user_model.get_collection('withdrawal_jobs')
+        requests = self.user_model.get_collection('withdrawal_requests')
+        if jobs is None or requests is None:
+            return {"success": False, "message": "Database error"}
+        
+        request_id = withdrawal_request['request_id']
+        now = datetime.utcnow()
+        try:
+            # Stage the job before touching the request: request_id is unique, so
+            # a request can never end up "processing" without a job behind it
+            job_id = uuid.uuid4().hex
+            try:
+                await jobs.insert_one({
+                    "job_id": job_id,
+                    "request_id": request_id,
+                    "user_id": withdrawal_request['user_id'],
+                    "amount": withdrawal_request['amount'],
+                    "payment_method": withdrawal_request['payment_method'],
+                    "payment_details": withdrawal_request.get('payment_details', {}),
+                    "idempotency_key": f"wd-{request_id}",
+                    "status": "staged",
+                    "attempts": 0,
+                    "next_attempt_at": now,
+                    "created_at": now,
+                    "history": [{"status": "staged", "at": now}]
+                })
+            except DuplicateKeyError:
+                existing = await jobs.find_one({"request_id": request_id}, {"job_id": 1, "status": 1})
+                if existing is None or existing['status'] != "staged":
+                    return {"success": False, "message": "Request already queued"}
+                job_id = existing['job_id']  # left over from an interrupted enqueue
+            
+            claimed = await requests.update_one(
+                {"request_id": request_id, "status": "pending"},
+                {
+                    "$set": {"status": "processing"},
+                    "$push": {"status_history": {"status": "processing", "at": now, "by": "withdrawal_queue"}}
+                }
+            )
+            if claimed.modified_count == 0:
+                await jobs.delete_one({"job_id": job_id, "status": "staged"})
+                return {"success": False, "message": "Request already processed"}
+            await dashboard_stats.record_withdrawal_status(withdrawal_request['amount'], 'pending', 'processing')
+            
+            await jobs.update_one(
+                {"job_id": job_id, "status": "staged"},
+                {
+                    "$set": {"status": "queued", "next_attempt_at": now},
+                    "$push": {"history": {"status": "queued", "at": now}}
+                }
+            )
+            
+            if self._wakeup is not None:
+                self._wakeup.set()
+            
+            logger.info(f"📥 Withdrawal {request_id} queued for automatic payout")
+            return {
+                "success": True,
+                "message": "Withdrawal queued for automatic payment. You will be notified once processed."
+            }
+            
+        except Exception as e:
+            logger.error(f"❌ Withdrawal enqueue error for {request_id}: {e}")
+            return {"success": False, "message": "Technical error occurred"}
+    
+    # -------- lifecycle --------
+    
+    def start(self):
+        """Start the recovery and worker tasks"""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._recovery_loop(), name="withdrawal-recovery")]
+        self._tasks += [
+            asyncio.create_task(self._worker_loop(), name=f"withdrawal-worker-{index}")
+            for index in range(self.worker_count)
+        ]
+        logger.info(f"💸 Withdrawal worker pool started ({self.worker_count} workers)")
+    
+    async def stop(self):
+        """Cancel recovery and workers; in-flight jobs are recovered after LOCK_TIMEOUT"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    # -------- claiming & recovery --------
+    
+    async def _recovery_loop(self):
+        while True:
+            try:
+                await self._recover_stale_jobs()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Withdrawal recovery error: {e}")
+            await asyncio.sleep(30)
+    
+    async def _claim_next_job(self) -> Optional[Dict[str, Any]]:
+        jobs = self.user_model.get_collection('withdrawal_jobs')
+        if jobs is None:
+            return None
+        now = datetime.utcnow()
+        return await jobs.find_one_and_update(
+            {"status": {"$in": list(self.RUNNABLE)}, "next_attempt_at": {"$lte": now}},
+            {
+                "$set": {"status": "running", "locked_by": self.worker_id, "locked_at": now},
+                "$inc": {"attempts": 1},
+                "$push": {"history": {"status": "running", "at": now, "worker": self.worker_id}}
+            },
+            sort=[("next_attempt_at", 1)],
+            return_document=True
+        )
+    
+    async def _recover_stale_jobs(self):
+        """Requeue jobs whose worker died mid-payout (same idempotency key on retry)"""
+        jobs = self.user_model.get_collection('withdrawal_jobs')
+        if jobs is None:
+            return
+        now = datetime.utcnow()
+        result = await jobs.update_many(
+            {"status": "running", "locked_at": {"$lt": now - self.LOCK_TIMEOUT}},
+            {
+                "$set": {"status": "retry", "next_attempt_at": now},
+                "$unset": {"locked_by": "", "locked_at": ""},
+                "$push": {"history": {"status": "retry", "at": now, "reason": "stale lock"}}
+            }
+        )
+        if result.modified_count:
+            logger.warning(f"⚠️ Recovered {result.modified_count} stale withdrawal jobs")
+        
+        async for job in jobs.find({"status": "refund_pending"}):
+            await self._fail(job, job.get('last_error', 'refund retry'))
+        
+        # Jobs staged by an enqueue that died: run them if the request was
+        # moved to processing, otherwise the request never left pending
+        requests = self.user_model.get_collection('withdrawal_requests')
+        if requests is None:
+            return
+        async for job in jobs.find({"status": "staged", "created_at": {"$lt": now - self.STAGED_TIMEOUT}}):
+            request = await requests.find_one({"request_id": job['request_id']}, {"status": 1})
+            if request is not None and request['status'] == "processing":
+                await jobs.update_one(
+                    {"job_id": job['job_id'], "status": "staged"},
+                    {
+                        "$set": {"status": "queued", "next_attempt_at": now},
+                        "$push": {"history": {"status": "queued", "at": now, "reason": "recovered staged job"}}
+                    }
+                )
+                logger.warning(f"⚠️ Queued staged withdrawal job {job['request_id']}")
+            else:
+                await jobs.delete_one({"job_id": job['job_id'], "status": "staged"})
+    
+    # -------- workers --------
+    
+    async def _worker_loop(self):
+        idle_delay = 1.0
+        while True:
+            try:
+                job = await self._claim_next_job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Withdrawal job claim error: {e}")
+                await asyncio.sleep(5)
+                continue
+            
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=idle_delay)
+                except asyncio.TimeoutError:
+                    pass
+                idle_delay = min(idle_delay * 2, 5.0)
+                continue
+            
+            idle_delay = 1.0
+            self._busy += 1
+            try:
+                await self._process_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Withdrawal job {job.get('request_id')} error: {e}")
+                await self._schedule_retry(job, f"worker error: {e}")
+            finally:
+                self._busy -= 1
+    
+    def _select_gateway(self, payment_method: str):
+        for name, gateway in self.payment_manager.gateways.items():
+            if payment_method not in gateway.get_supported_methods():
+                continue
+            if self.breakers.setdefault(name, CircuitBreaker()).allow():
+                return name, gateway
+        return None, None
+    
+    @staticmethod
+    def _ledger_keys(job: Dict[str, Any]) -> tuple:
+        return f"wd-debit-{job['request_id']}", f"wd-refund-{job['request_id']}"
+    
+    async def _debit(self, job: Dict[str, Any]) -> bool:
+        """Take the amount from the wallet once per job, before any money moves
+        
+        Whether the wallet was debited is decided by the ledger row written in
+        the same transaction as the debit, never by state kept beside it.
+        """
+        debit_key, _ = self._ledger_keys(job)
+        if await self.user_model.find_ledger_entry(debit_key) is not None:
+            return True
+        
+        if await self.user_model.subtract_from_wallet(
+            job['user_id'],
+            job['amount'],
+            "withdrawal",
+            f"Automatic withdrawal: {job['request_id']}",
+            idempotency_key=debit_key
+        ):
+            return True
+        # A False can hide a commit whose reply was lost; the ledger knows
+        return await self.user_model.find_ledger_entry(debit_key) is not None
+    
+    async def _process_job(self, job: Dict[str, Any]):
+        if not await self._debit(job):
+            await self._fail(job, "insufficient balance or account not eligible")
+            return
+        
+        name, gateway = self._select_gateway(job['payment_method'])
+        if gateway is None:
+            await self._schedule_retry(job, "no gateway available (unsupported method or circuit open)")
+            return
+        
+        semaphore = self.semaphores.setdefault(name, asyncio.Semaphore(self.gateway_concurrency))
+        recipient_details = {**job.get('payment_details', {}), 'method': job['payment_method']}
+        result = {"success": False, "message": "gateway call raised"}
+        try:
+            async with semaphore:
+                result = await gateway.process_payment(
+                    job['amount'], recipient_details, idempotency_key=job['idempotency_key']
+                )
+        finally:
+            # Always settle the breaker, otherwise a raising half-open probe keeps it shut for good
+            if result.get('success'):
+                self.breakers[name].record_success()
+            else:
+                self.breakers[name].record_failure()
+        
+        if result.get('success'):
+            await self._complete(job, name, result)
+        else:
+            await self._schedule_retry(job, result.get('message', 'payment failed'), gateway_name=name)
+    
+    async def _complete(self, job: Dict[str, Any], gateway_name: str, result: Dict[str, Any]):
+        jobs = self.user_model.get_collection('withdrawal_jobs')
+        requests = self.user_model.get_collection('withdrawal_requests')
+        now = datetime.utcnow()
+        
+        updated = await requests.update_one(
+            {"request_id": job['request_id'], "status": "processing"},
+            {
+                "$set": {
+                    "status": "completed",
+                    "processed_time": now,
+                    "transaction_id": result.get('transaction_id'),
+                    "gateway_used": gateway_name
+                },
+                "$push": {"status_history": {"status": "completed", "at": now, "by": "withdrawal_queue"}}
+            }
+        )
+        if updated.modified_count:
+            await dashboard_stats.record_withdrawal_status(job['amount'], 'processing', 'completed')
+        
+        await jobs.update_one(
+            {"job_id": job['job_id']},
+            {
+                "$set": {"status": "succeeded", "gateway": gateway_name,
+                         "transaction_id": result.get('transaction_id'), "finished_at": now},
+                "$unset": {"locked_by": "", "locked_at": ""},
+                "$push": {"history": {"status": "succeeded", "at": now, "gateway": gateway_name}}
+            }
+        )
+        logger.info(f"✅ Automatic payout {job['request_id']} completed via {gateway_name}")
+    
+    async def _schedule_retry(self, job: Dict[str, Any], reason: str, gateway_name: str = None):
+        jobs = self.user_model.get_collection('withdrawal_jobs')
+        now = datetime.utcnow()
+        
+        if job.get('attempts', 1) >= self.max_attempts:
+            await self._fail(job, reason)
+            return
+        
+        delay = min(self.max_delay, self.base_delay * (2 ** (job.get('attempts', 1) - 1)))
+        delay *= random.uniform(0.5, 1.5)  # jitter spreads retries after a gateway outage
+        await jobs.update_one(
+            {"job_id": job['job_id']},
+            {
+                "$set": {"status": "retry", "next_attempt_at": now + timedelta(seconds=delay), "last_error": reason},
+                "$unset": {"locked_by": "", "locked_at": ""},
+                "$push": {"history": {"status": "retry", "at": now, "reason": reason, "gateway": gateway_name}}
+            }
+        )
+        logger.warning(f"⚠️ Payout {job['request_id']} attempt {job.get('attempts')} failed ({reason}); retry in {delay:.0f}s")
+    
+    async def _fail(self, job: Dict[str, Any], reason: str):
+        """Give up on automatic payout and hand the request back to admins"""
+        jobs = self.user_model.get_collection('withdrawal_jobs')
+        requests = self.user_model.get_collection('withdrawal_requests')
+        now = datetime.utcnow()
+        
+        if not await self._refund(job):
+            # Keep the request in processing until the money is back; recovery retries the refund
+            await jobs.update_one(
+                {"job_id": job['job_id']},
+                {
+                    "$set": {"status": "refund_pending", "last_error": reason},
+                    "$unset": {"locked_by": "", "locked_at": ""},
+                    "$push": {"history": {"status": "refund_pending", "at": now, "reason": reason}}
+                }
+            )
+            logger.error(f"❌ Refund of failed payout {job['request_id']} did not commit; will retry")
+            return
+        
+        await jobs.update_one(
+            {"job_id": job['job_id']},
+            {
+                "$set": {"status": "failed", "last_error": reason, "finished_at": now},
+                "$unset": {"locked_by": "", "locked_at": ""},
+                "$push": {"history": {"status": "failed", "at": now, "reason": reason}}
+            }
+        )
+        reverted = await requests.update_one(
+            {"request_id": job['request_id'], "status": "processing"},
+            {
+                "$set": {"status": "pending", "admin_notes": f"Automatic payout failed: {reason}"},
+                "$push": {"status_history": {"status": "pending", "at": now, "by": "withdrawal_queue", "reason": reason}}
+            }
+        )
+        if reverted.modified_count:
+            await dashboard_stats.record_withdrawal_status(job['amount'], 'processing', 'pending')
+        logger.error(f"❌ Automatic payout {job['request_id']} failed after {job.get('attempts')} attempts: {reason}")
+    
+    async def _refund(self, job: Dict[str, Any]) -> bool:
+        """Return a job's debit to the wallet (at most once); True once nothing is owed"""
+        debit_key, refund_key = self._ledger_keys(job)
+        try:
+            if await self.user_model.find_ledger_entry(debit_key) is None:
+                return True
+            if await self.user_model.find_ledger_entry(refund_key) is not None:
+                return True
+            await self.user_model.add_to_wallet(
+                job['user_id'],
+                job['amount'],
+                "withdrawal_refund",
+                f"Automatic withdrawal failed: {job['request_id']}",
+                idempotency_key=refund_key,
+                check_eligibility=False
+            )
+            return await self.user_model.find_ledger_entry(refund_key) is not None
+        except Exception as e:
+            logger.error(f"❌ Withdrawal refund error for {job['request_id']}: {e}")
+            return False
+    
+    def status(self) -> Dict[str, Any]:
+        """Worker pool, gateway slot and circuit breaker state"""
+        return {
+            "running": bool(self._tasks),
+            "workers": self.worker_count,
+            "busy_workers": self._busy,
+            "gateways": {
+                name: {
+                    "circuit": self.breakers.get(name, CircuitBreaker()).state,
+                    "free_slots": self.semaphores[name]._value if name in self.semaphores else self.gateway_concurrency
+                }
+                for name in self.payment_manager.gateways
+            }
+        }
+
 # Initialize payment manager
 payment_manager = PaymentManager(user_model)
+withdrawal_queue = WithdrawalJobQueue(payment_manager, user_model)
 
 
 
@@ -2090,6 +5703,7 @@ payment_manager = PaymentManager(user_model)
 
 # ==================== CHANNEL MANAGER ====================
 
+@profiled_queries
 class ChannelManager:
     """Manage force join channels and verification system"""
     
@@ -2314,7 +5928,7 @@ class ChannelManager:
     async def get_channels_statistics(self) -> Dict[str, Any]:
         """Get channel statistics for admin dashboard"""
         try:
-            collection = self.user_model.get_collection('force_join_channels')
+            collection = query_router.collection('force_join_channels', 'analytics')
             if collection is None:
                 return {}
             
@@ -2345,6 +5959,7 @@ class ChannelManager:
 
 # ==================== BUTTON MANAGER ====================
 
+@profiled_queries
 class ButtonManager:
     """Manage dynamic bot buttons and their responses"""
     
@@ -2524,25 +6139,560 @@ class ButtonManager:
 """
                     response['text'] += balance_info
             
-            return response
+            return response
+            
+        except Exception as e:
+            logger.error(f"❌ Error getting button response: {e}")
+            return {
+                "text": "Error loading content. Please try again.",
+                "image_url": "",
+                "requires_channel_join": False
+            }
+
+# ==================== API INTEGRATION MANAGER ====================
+
+@profiled_queries
+class SlidingWindowRateLimiter:
+    """Sliding-window counters: the current fixed window plus the previous one
+    weighted by how much of it still overlaps the sliding window
+    
+    hit() never awaits. Idle keys are dropped by sync() and the number of
+    tracked keys is capped (least recently used first). With a shared backend
+    sync() pushes local hits to rate_limit_counters and pulls the totals of
+    all replicas, so the cluster can overshoot a limit by at most the hits
+    accepted during one sync interval.
+    """
+    
+    def __init__(self, user_model_instance=None, window_seconds: int = 3600,
+                 max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.user_model = user_model_instance  # shared backend when set
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self._windows: OrderedDict = OrderedDict()  # key -> [window index, current count, previous count]
+        self._pending: Dict[tuple, int] = {}  # (key, window index) -> hits not yet pushed
+        self.rejected = 0
+        self.evicted = 0
+    
+    def _window(self, key: str, index: int) -> list:
+        state = self._windows.get(key)
+        if state is None:
+            state = self._windows[key] = [index, 0, 0]
+            if len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+                self.evicted += 1
+            return state
+        self._windows.move_to_end(key)
+        if state[0] != index:
+            state[2] = state[1] if state[0] == index - 1 else 0
+            state[0], state[1] = index, 0
+        return state
+    
+    def hit(self, key: str, limit: int, cost: int = 1) -> bool:
+        """Count cost requests for key; False (and nothing counted) when that would exceed limit"""
+        index, offset = divmod(time.time(), self.window_seconds)
+        index = int(index)
+        state = self._window(key, index)
+        if state[1] + state[2] * (1 - offset / self.window_seconds) + cost > limit:
+            self.rejected += 1
+            return False
+        state[1] += cost
+        if self.user_model is not None:
+            self._pending[(key, index)] = self._pending.get((key, index), 0) + cost
+        return True
+    
+    async def sync(self):
+        """Drop idle windows and, with a shared backend, exchange counts with the other replicas"""
+        current = int(time.time() // self.window_seconds)
+        for key in [key for key, state in self._windows.items() if state[0] < current - 1]:
+            del self._windows[key]
+        
+        if self.user_model is None:
+            return
+        collection = self.user_model.get_collection('rate_limit_counters')
+        if collection is None:
+            return
+        
+        pending, self._pending = self._pending, {}
+        if pending:
+            operations = [
+                UpdateOne(
+                    {"_id": f"{key}:{index}"},
+                    {
+                        "$inc": {"count": hits},
+                        "$setOnInsert": {"expires_at": datetime.utcfromtimestamp((index + 2) * self.window_seconds)}
+                    },
+                    upsert=True
+                )
+                for (key, index), hits in pending.items()
+            ]
+            try:
+                await collection.bulk_write(operations, ordered=False)
+            except Exception:
+                for pending_key, hits in pending.items():
+                    self._pending[pending_key] = self._pending.get(pending_key, 0) + hits
+                raise
+        
+        if not self._windows:
+            return
+        ids = [f"{key}:{index}" for key in self._windows for index in (current, current - 1)]
+        totals = {doc["_id"]: doc["count"] async for doc in collection.find({"_id": {"$in": ids}})}
+        for key, state in self._windows.items():
+            if state[0] != current:
+                state[2] = state[1] if state[0] == current - 1 else 0
+                state[0], state[1] = current, 0
+            # totals include this process's pushed hits; add what arrived since the push
+            unsynced = self._pending.get((key, current), 0)
+            state[1] = max(state[1], totals.get(f"{key}:{current}", 0) + unsynced)
+            state[2] = max(state[2], totals.get(f"{key}:{current - 1}", 0))
+    
+    def status(self) -> Dict[str, Any]:
+        return {
+            "backend": "mongo" if self.user_model is not None else "memory",
+            "tracked_keys": len(self._windows),
+            "max_keys": self.max_keys,
+            "evicted": self.evicted,
+            "rejected": self.rejected,
+            "pending_hits": sum(self._pending.values())
+        }
+
+def api_key_scope(api_key: str) -> str:
+    """Stable per-key namespace for client idempotency keys (the raw key is never stored)"""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+@profiled_queries
+class IdempotencyStore:
+    """Remember the response to each (scope, idempotency key) so retries replay it
+    
+    Records live in the TTL-indexed idempotency_keys collection, with an LRU of
+    completed responses in front so replays skip the database. A key is
+    reserved ("in_progress") before the operation runs; only successful
+    responses are stored and failures release the key so the client can retry.
+    
+    A reservation older than IDEMPOTENCY_LOCK_SECONDS can be taken over, so
+    operations that move money must also be unique on their own (credits
+    carry the key into the transactions ledger).
+    """
+    
+    def __init__(self, user_model_instance, ttl_seconds: int = IDEMPOTENCY_TTL_SECONDS,
+                 cache_size: int = IDEMPOTENCY_CACHE_SIZE):
+        self.user_model = user_model_instance
+        self.ttl_seconds = ttl_seconds
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()  # record id -> (fingerprint, response, expires at monotonic)
+        self.replays = 0
+        self.conflicts = 0
+    
+    @staticmethod
+    def record_id(scope: str, key: str) -> str:
+        return f"{scope}:{hashlib.sha256(str(key).encode()).hexdigest()}"
+    
+    @staticmethod
+    def fingerprint(payload: Dict[str, Any]) -> str:
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+    
+    def _remember(self, record_id: str, fingerprint: str, response: Dict[str, Any]):
+        self._cache[record_id] = (fingerprint, response, time.monotonic() + self.ttl_seconds)
+        self._cache.move_to_end(record_id)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    def _replay(self, stored_fingerprint: str, fingerprint: str, response: Dict[str, Any]) -> Dict[str, Any]:
+        if stored_fingerprint != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency key was already used with different parameters")
+        self.replays += 1
+        return response
+    
+    async def run(self, scope: str, key: Optional[str], payload: Dict[str, Any], operation) -> tuple:
+        """Run operation() at most once per key; returns (response, replayed)
+        
+        payload identifies the request: reusing a key with a different payload
+        is rejected with 422, and a key whose first request is still running
+        gets 409.
+        """
+        if not key:
+            return await operation(), False
+        
+        record_id = self.record_id(scope, key)
+        fingerprint = self.fingerprint(payload)
+        
+        cached = self._cache.get(record_id)
+        if cached is not None and cached[2] > time.monotonic():
+            self._cache.move_to_end(record_id)
+            return self._replay(cached[0], fingerprint, cached[1]), True
+        
+        collection = self.user_model.get_collection('idempotency_keys')
+        if collection is None:
+            raise HTTPException(status_code=503, detail="Idempotency store unavailable")
+        
+        now = datetime.utcnow()
+        try:
+            await collection.insert_one({
+                "_id": record_id,
+                "status": "in_progress",
+                "fingerprint": fingerprint,
+                "locked_at": now,
+                "expires_at": now + timedelta(seconds=self.ttl_seconds)
+            })
+        except DuplicateKeyError:
+            record = await collection.find_one({"_id": record_id})
+            if record and record.get("status") == "completed":
+                self._remember(record_id, record["fingerprint"], record["response"])
+                return self._replay(record["fingerprint"], fingerprint, record["response"]), True
+            
+            # Another request holds the key; take it over only if that request died
+            taken = await collection.find_one_and_update(
+                {
+                    "_id": record_id,
+                    "status": "in_progress",
+                    "locked_at": {"$lt": now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}
+                },
+                {"$set": {"fingerprint": fingerprint, "locked_at": now}}
+            )
+            if taken is None:
+                self.conflicts += 1
+                raise HTTPException(status_code=409, detail="A request with this idempotency key is in progress")
+        
+        try:
+            response = await operation()
+        except Exception:
+            await collection.delete_one({"_id": record_id, "status": "in_progress"})
+            raise
+        
+        if isinstance(response, dict) and response.get("success"):
+            await collection.update_one(
+                {"_id": record_id},
+                {"$set": {"status": "completed", "response": response, "completed_at": datetime.utcnow()}}
+            )
+            self._remember(record_id, fingerprint, response)
+        else:
+            await collection.delete_one({"_id": record_id, "status": "in_progress"})
+        
+        return response, False
+
+def idempotent_response(response: Dict[str, Any], replayed: bool) -> FastJSONResponse:
+    """JSON response flagging replays of a stored idempotent result"""
+    return FastJSONResponse(response, headers={"Idempotent-Replayed": "true"} if replayed else None)
+
+@profiled_queries
+class PartnerWebhookDispatcher:
+    """Push wallet events to partner webhooks in signed batches
+    
+    emit() only appends to an in-memory buffer per API key. flush() sends
+    each partner's events as one or more JSON batches signed with the key's
+    webhook secret:
+    
+        X-Wallet-Signature: sha256=HMAC(secret, "<X-Wallet-Timestamp>." + body)
+    
+    A batch that fails is stored in partner_webhook_deliveries and retried
+    with exponential backoff by any replica; after PARTNER_WEBHOOK_MAX_ATTEMPTS
+    it moves to partner_webhook_dead_letters.
+    
+    Events: "wallet.updated" (any balance change of a user the partner has
+    credited, recorded in partner_users; partners need the user_info
+    permission) and "earnings.credited" (credits made with the partner's own
+    key). wallet.updated events are routed to their partners at flush time,
+    with one partner_users lookup per flush.
+    """
+    
+    EVENT_TYPES = ("wallet.updated", "earnings.credited")
+    SUBSCRIBER_PROJECTION = {"_id": 0, "api_key": 1, "webhook_url": 1, "webhook_secret": 1,
+                             "webhook_events": 1, "permissions": 1}
+    SENDING_LOCK_TIMEOUT = timedelta(minutes=5)
+    
+    def __init__(self, user_model_instance):
+        self.user_model = user_model_instance
+        self.subscribers: Dict[str, Dict[str, Any]] = {}  # api_key -> url, secret, events, permissions
+        self.buffers: Dict[str, list] = {}
+        self.unrouted: list = []  # user events waiting for their partners to be looked up
+        self.pending_links: set = set()  # (api_key, user_id) not yet written to partner_users
+        self.delivered = 0
+        self.failed = 0
+        self.dead_lettered = 0
+        self.dropped = 0
+    
+    @property
+    def http(self) -> GatewayHTTPClient:
+        # partner URLs are absolute, so the shared client has no base URL
+        return gateway_http.client("partner_webhooks", "")
+    
+    async def refresh_subscribers(self):
+        """Reload webhook settings of active API keys"""
+        collection = self.user_model.get_collection('api_keys')
+        if collection is None:
+            return
+        subscribers = {}
+        async for doc in collection.find(
+            {"is_active": True, "webhook_url": {"$nin": [None, ""]}}, self.SUBSCRIBER_PROJECTION
+        ):
+            subscribers[doc["api_key"]] = {
+                "url": doc["webhook_url"],
+                "secret": doc.get("webhook_secret", ""),
+                "events": set(doc.get("webhook_events") or self.EVENT_TYPES),
+                "permissions": set(doc.get("permissions") or [])
+            }
+        self.subscribers = subscribers
+    
+    def _user_event_subscribers(self, event_type: str) -> List[str]:
+        return [
+            key for key, subscriber in self.subscribers.items()
+            if event_type in subscriber["events"] and "user_info" in subscriber["permissions"]
+        ]
+    
+    def _append(self, buffer: list, event: Dict[str, Any]):
+        buffer.append(event)
+        if len(buffer) > PARTNER_WEBHOOK_MAX_BUFFER:
+            del buffer[0]
+            self.dropped += 1
+    
+    def link_user(self, api_key: str, user_id: int):
+        """Remember that a partner credited a user, so it receives that user's wallet events (no I/O)"""
+        self.pending_links.add((api_key, user_id))
+    
+    def emit(self, event_type: str, data: Dict[str, Any], api_key: Optional[str] = None):
+        """Queue an event (no I/O); api_key targets a single partner, otherwise the
+        event goes to the partners linked to data["user_id"]"""
+        if not self.subscribers:
+            return
+        
+        event = {
+            "id": uuid.uuid4().hex,
+            "type": event_type,
+            "occurred_at": datetime.utcnow().isoformat() + "Z",
+            "data": data
+        }
+        if api_key is not None:
+            subscriber = self.subscribers.get(api_key)
+            if subscriber and event_type in subscriber["events"]:
+                self._append(self.buffers.setdefault(api_key, []), event)
+        elif self._user_event_subscribers(event_type):
+            self._append(self.unrouted, event)
+    
+    @staticmethod
+    def sign(secret: str, timestamp: str, body: bytes) -> str:
+        return hmac.new(secret.encode(), timestamp.encode() + b"." + body, hashlib.sha256).hexdigest()
+    
+    async def _post(self, url: str, secret: str, delivery_id: str, events: list) -> Optional[str]:
+        """Send one signed batch; returns None on success, else the error"""
+        body = dump_json({"delivery_id": delivery_id, "sent_at": datetime.utcnow().isoformat() + "Z", "events": events})
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            "X-Wallet-Delivery": delivery_id,
+            "X-Wallet-Timestamp": timestamp,
+            "X-Wallet-Signature": f"sha256={self.sign(secret, timestamp, body)}"
+        }
+        try:
+            status = await self.http.post_body(url, body, headers, timeout=PARTNER_WEBHOOK_TIMEOUT_SECONDS)
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+        return None if 200 <= status < 300 else f"HTTP {status}"
+    
+    async def _deliver_partner(self, api_key: str, events: list):
+        subscriber = self.subscribers.get(api_key)
+        if subscriber is None:
+            return
+        batches = [
+            events[start:start + PARTNER_WEBHOOK_BATCH_MAX_EVENTS]
+            for start in range(0, len(events), PARTNER_WEBHOOK_BATCH_MAX_EVENTS)
+        ]
+        for position, batch in enumerate(batches):
+            delivery_id = uuid.uuid4().hex
+            error = await self._post(subscriber["url"], subscriber["secret"], delivery_id, batch)
+            if error is None:
+                self.delivered += len(batch)
+                continue
+            # Partner is failing: queue this and the remaining batches for retry without sending
+            self.failed += 1
+            try:
+                await self._schedule_retry(api_key, [(delivery_id, batch)] + [
+                    (uuid.uuid4().hex, later) for later in batches[position + 1:]
+                ], error)
+                logger.warning(f"⚠️ Partner webhook delivery failed ({error}); queued for retry")
+            except Exception as e:
+                # Keep the events in memory for the next flush rather than losing them
+                logger.error(f"❌ Partner webhook retry queue error ({e}); events kept in buffer")
+                buffer = self.buffers.setdefault(api_key, [])
+                for event in [event for later in batches[position:] for event in later]:
+                    self._append(buffer, event)
+            return
+    
+    async def _schedule_retry(self, api_key: str, batches: list, error: str):
+        collection = self.user_model.get_collection('partner_webhook_deliveries')
+        if collection is None:
+            return
+        now = datetime.utcnow()
+        await collection.insert_many([
+            {
+                "delivery_id": delivery_id,
+                "api_key": api_key,
+                "events": batch,
+                "status": "retry",
+                "attempts": 1,
+                "last_error": error,
+                "created_at": now,
+                "next_attempt_at": now + self._backoff(1)
+            }
+            for delivery_id, batch in batches
+        ], ordered=False)
+    
+    @staticmethod
+    def _backoff(attempts: int) -> timedelta:
+        return timedelta(seconds=min(30 * 2 ** (attempts - 1), 3600) * random.uniform(0.8, 1.2))
+    
+    async def _write_links(self):
+        collection = self.user_model.get_collection('partner_users')
+        if collection is None or not self.pending_links:
+            return
+        links, self.pending_links = self.pending_links, set()
+        now = datetime.utcnow()
+        try:
+            await collection.bulk_write([
+                UpdateOne({"user_id": user_id, "api_key": api_key}, {"$setOnInsert": {"linked_at": now}}, upsert=True)
+                for api_key, user_id in links
+            ], ordered=False)
+        except BulkWriteError as e:
+            # Duplicate key: another replica inserted the same link concurrently
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                self.pending_links |= links
+                raise
+        except Exception:
+            self.pending_links |= links
+            raise
+    
+    async def _route_user_events(self):
+        """Buffer unrouted user events for the partners linked to each user"""
+        collection = self.user_model.get_collection('partner_users')
+        if collection is None or not self.unrouted:
+            return
+        events, self.unrouted = self.unrouted, []
+        audience: Dict[int, List[str]] = {}
+        try:
+            subscribed = list({key for event in events for key in self._user_event_subscribers(event["type"])})
+            async for link in collection.find(
+                {"user_id": {"$in": list({event["data"]["user_id"] for event in events})}, "api_key": {"$in": subscribed}},
+                {"_id": 0, "user_id": 1, "api_key": 1}
+            ):
+                audience.setdefault(link["user_id"], []).append(link["api_key"])
+        except Exception:
+            self.unrouted = events + self.unrouted
+            raise
+        
+        for event in events:
+            for api_key in audience.get(event["data"]["user_id"], []):
+                if event["type"] in self.subscribers.get(api_key, {}).get("events", ()):
+                    self._append(self.buffers.setdefault(api_key, []), event)
+    
+    async def flush(self):
+        """Send everything buffered so far, partners in parallel"""
+        try:
+            await self._write_links()
+            await self._route_user_events()
+        except Exception as e:
+            logger.error(f"❌ Partner webhook routing error (retried next flush): {e}")
+        if not self.buffers:
+            return
+        buffers, self.buffers = self.buffers, {}
+        for events in buffers.values():
+            events.sort(key=lambda event: event["occurred_at"])
+        await asyncio.gather(*(
+            self._deliver_partner(api_key, events) for api_key, events in buffers.items()
+        ), return_exceptions=True)
+    
+    async def retry_failed(self, limit: int = 50):
+        """Redeliver due batches (claimed atomically, so every replica can run this)"""
+        collection = self.user_model.get_collection('partner_webhook_deliveries')
+        if collection is None:
+            return
+        
+        for _ in range(limit):
+            now = datetime.utcnow()
+            delivery = await collection.find_one_and_update(
+                {"$or": [
+                    {"status": "retry", "next_attempt_at": {"$lte": now}},
+                    {"status": "sending", "locked_at": {"$lt": now - self.SENDING_LOCK_TIMEOUT}}
+                ]},
+                {"$set": {"status": "sending", "locked_at": now}},
+                sort=[("next_attempt_at", 1)],
+                return_document=True
+            )
+            if delivery is None:
+                return
+            
+            subscriber = self.subscribers.get(delivery["api_key"])
+            error = "Webhook no longer configured" if subscriber is None else await self._post(
+                subscriber["url"], subscriber["secret"], delivery["delivery_id"], delivery["events"]
+            )
             
-        except Exception as e:
-            logger.error(f"❌ Error getting button response: {e}")
-            return {
-                "text": "Error loading content. Please try again.",
-                "image_url": "",
-                "requires_channel_join": False
-            }
-
-# ==================== API INTEGRATION MANAGER ====================
+            if error is None:
+                self.delivered += len(delivery["events"])
+                await collection.delete_one({"_id": delivery["_id"]})
+            elif subscriber is None or delivery["attempts"] >= PARTNER_WEBHOOK_MAX_ATTEMPTS:
+                await self._dead_letter(collection, delivery, error)
+            else:
+                await collection.update_one(
+                    {"_id": delivery["_id"]},
+                    {
+                        "$set": {
+                            "status": "retry",
+                            "last_error": error,
+                            "next_attempt_at": now + self._backoff(delivery["attempts"] + 1)
+                        },
+                        "$inc": {"attempts": 1},
+                        "$unset": {"locked_at": ""}
+                    }
+                )
+    
+    async def _dead_letter(self, collection, delivery: Dict[str, Any], error: str):
+        dead_letters = self.user_model.get_collection('partner_webhook_dead_letters')
+        if dead_letters is None:
+            return
+        delivery.pop("_id")
+        delivery.pop("locked_at", None)
+        await dead_letters.insert_one({
+            **delivery, "status": "dead", "last_error": error, "failed_at": datetime.utcnow()
+        })
+        await collection.delete_one({"delivery_id": delivery["delivery_id"]})
+        self.dead_lettered += 1
+        logger.error(f"❌ Partner webhook delivery {delivery['delivery_id']} dead-lettered: {error}")
+    
+    async def replay_dead_letter(self, delivery_id: str) -> bool:
+        """Move a dead-lettered batch back to the retry queue"""
+        dead_letters = self.user_model.get_collection('partner_webhook_dead_letters')
+        deliveries = self.user_model.get_collection('partner_webhook_deliveries')
+        if dead_letters is None or deliveries is None:
+            return False
+        delivery = await dead_letters.find_one_and_delete({"delivery_id": delivery_id}, projection={"_id": 0})
+        if delivery is None:
+            return False
+        delivery.update({"status": "retry", "attempts": 0, "next_attempt_at": datetime.utcnow()})
+        delivery.pop("failed_at", None)
+        await deliveries.insert_one(delivery)
+        return True
+    
+    def status(self) -> Dict[str, Any]:
+        return {
+            "subscribers": len(self.subscribers),
+            "buffered_events": sum(len(events) for events in self.buffers.values()) + len(self.unrouted),
+            "delivered_events": self.delivered,
+            "failed_batches": self.failed,
+            "dead_lettered_batches": self.dead_lettered,
+            "dropped_events": self.dropped
+        }
 
+@profiled_queries
 class APIIntegrationManager:
     """Manage external API integrations for third-party projects"""
     
+    API_KEY_PROJECTION = {"_id": 0, "permissions": 1, "project_name": 1, "rate_limit_per_hour": 1}
+    API_KEY_CACHE_MAX_ENTRIES = 10000
+    
     def __init__(self, user_model_instance):
         self.user_model = user_model_instance
-        self.api_keys = {}
-        self.rate_limits = {}
+        self.api_keys: OrderedDict = OrderedDict()  # api_key -> (document or None, expires at monotonic)
+        self.rate_limiter = SlidingWindowRateLimiter(
+            user_model_instance if RATE_LIMIT_BACKEND == "mongo" else None
+        )
+        self.pending_usage: Dict[str, list] = {}  # api_key -> [uses, last used]
     
     async def generate_api_key(self, project_name: str, permissions: List[str] = None) -> Dict[str, Any]:
         """Generate new API key for external integration"""
@@ -2563,6 +6713,7 @@ class APIIntegrationManager:
             collection = self.user_model.get_collection('api_keys')
             if collection is not None:
                 await collection.insert_one(api_doc)
+                self.invalidate_api_key(api_key)
             
             logger.info(f"🔑 API key generated for project: {project_name}")
             return {"success": True, "api_key": api_key}
@@ -2571,35 +6722,52 @@ class APIIntegrationManager:
             logger.error(f"❌ Error generating API key: {e}")
             return {"success": False, "message": "Technical error occurred"}
     
-    async def validate_api_key(self, api_key: str) -> Dict[str, Any]:
-        """Validate API key and return permissions"""
+    def invalidate_api_key(self, api_key: str):
+        """Forget a cached key document (other replicas refresh within API_KEY_CACHE_SECONDS)"""
+        self.api_keys.pop(api_key, None)
+    
+    def _cache_api_key(self, api_key: str, api_doc: Optional[Dict[str, Any]]):
+        # unknown keys are cached briefly so guessing cannot hammer the database
+        ttl = API_KEY_CACHE_SECONDS if api_doc else min(API_KEY_CACHE_SECONDS, 10)
+        self.api_keys[api_key] = (api_doc, time.monotonic() + ttl)
+        self.api_keys.move_to_end(api_key)
+        if len(self.api_keys) > self.API_KEY_CACHE_MAX_ENTRIES:
+            self.api_keys.popitem(last=False)
+    
+    async def validate_api_key(self, api_key: str, cost: int = 1) -> Dict[str, Any]:
+        """Validate API key and return permissions
+        
+        Cached key, in-memory rate limit and buffered usage: no database round
+        trip unless the key document is not cached. cost is the number of
+        operations charged against the hourly limit (batch size).
+        """
         try:
-            collection = self.user_model.get_collection('api_keys')
-            if collection is None:
-                return {"valid": False, "message": "Service unavailable"}
-            
-            api_doc = await collection.find_one({"api_key": api_key, "is_active": True})
+            cached = self.api_keys.get(api_key)
+            if cached is not None and cached[1] > time.monotonic():
+                api_doc = cached[0]
+            else:
+                collection = self.user_model.get_collection('api_keys')
+                if collection is None:
+                    return {"valid": False, "message": "Service unavailable"}
+                api_doc = await collection.find_one(
+                    {"api_key": api_key, "is_active": True}, self.API_KEY_PROJECTION
+                )
+                self._cache_api_key(api_key, api_doc)
             
             if not api_doc:
                 return {"valid": False, "message": "Invalid API key"}
             
             # Check rate limit
-            current_hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
-            usage_key = f"{api_key}_{current_hour.isoformat()}"
-            
-            current_usage = self.rate_limits.get(usage_key, 0)
-            if current_usage >= api_doc.get('rate_limit_per_hour', 1000):
+            if not self.rate_limiter.hit(api_key, api_doc.get('rate_limit_per_hour', 1000), cost):
                 return {"valid": False, "message": "Rate limit exceeded"}
             
-            # Update usage
-            self.rate_limits[usage_key] = current_usage + 1
-            await collection.update_one(
-                {"api_key": api_key},
-                {
-                    "$inc": {"usage_count": 1},
-                    "$set": {"last_used": datetime.utcnow()}
-                }
-            )
+            # Record usage (written by flush_usage)
+            usage = self.pending_usage.get(api_key)
+            if usage is None:
+                self.pending_usage[api_key] = [cost, datetime.utcnow()]
+            else:
+                usage[0] += cost
+                usage[1] = datetime.utcnow()
             
             return {
                 "valid": True,
@@ -2611,8 +6779,36 @@ class APIIntegrationManager:
             logger.error(f"❌ Error validating API key: {e}")
             return {"valid": False, "message": "Validation error"}
     
-    async def add_earnings_via_api(self, api_key: str, user_id: int, amount: float, description: str) -> Dict[str, Any]:
-        """Add earnings to user wallet via API"""
+    async def flush_usage(self):
+        """Write buffered usage_count / last_used updates in one bulk write"""
+        if not self.pending_usage:
+            return
+        collection = self.user_model.get_collection('api_keys', 'relaxed')
+        if collection is None:
+            return
+        
+        pending, self.pending_usage = self.pending_usage, {}
+        operations = [
+            UpdateOne({"api_key": api_key}, {"$inc": {"usage_count": uses}, "$max": {"last_used": last_used}})
+            for api_key, (uses, last_used) in pending.items()
+        ]
+        try:
+            await collection.bulk_write(operations, ordered=False)
+        except Exception:
+            for api_key, (uses, last_used) in pending.items():
+                usage = self.pending_usage.setdefault(api_key, [0, last_used])
+                usage[0] += uses
+                usage[1] = max(usage[1], last_used)
+            raise
+    
+    async def add_earnings_via_api(self, api_key: str, user_id: int, amount: float, description: str,
+                                   ledger_key: Optional[str] = None) -> Dict[str, Any]:
+        """Add earnings to user wallet via API
+        
+        ledger_key (the scoped client idempotency key) is stored on the
+        transaction row, whose unique index makes the credit happen at most
+        once even if the idempotency reservation was taken over.
+        """
         try:
             # Validate API key
             validation = await self.validate_api_key(api_key)
@@ -2626,14 +6822,30 @@ class APIIntegrationManager:
             if not await self.user_model.is_user_verified(user_id):
                 return {"success": False, "message": "User not verified"}
             
+            if ledger_key:
+                credited = await self._ledger_credit(ledger_key)
+                if credited is not None:
+                    return credited
+            
             # Add to wallet
             success = await self.user_model.add_to_wallet(
                 user_id, amount, "api_integration", 
-                f"API: {description} (Project: {validation['project_name']})"
+                f"API: {description} (Project: {validation['project_name']})",
+                idempotency_key=ledger_key
             )
             
+            if not success and ledger_key:
+                # A concurrent request with the same key may have committed first
+                credited = await self._ledger_credit(ledger_key)
+                if credited is not None:
+                    return credited
+            
             if success:
                 logger.info(f"💰 API earnings added: User {user_id}, Amount Rs.{amount} via {validation['project_name']}")
+                partner_webhooks.link_user(api_key, user_id)
+                partner_webhooks.emit("earnings.credited", {
+                    "user_id": user_id, "amount": amount, "description": description
+                }, api_key=api_key)
                 return {
                     "success": True,
                     "message": f"Rs.{amount} added to user wallet",
@@ -2645,11 +6857,118 @@ class APIIntegrationManager:
         except Exception as e:
             logger.error(f"❌ API earnings error: {e}")
             return {"success": False, "message": "Technical error occurred"}
+    
+    async def _ledger_credit(self, ledger_key: str) -> Optional[Dict[str, Any]]:
+        """Response for a credit already in the ledger under ledger_key, else None"""
+        transaction = await self.user_model.find_ledger_entry(ledger_key)
+        if transaction is None:
+            return None
+        return {
+            "success": True,
+            "message": f"Rs.{transaction['amount']} already added to user wallet",
+            "duplicate": True,
+            "transaction_id": transaction['transaction_id'],
+            "new_balance": await self.user_model.get_wallet_balance(transaction['user_id'])
+        }
+    
+    async def add_earnings_batch_via_api(self, api_key: str, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Credit a batch of earnings: one key validation, one verification
+        lookup, one transaction insert_many and one balance bulk_write
+        
+        Returns per-item results in request order. Item idempotency keys are
+        scoped to the API key; a replayed key is reported as "duplicate" and
+        not credited again.
+        """
+        try:
+            validation = await self.validate_api_key(api_key, cost=len(items))
+            if not validation["valid"]:
+                return {"success": False, "message": validation["message"]}
+            
+            if "wallet_add" not in validation.get("permissions", []):
+                return {"success": False, "message": "Insufficient API permissions"}
+            
+            project_name = validation['project_name']
+            key_scope = api_key_scope(api_key)
+            results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+            credits, positions, seen_keys = [], [], set()
+            
+            for index, item in enumerate(items):
+                try:
+                    user_id = int(item['user_id'])
+                    amount = round(float(item['amount']), 2)
+                except (KeyError, TypeError, ValueError):
+                    results[index] = {"index": index, "status": "rejected", "message": "Invalid user_id or amount"}
+                    continue
+                if amount <= 0:
+                    results[index] = {"index": index, "user_id": user_id, "status": "rejected", "message": "Amount must be positive"}
+                    continue
+                
+                idempotency_key = item.get('idempotency_key')
+                if idempotency_key:
+                    idempotency_key = str(idempotency_key)
+                    if idempotency_key in seen_keys:
+                        results[index] = {"index": index, "user_id": user_id, "status": "duplicate", "message": "Repeated in batch"}
+                        continue
+                    seen_keys.add(idempotency_key)
+                
+                credits.append({
+                    'user_id': user_id,
+                    'amount': amount,
+                    'description': f"API: {item.get('description') or 'External project earnings'} (Project: {project_name})",
+                    'idempotency_key': f"{key_scope}:{idempotency_key}" if idempotency_key else None
+                })
+                positions.append(index)
+            
+            verified = await self.user_model.verified_user_ids([credit['user_id'] for credit in credits])
+            accepted, accepted_positions = [], []
+            for credit, index in zip(credits, positions):
+                if credit['user_id'] in verified:
+                    accepted.append(credit)
+                    accepted_positions.append(index)
+                else:
+                    results[index] = {"index": index, "user_id": credit['user_id'], "status": "rejected", "message": "User not verified"}
+            
+            outcomes = await self.user_model.add_to_wallets_bulk(accepted, "api_integration") if accepted else []
+            for credit, index, outcome in zip(accepted, accepted_positions, outcomes):
+                results[index] = {
+                    "index": index,
+                    "user_id": credit['user_id'],
+                    "amount": credit['amount'],
+                    **outcome
+                }
+                if outcome["status"] == "credited":
+                    partner_webhooks.link_user(api_key, credit['user_id'])
+                    partner_webhooks.emit("earnings.credited", {
+                        "user_id": credit['user_id'],
+                        "amount": credit['amount'],
+                        "transaction_id": outcome["transaction_id"],
+                        "idempotency_key": items[index].get('idempotency_key')
+                    }, api_key=api_key)
+            
+            summary = {status: 0 for status in ("credited", "duplicate", "rejected")}
+            for result in results:
+                summary[result["status"]] += 1
+            
+            logger.info(f"💰 API batch earnings via {project_name}: {summary}")
+            return {"success": True, "summary": summary, "results": results}
+            
+        except Exception as e:
+            logger.error(f"❌ API batch earnings error: {e}")
+            return {"success": False, "message": "Technical error occurred"}
 
 # Initialize managers
 channel_manager = ChannelManager(user_model)
 button_manager = ButtonManager(user_model)
 api_integration_manager = APIIntegrationManager(user_model)
+idempotency_store = IdempotencyStore(user_model)
+partner_webhooks = PartnerWebhookDispatcher(user_model)
+periodic_tasks.append(PeriodicTask("partner_webhook_subscribers", partner_webhooks.refresh_subscribers, 60))
+periodic_tasks.append(PeriodicTask("partner_webhook_flush", partner_webhooks.flush, PARTNER_WEBHOOK_BATCH_SECONDS))
+periodic_tasks.append(PeriodicTask("partner_webhook_retry", partner_webhooks.retry_failed, 15, initial_delay=15))
+periodic_tasks.append(PeriodicTask("api_usage_flush", api_integration_manager.flush_usage, API_USAGE_FLUSH_SECONDS))
+periodic_tasks.append(PeriodicTask(
+    "rate_limit_sync", api_integration_manager.rate_limiter.sync, RATE_LIMIT_SYNC_SECONDS
+))
 
 
 
@@ -2667,6 +6986,7 @@ api_integration_manager = APIIntegrationManager(user_model)
 
 # ==================== MAIN TELEGRAM BOT CLASS ====================
 
+@profiled_queries
 class EnterpriseWalletBot:
     """Complete Telegram bot implementation with all features"""
     
@@ -2683,8 +7003,10 @@ class EnterpriseWalletBot:
                 logger.error("❌ BOT_TOKEN not configured")
                 return False
                 
-            self.bot = Bot(token=BOT_TOKEN)
-            self.application = ApplicationBuilder().token(BOT_TOKEN).build()
+            self.bot = Bot(token=BOT_TOKEN, request=TelegramMetricsRequest())
+            self.application = ApplicationBuilder().token(BOT_TOKEN).request(
+                TelegramMetricsRequest(connection_pool_size=256)
+            ).build()
             self.setup_handlers()
             self.initialized = True
             logger.info("✅ Enterprise Wallet Bot initialized successfully")
@@ -2698,26 +7020,33 @@ class EnterpriseWalletBot:
     def setup_handlers(self):
         """Setup all command and message handlers"""
         try:
-            # Command handlers
-            self.application.add_handler(CommandHandler("start", self.start_command))
-            self.application.add_handler(CommandHandler("wallet", self.wallet_command))
-            self.application.add_handler(CommandHandler("balance", self.balance_command))
-            self.application.add_handler(CommandHandler("referral", self.referral_command))
-            self.application.add_handler(CommandHandler("campaigns", self.campaigns_command))
-            self.application.add_handler(CommandHandler("withdraw", self.withdraw_command))
-            self.application.add_handler(CommandHandler("redeem", self.redeem_gift_code_command))
-            self.application.add_handler(CommandHandler("help", self.help_command))
-            self.application.add_handler(CommandHandler("status", self.status_command))
-            self.application.add_handler(CommandHandler("admin", self.admin_command))
-            self.application.add_handler(CommandHandler("device_verified", self.device_verified_callback))
-            
-            # Callback query handlers
+            # Command handlers (timed_handler records per-handler latency)
+            commands = {
+                "start": self.start_command,
+                "wallet": self.wallet_command,
+                "balance": self.balance_command,
+                "referral": self.referral_command,
+                "campaigns": self.campaigns_command,
+                "withdraw": self.withdraw_command,
+                "redeem": self.redeem_gift_code_command,
+                "help": self.help_command,
+                "status": self.status_command,
+                "admin": self.admin_command,
+                "device_verified": self.device_verified_callback
+            }
+            for command, callback in commands.items():
+                self.application.add_handler(CommandHandler(command, timed_handler(callback.__name__, callback)))
+            
+            # Callback query handlers (timed per prefix inside the router)
             self.application.add_handler(CallbackQueryHandler(self.button_callback_handler))
             
             # Message handlers
-            self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.text_message_handler))
-            self.application.add_handler(MessageHandler(filters.PHOTO, self.photo_message_handler))
-            self.application.add_handler(MessageHandler(filters.Document.IMAGE, self.photo_message_handler))
+            self.application.add_handler(MessageHandler(
+                filters.TEXT & ~filters.COMMAND, timed_handler("text_message_handler", self.text_message_handler)))
+            self.application.add_handler(MessageHandler(
+                filters.PHOTO, timed_handler("photo_message_handler", self.photo_message_handler)))
+            self.application.add_handler(MessageHandler(
+                filters.Document.IMAGE, timed_handler("photo_message_handler", self.photo_message_handler)))
             
             # Error handler
             self.application.add_error_handler(self.error_handler)
@@ -3684,12 +8013,19 @@ wallet_bot = EnterpriseWalletBot()
 
 # ==================== CALLBACK QUERY HANDLERS ====================
 
+@profiled_queries
 class CallbackQueryHandler:
     """Handle all inline button callbacks and interactive features"""
     
+    # Interaction states live in shared_state so any worker can serve the next update
+    USER_STATE_TTL_SECONDS = 900
+    
     def __init__(self, bot_instance):
         self.bot = bot_instance
-        self.user_states = {}  # Store user interaction states
+    
+    @staticmethod
+    def user_state_key(user_id: int) -> str:
+        return f"user_state:{user_id}"
     
     async def handle_callback_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Main callback query router"""
@@ -3700,7 +8036,7 @@ class CallbackQueryHandler:
             user_id = update.effective_user.id
             callback_data = query.data
             
-            logger.info(f"🔘 Callback received: {callback_data} from user {user_id}")
+            callback_logger.info("🔘 Callback received: %s from user %s", callback_data, user_id)
             
             # Verify user before processing any callbacks
             if not await user_model.is_user_verified(user_id) and not callback_data.startswith('verify_'):
@@ -3711,27 +8047,32 @@ class CallbackQueryHandler:
                 )
                 return
             
-            # Route callbacks based on prefix
-            if callback_data.startswith('wallet'):
-                await self.handle_wallet_callbacks(update, context, callback_data)
-            elif callback_data.startswith('campaign'):
-                await self.handle_campaign_callbacks(update, context, callback_data)
-            elif callback_data.startswith('withdraw'):
-                await self.handle_withdrawal_callbacks(update, context, callback_data)
-            elif callback_data.startswith('referral'):
-                await self.handle_referral_callbacks(update, context, callback_data)
-            elif callback_data.startswith('admin'):
-                await self.handle_admin_callbacks(update, context, callback_data)
-            elif callback_data.startswith('gift'):
-                await self.handle_gift_code_callbacks(update, context, callback_data)
-            elif callback_data.startswith('channel'):
-                await self.handle_channel_callbacks(update, context, callback_data)
-            elif callback_data.startswith('verify_'):
-                await self.handle_verification_callbacks(update, context, callback_data)
-            elif callback_data.startswith('screenshot'):
-                await self.handle_screenshot_callbacks(update, context, callback_data)
-            else:
-                await self.handle_general_callbacks(update, context, callback_data)
+            # Route callbacks based on prefix (latency recorded per prefix)
+            route_timer = CALLBACK_ROUTE_SECONDS[callback_route(callback_data)]
+            started = time.perf_counter()
+            try:
+                if callback_data.startswith('wallet'):
+                    await self.handle_wallet_callbacks(update, context, callback_data)
+                elif callback_data.startswith('campaign'):
+                    await self.handle_campaign_callbacks(update, context, callback_data)
+                elif callback_data.startswith('withdraw'):
+                    await self.handle_withdrawal_callbacks(update, context, callback_data)
+                elif callback_data.startswith('referral'):
+                    await self.handle_referral_callbacks(update, context, callback_data)
+                elif callback_data.startswith('admin'):
+                    await self.handle_admin_callbacks(update, context, callback_data)
+                elif callback_data.startswith('gift'):
+                    await self.handle_gift_code_callbacks(update, context, callback_data)
+                elif callback_data.startswith('channel'):
+                    await self.handle_channel_callbacks(update, context, callback_data)
+                elif callback_data.startswith('verify_'):
+                    await self.handle_verification_callbacks(update, context, callback_data)
+                elif callback_data.startswith('screenshot'):
+                    await self.handle_screenshot_callbacks(update, context, callback_data)
+                else:
+                    await self.handle_general_callbacks(update, context, callback_data)
+            finally:
+                route_timer.observe(time.perf_counter() - started)
                 
         except Exception as e:
             logger.error(f"❌ Callback query handler error: {e}")
@@ -3778,14 +8119,11 @@ class CallbackQueryHandler:
     async def show_transaction_history(self, update: Update, user_id: int):
         """Show user transaction history"""
         try:
-            collection = user_model.get_collection('transactions')
-            if collection is None:
+            if user_model.get_collection('transactions') is None:
                 await update.callback_query.answer("Transaction history not available")
                 return
             
-            transactions = await collection.find({
-                "user_id": user_id
-            }).sort("timestamp", -1).limit(10).to_list(10)
+            transactions = await transaction_archive.get_user_transactions(user_id, limit=10)
             
             if not transactions:
                 history_msg = f"""📊 **Transaction History**
@@ -3927,11 +8265,11 @@ class CallbackQueryHandler:
                 return
             
             # Store user state for campaign
-            self.user_states[user_id] = {
+            await shared_state.set(self.user_state_key(user_id), {
                 'action': 'campaign_participation',
                 'campaign_id': campaign_id,
                 'started_at': datetime.utcnow()
-            }
+            }, self.USER_STATE_TTL_SECONDS)
             
             start_msg = f"""🚀 **Campaign Started: {campaign['name']}**
 
@@ -3977,12 +8315,12 @@ class CallbackQueryHandler:
             query = update.callback_query
             user_id = update.effective_user.id
             
-            # Update user state
-            self.user_states[user_id] = {
+            # Update user state (expires after 15 minutes)
+            await shared_state.set(self.user_state_key(user_id), {
                 'action': 'awaiting_screenshot',
                 'campaign_id': campaign_id,
                 'prompted_at': datetime.utcnow()
-            }
+            }, self.USER_STATE_TTL_SECONDS)
             
             upload_msg = f"""📷 **Screenshot Upload Required**
 
@@ -4008,19 +8346,9 @@ class CallbackQueryHandler:
             
             await safe_edit_message(query, upload_msg, reply_markup=reply_markup, parse_mode="Markdown")
             
-            # Set timeout for screenshot upload (15 minutes)
-            asyncio.create_task(self.clear_user_state_after_timeout(user_id, 900))  # 15 minutes
-            
         except Exception as e:
             logger.error(f"❌ Screenshot prompt error: {e}")
     
-    async def clear_user_state_after_timeout(self, user_id: int, timeout_seconds: int):
-        """Clear user state after timeout"""
-        await asyncio.sleep(timeout_seconds)
-        if user_id in self.user_states:
-            del self.user_states[user_id]
-            logger.info(f"🕐 Cleared user state for {user_id} after timeout")
-    
     # ==================== WITHDRAWAL CALLBACKS ====================
     
     async def handle_withdrawal_callbacks(self, update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
@@ -4483,8 +8811,8 @@ async def enhanced_photo_handler(update: Update, context: ContextTypes.DEFAULT_T
             return
         
         # Check if user has an active campaign submission state
-        callback_handler = CallbackQueryHandler(wallet_bot)
-        user_state = callback_handler.user_states.get(user_id)
+        state_key = CallbackQueryHandler.user_state_key(user_id)
+        user_state = await shared_state.get(state_key)
         
         if user_state and user_state.get('action') == 'awaiting_screenshot':
             campaign_id = user_state.get('campaign_id')
@@ -4521,8 +8849,7 @@ Thank you for your submission! 🌟"""
                 await update.message.reply_text(success_msg, parse_mode="Markdown")
                 
                 # Clear user state
-                if user_id in callback_handler.user_states:
-                    del callback_handler.user_states[user_id]
+                await shared_state.delete(state_key)
                     
             else:
                 error_msg = f"""❌ **Screenshot Submission Failed**
@@ -4587,80 +8914,277 @@ if wallet_bot.initialized:
 
 @app.get("/api/admin/dashboard")
 async def get_admin_dashboard(username: str = Depends(authenticate_admin)):
-    """Get admin dashboard statistics"""
+    """Get admin dashboard statistics (one read of the materialized counters)"""
     try:
-        # User statistics
-        users_collection = user_model.get_collection('users')
-        total_users = await users_collection.count_documents({}) if users_collection is not None else 0
-        # total_users = await users_collection.count_documents({}) if users_collection else 0
-        verified_users = await users_collection.count_documents({"device_verified": True}) if users_collection is not None else 0
-        banned_users = await users_collection.count_documents({"is_banned": True}) if users_collection is not None else 0
-        
-        # Wallet statistics  
-        wallet_stats = await users_collection.aggregate([
-            {"$group": {
-                "_id": None,
-                "total_balance": {"$sum": "$wallet_balance"},
-                "total_earned": {"$sum": "$total_earned"},
-                "total_withdrawals": {"$sum": "$withdrawal_total"}
-            }}
-        ]).to_list(1) if users_collection is not None else []
-        
-        wallet_data = wallet_stats[0] if wallet_stats else {
-            "total_balance": 0, "total_earned": 0, "total_withdrawals": 0
+        stats = await dashboard_stats.get_stats()
+        users_stats = stats.get("users", {})
+        wallet_data = stats.get("wallet", {})
+        campaign_stats = stats.get("campaigns", {})
+        
+        withdrawal_stats = {
+            status: stats.get("withdrawals", {}).get(status, {"count": 0, "amount": 0.0})
+            for status in DashboardStatsManager.WITHDRAWAL_STATUSES
+        }
+        withdrawal_stats["total"] = {
+            "count": sum(bucket["count"] for bucket in withdrawal_stats.values()),
+            "amount": sum(bucket["amount"] for bucket in withdrawal_stats.values())
         }
-        
-        # Campaign statistics
-        campaigns_collection = user_model.get_collection('campaigns')
-        active_campaigns = await campaigns_collection.count_documents({"status": "active"}) if campaigns_collection is not None else 0
-        total_campaigns = await campaigns_collection.count_documents({}) if campaigns_collection is not None else 0
-        
-        # Screenshot statistics
-        screenshots_collection = user_model.get_collection('screenshots')
-        pending_screenshots = await screenshots_collection.count_documents({"status": "pending"}) if screenshots_collection is not None else 0
-        
-        # Withdrawal statistics
-        withdrawal_stats = await payment_manager.get_withdrawal_statistics()
-        
-        # Recent activity (last 7 days)
-        week_ago = datetime.utcnow() - timedelta(days=7)
-        recent_users = await users_collection.count_documents({
-            "created_at": {"$gte": week_ago}
-        }) if users_collection is not None else 0
         
         dashboard_data = {
             "overview": {
-                "total_users": total_users,
-                "verified_users": verified_users,
-                "banned_users": banned_users,
-                "recent_users": recent_users,
-                "active_campaigns": active_campaigns,
-                "total_campaigns": total_campaigns,
-                "pending_screenshots": pending_screenshots
+                "total_users": users_stats.get("total", 0),
+                "verified_users": users_stats.get("verified", 0),
+                "banned_users": users_stats.get("banned", 0),
+                "recent_users": dashboard_stats.recent_signups(stats),
+                "active_campaigns": campaign_stats.get("active", 0),
+                "total_campaigns": campaign_stats.get("total", 0),
+                "pending_screenshots": stats.get("screenshots", {}).get("pending", 0)
             },
             "wallet": {
-                "total_balance": wallet_data["total_balance"],
-                "total_earned": wallet_data["total_earned"],
-                "total_withdrawals": wallet_data["total_withdrawals"],
-                "pending_withdrawals": withdrawal_stats.get("pending", {}).get("amount", 0)
+                "total_balance": wallet_data.get("total_balance", 0),
+                "total_earned": wallet_data.get("total_earned", 0),
+                "total_withdrawals": wallet_data.get("total_withdrawals", 0),
+                "pending_withdrawals": withdrawal_stats["pending"]["amount"]
             },
             "withdrawals": withdrawal_stats,
             "system_status": {
                 "database_connected": db_connected,
                 "bot_initialized": wallet_bot.initialized if wallet_bot else False,
                 "webhook_active": wallet_bot.webhook_set if wallet_bot else False,
+                "stats_reconciled_at": stats.get("reconciled_at"),
                 "timestamp": datetime.utcnow().isoformat()
             }
         }
         
-        return {"success": True, "data": dashboard_data}
+        return FastJSONResponse({"success": True, "data": dashboard_data})
         
     except Exception as e:
         logger.error(f"❌ Admin dashboard error: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch dashboard data")
 
+def parse_utc_timestamp(value: str) -> datetime:
+    """ISO 8601 timestamp as naive UTC (offsets are converted, a bare time is taken as UTC)"""
+    if value.endswith(("Z", "z")):
+        value = value[:-1] + "+00:00"
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+@app.get("/api/admin/analytics")
+async def get_analytics_series(
+    metric: str,
+    granularity: str = "hour",
+    start: str = None,
+    end: str = None,
+    group_by: str = None,
+    step: int = 1,
+    username: str = Depends(authenticate_admin)
+):
+    """Time series from the analytics rollups (step merges N buckets, e.g. 6 hourly -> 6h)"""
+    try:
+        if metric not in AnalyticsRollupManager.SOURCES:
+            raise HTTPException(status_code=400, detail=f"Unknown metric. Available: {', '.join(AnalyticsRollupManager.SOURCES)}")
+        if granularity not in AnalyticsRollupManager.GRANULARITIES:
+            raise HTTPException(status_code=400, detail="Granularity must be minute, hour or day")
+        
+        try:
+            end_time = parse_utc_timestamp(end) if end else datetime.utcnow()
+            start_time = parse_utc_timestamp(start) if start else end_time - timedelta(days=7)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="start and end must be ISO 8601 timestamps")
+        
+        group_fields = [field.strip() for field in group_by.split(",") if field.strip()] if group_by else []
+        try:
+            series = await analytics_rollups.query(metric, granularity, start_time, end_time, group_fields, step)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"{e}; use a coarser granularity or a shorter range")
+        
+        return FastJSONResponse({
+            "success": True,
+            "data": {
+                "metric": metric,
+                "granularity": granularity,
+                "step": step,
+                "start": start_time,
+                "end": end_time,
+                "series": series
+            }
+        })
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Analytics query error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to fetch analytics")
+
+@app.post("/api/admin/analytics/rollup")
+async def run_analytics_rollup(username: str = Depends(authenticate_admin)):
+    """Fold new events into the analytics rollups now"""
+    try:
+        processed = await analytics_rollups.run()
+        return {"success": True, "data": {"events_processed": processed}}
+        
+    except Exception as e:
+        logger.error(f"❌ Analytics rollup error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to run analytics rollup")
+
+@app.post("/api/admin/transactions/archive")
+async def run_transaction_archive(username: str = Depends(authenticate_admin)):
+    """Move transactions past the hot window into the monthly archives now"""
+    try:
+        moved = await transaction_archive.archive_old_transactions()
+        return {"success": True, "data": {"archived": moved, "hot_days": transaction_archive.hot_days}}
+        
+    except Exception as e:
+        logger.error(f"❌ Transaction archive error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to archive transactions")
+
+@app.post("/api/admin/ledger/verify")
+async def start_ledger_verification(username: str = Depends(authenticate_admin)):
+    """Start a full ledger verification in the background"""
+    try:
+        if ledger_verifier.current_report_id:
+            return {"success": False, "message": "Verification already running", "report_id": ledger_verifier.current_report_id}
+        
+        asyncio.create_task(ledger_verifier.run())
+        return {"success": True, "message": "Ledger verification started"}
+        
+    except Exception as e:
+        logger.error(f"❌ Ledger verification start error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to start ledger verification")
+
+@app.get("/api/admin/ledger/reports")
+async def get_ledger_reports(limit: int = 20, username: str = Depends(authenticate_admin)):
+    """Recent ledger verification reports"""
+    try:
+        collection = user_model.get_collection('ledger_reports')
+        if collection is None:
+            return {"success": False, "message": "Database not available"}
+        
+        reports = await collection.find({}, {"_id": 0}).sort("started_at", -1).limit(limit).to_list(limit)
+        return FastJSONResponse({"success": True, "data": {"reports": reports}})
+        
+    except Exception as e:
+        logger.error(f"❌ Ledger reports error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to fetch ledger reports")
+
+@app.get("/api/admin/ledger/reports/{report_id}")
+async def get_ledger_report(
+    report_id: str,
+    page: int = 1,
+    limit: int = 100,
+    username: str = Depends(authenticate_admin)
+):
+    """Ledger report with its discrepancies (largest drift first)"""
+    try:
+        reports = user_model.get_collection('ledger_reports')
+        discrepancies = user_model.get_collection('ledger_discrepancies')
+        if reports is None or discrepancies is None:
+            return {"success": False, "message": "Database not available"}
+        
+        report = await reports.find_one({"report_id": report_id}, {"_id": 0})
+        if not report:
+            raise HTTPException(status_code=404, detail="Report not found")
+        
+        skip = (page - 1) * limit
+        rows = await discrepancies.aggregate([
+            {"$match": {"report_id": report_id}},
+            {"$set": {"abs_drift": {"$abs": "$drift"}}},
+            {"$sort": {"abs_drift": -1}},
+            {"$skip": skip},
+            {"$limit": limit},
+            {"$project": {"_id": 0, "report_id": 0, "abs_drift": 0}}
+        ]).to_list(limit)
+        
+        return FastJSONResponse({"success": True, "data": {"report": report, "discrepancies": rows}})
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ledger report error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to fetch ledger report")
+
+@app.get("/api/admin/profiler/queries")
+async def get_query_profile(limit: int = 25, username: str = Depends(authenticate_admin)):
+    """Top Mongo query shapes by time, slow queries, N+1 patterns and round trips per update"""
+    return FastJSONResponse({
+        "success": True,
+        "enabled": QUERY_PROFILER_ENABLED,
+        "data": {**query_profiler.report(limit), "read_routing": dict(query_router.routed)}
+    })
+
+@app.post("/api/admin/profiler/explain")
+async def explain_query_shapes(limit: int = 20, username: str = Depends(authenticate_admin)):
+    """Explain the most expensive query shapes and flag collection scans (missing indexes)"""
+    try:
+        findings = await query_profiler.explain_top_shapes(limit)
+        return FastJSONResponse({
+            "success": True,
+            "data": {"explained": findings, "collection_scans": [item for item in findings if item.get("collscan")]}
+        })
+    except Exception as e:
+        logger.error(f"❌ Query explain error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to explain queries")
+
+@app.get("/api/admin/tracing")
+async def get_tracing_status(username: str = Depends(authenticate_admin)):
+    """Tracer sampling, budgets and export counters"""
+    return {"success": True, "data": update_tracer.status()}
+
+@app.post("/api/admin/profiler/reset")
+async def reset_query_profile(username: str = Depends(authenticate_admin)):
+    """Clear collected profiler statistics"""
+    query_profiler.reset()
+    return {"success": True, "message": "Query profiler reset"}
+
+@app.get("/api/admin/cluster")
+async def get_cluster_status(username: str = Depends(authenticate_admin)):
+    """Lease holder and this worker's role in clustered mode"""
+    try:
+        status = await leader_election.status()
+        status["shared_state_backend"] = SHARED_STATE_BACKEND
+        status["singleton_tasks"] = [task.name for task in periodic_tasks if task.leader_only]
+        return FastJSONResponse({"success": True, "data": status})
+    except Exception as e:
+        logger.error(f"❌ Cluster status error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to fetch cluster status")
+
+@app.post("/api/admin/dashboard/reconcile")
+async def reconcile_dashboard_stats(username: str = Depends(authenticate_admin)):
+    """Recount the materialized dashboard counters now"""
+    try:
+        stats = await dashboard_stats.reconcile()
+        if not stats:
+            raise HTTPException(status_code=503, detail="Database not available")
+        return {"success": True, "message": "Dashboard statistics reconciled", "reconciled_at": stats["reconciled_at"]}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Dashboard reconcile error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to reconcile dashboard statistics")
+
 # -------------------- User Management --------------------
 
+ADMIN_USER_LIST_PROJECTION = {
+    "_id": 0,
+    "user_id": 1,
+    "name": {"$trim": {"input": {"$concat": [
+        {"$ifNull": ["$first_name", ""]}, " ", {"$ifNull": ["$last_name", ""]}
+    ]}}},
+    "username": {"$ifNull": ["$username", "Not set"]},
+    "wallet_balance": {"$ifNull": ["$wallet_balance", 0]},
+    "total_earned": {"$ifNull": ["$total_earned", 0]},
+    "device_verified": {"$ifNull": ["$device_verified", False]},
+    "is_active": {"$ifNull": ["$is_active", True]},
+    "is_banned": {"$ifNull": ["$is_banned", False]},
+    "created_at": {"$ifNull": ["$created_at", "$$NOW"]},
+    "last_activity": {"$ifNull": ["$last_activity", "$$NOW"]},
+    "total_referrals": {"$ifNull": ["$total_referrals", 0]},
+    "campaigns_completed": {"$ifNull": ["$campaigns_completed", 0]}
+}
+
 @app.get("/api/admin/users")
 async def get_users_list(
     page: int = 1,
@@ -4671,7 +9195,7 @@ async def get_users_list(
 ):
     """Get paginated users list with search and filters"""
     try:
-        collection = user_model.get_collection('users')
+        collection = query_router.collection('users', 'analytics')
         if collection is None:
             return {"success": False, "message": "Database not available"}
         
@@ -4697,33 +9221,14 @@ async def get_users_list(
         # Get total count
         total_count = await collection.count_documents(query)
         
-        # Get paginated results
+        # Get paginated results (shaped by the projection, serialized as-is)
         skip = (page - 1) * limit
-        users = await collection.find(query).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
-        
-        # Format user data
-        formatted_users = []
-        for user in users:
-            formatted_user = {
-                "user_id": user["user_id"],
-                "name": f"{user.get('first_name', '')} {user.get('last_name', '')}".strip(),
-                "username": user.get('username', 'Not set'),
-                "wallet_balance": user.get('wallet_balance', 0),
-                "total_earned": user.get('total_earned', 0),
-                "device_verified": user.get('device_verified', False),
-                "is_active": user.get('is_active', True),
-                "is_banned": user.get('is_banned', False),
-                "created_at": user.get('created_at', datetime.utcnow()).isoformat(),
-                "last_activity": user.get('last_activity', datetime.utcnow()).isoformat(),
-                "total_referrals": user.get('total_referrals', 0),
-                "campaigns_completed": user.get('campaigns_completed', 0)
-            }
-            formatted_users.append(formatted_user)
+        users = await collection.find(query, ADMIN_USER_LIST_PROJECTION).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
         
-        return {
+        return FastJSONResponse({
             "success": True,
             "data": {
-                "users": formatted_users,
+                "users": users,
                 "pagination": {
                     "current_page": page,
                     "limit": limit,
@@ -4731,12 +9236,32 @@ async def get_users_list(
                     "total_pages": (total_count + limit - 1) // limit
                 }
             }
-        }
+        })
         
     except Exception as e:
         logger.error(f"❌ Get users list error: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch users")
 
+ADMIN_USER_TRANSACTION_PROJECTION = {
+    "_id": 0,
+    "transaction_id": {"$ifNull": ["$transaction_id", ""]},
+    "amount": {"$ifNull": ["$amount", 0]},
+    "type": {"$ifNull": ["$type", ""]},
+    "description": {"$ifNull": ["$description", ""]},
+    "timestamp": {"$ifNull": ["$timestamp", "$$NOW"]},
+    "status": {"$ifNull": ["$status", "completed"]}
+}
+
+ADMIN_USER_WITHDRAWAL_PROJECTION = {
+    "_id": 0,
+    "request_id": {"$ifNull": ["$request_id", ""]},
+    "amount": {"$ifNull": ["$amount", 0]},
+    "payment_method": {"$ifNull": ["$payment_method", ""]},
+    "status": {"$ifNull": ["$status", ""]},
+    "request_time": {"$ifNull": ["$request_time", "$$NOW"]},
+    "processed_time": {"$ifNull": ["$processed_time", None]}
+}
+
 @app.get("/api/admin/users/{user_id}")
 async def get_user_details(user_id: int, username: str = Depends(authenticate_admin)):
     """Get detailed user information"""
@@ -4745,21 +9270,18 @@ async def get_user_details(user_id: int, username: str = Depends(authenticate_ad
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Get additional data
-        transactions_collection = user_model.get_collection('transactions')
-        transactions = []
-        if transactions_collection is not None:
-            transactions = await transactions_collection.find({
-                "user_id": user_id
-            }).sort("timestamp", -1).limit(20).to_list(20)
+        # Get additional data (hot and archived transactions)
+        transactions = await transaction_archive.get_user_transactions(
+            user_id, limit=20, projection=ADMIN_USER_TRANSACTION_PROJECTION
+        )
         
         # Get withdrawal history
         withdrawals_collection = user_model.get_collection('withdrawal_requests')
         withdrawals = []
         if withdrawals_collection is not None:
-            withdrawals = await withdrawals_collection.find({
-                "user_id": user_id
-            }).sort("request_time", -1).limit(10).to_list(10)
+            withdrawals = await withdrawals_collection.find(
+                {"user_id": user_id}, ADMIN_USER_WITHDRAWAL_PROJECTION
+            ).sort("request_time", -1).limit(10).to_list(10)
         
         # Format detailed user data
         user_details = {
@@ -4768,14 +9290,14 @@ async def get_user_details(user_id: int, username: str = Depends(authenticate_ad
                 "first_name": user.get('first_name', ''),
                 "last_name": user.get('last_name', ''),
                 "username": user.get('username', ''),
-                "created_at": user.get('created_at', datetime.utcnow()).isoformat(),
-                "last_activity": user.get('last_activity', datetime.utcnow()).isoformat()
+                "created_at": user.get('created_at', datetime.utcnow()),
+                "last_activity": user.get('last_activity', datetime.utcnow())
             },
             "security": {
                 "device_verified": user.get('device_verified', False),
                 "device_fingerprint": user.get('device_fingerprint', ''),
                 "verification_status": user.get('verification_status', 'pending'),
-                "device_verified_at": user.get('device_verified_at', '').isoformat() if user.get('device_verified_at') else None
+                "device_verified_at": user.get('device_verified_at')
             },
             "wallet": {
                 "balance": user.get('wallet_balance', 0),
@@ -4800,29 +9322,11 @@ async def get_user_details(user_id: int, username: str = Depends(authenticate_ad
                 "ban_reason": user.get('ban_reason', ''),
                 "warning_count": user.get('warning_count', 0)
             },
-            "transactions": [
-                {
-                    "transaction_id": tx.get('transaction_id', ''),
-                    "amount": tx.get('amount', 0),
-                    "type": tx.get('type', ''),
-                    "description": tx.get('description', ''),
-                    "timestamp": tx.get('timestamp', datetime.utcnow()).isoformat(),
-                    "status": tx.get('status', 'completed')
-                } for tx in transactions
-            ],
-            "withdrawals": [
-                {
-                    "request_id": wd.get('request_id', ''),
-                    "amount": wd.get('amount', 0),
-                    "payment_method": wd.get('payment_method', ''),
-                    "status": wd.get('status', ''),
-                    "request_time": wd.get('request_time', datetime.utcnow()).isoformat(),
-                    "processed_time": wd.get('processed_time', '').isoformat() if wd.get('processed_time') else None
-                } for wd in withdrawals
-            ]
+            "transactions": transactions,
+            "withdrawals": withdrawals
         }
         
-        return {"success": True, "data": user_details}
+        return FastJSONResponse({"success": True, "data": user_details})
         
     except HTTPException:
         raise
@@ -4843,21 +9347,40 @@ async def manage_user_wallet(
         operation = data.get('operation', 'add')  # 'add' or 'subtract'
         description = data.get('description', 'Admin wallet adjustment')
         
+        idempotency_key = request.headers.get('idempotency-key') or data.get('idempotency_key')
+        
         if amount <= 0:
             raise HTTPException(status_code=400, detail="Amount must be positive")
         
-        user = await user_model.get_user(user_id)
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
         if operation == 'subtract':
             amount = -amount
         
-        success = await user_model.add_to_wallet(
-            user_id, amount, "admin_adjustment", f"Admin: {description}"
-        )
+        # The key also goes on the ledger row, so a taken-over reservation cannot apply twice
+        ledger_key = f"admin:{username}:{idempotency_key}" if idempotency_key else None
         
-        if success:
+        async def apply_adjustment():
+            user = await user_model.get_user(user_id)
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
+            
+            success = await user_model.add_to_wallet(
+                user_id, amount, "admin_adjustment", f"Admin: {description}", idempotency_key=ledger_key
+            )
+            
+            if not success and ledger_key:
+                applied = await user_model.find_ledger_entry(ledger_key)
+                if applied is not None:
+                    return {
+                        "success": True,
+                        "message": "Wallet adjustment was already applied",
+                        "duplicate": True,
+                        "transaction_id": applied['transaction_id'],
+                        "new_balance": await user_model.get_wallet_balance(user_id)
+                    }
+            
+            if not success:
+                raise HTTPException(status_code=400, detail="Failed to update wallet")
+            
             new_balance = await user_model.get_wallet_balance(user_id)
             
             # Send notification to user
@@ -4884,9 +9407,15 @@ async def manage_user_wallet(
                 "message": f"Wallet {'credited' if amount > 0 else 'debited'} successfully",
                 "new_balance": new_balance
             }
-        else:
-            raise HTTPException(status_code=400, detail="Failed to update wallet")
-            
+        
+        # A retried adjustment with the same Idempotency-Key replays the first result
+        result, replayed = await idempotency_store.run(
+            f"admin:{username}", idempotency_key,
+            {"user_id": user_id, "amount": amount, "description": description},
+            apply_adjustment
+        )
+        return idempotent_response(result, replayed)
+        
     except HTTPException:
         raise
     except Exception as e:
@@ -4923,6 +9452,9 @@ async def ban_user(user_id: int, request: Request, username: str = Depends(authe
         success = await user_model.update_user(user_id, update_data)
         
         if success:
+            if user.get('is_banned', False) != (action == 'ban'):
+                await dashboard_stats.record_user_banned(action == 'ban')
+            
             # Send notification to user
             try:
                 if wallet_bot and wallet_bot.bot:
@@ -4962,8 +9494,80 @@ Welcome back! 🎉"""
         logger.error(f"❌ Ban user error: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to {action} user")
 
+# -------------------- Device Similarity --------------------
+
+@app.get("/api/admin/devices/flagged")
+async def get_flagged_devices(
+    page: int = 1,
+    limit: int = 20,
+    username: str = Depends(authenticate_admin)
+):
+    """List verified devices that resemble another user's device"""
+    try:
+        collection = user_model.get_collection('device_fingerprints')
+        if collection is None:
+            return {"success": False, "message": "Database not available"}
+        
+        query = {"similarity_flagged": True}
+        skip = (page - 1) * limit
+        devices = await collection.find(
+            query,
+            {"_id": 0, "user_id": 1, "fingerprint": 1, "created_at": 1,
+             "verification_ip": 1, "similar_devices": 1}
+        ).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+        total_count = await collection.count_documents(query)
+        
+        return FastJSONResponse({
+            "success": True,
+            "data": {
+                "devices": devices,
+                "min_shared_components": device_similarity_index.min_shared,
+                "pagination": {
+                    "current_page": page,
+                    "total_pages": (total_count + limit - 1) // limit,
+                    "total_count": total_count,
+                    "limit": limit
+                }
+            }
+        })
+        
+    except Exception as e:
+        logger.error(f"❌ Flagged devices error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to load flagged devices")
+
+@app.post("/api/admin/devices/similarity-index/rebuild")
+async def rebuild_device_similarity_index(username: str = Depends(authenticate_admin)):
+    """Backfill the device similarity index from stored fingerprints"""
+    try:
+        result = await device_similarity_index.rebuild_from_device_fingerprints()
+        if not result["success"]:
+            raise HTTPException(status_code=500, detail=result.get("message", "Rebuild failed"))
+        return {"success": True, "data": result}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Device similarity rebuild error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to rebuild device similarity index")
+
 # -------------------- Campaign Management --------------------
 
+ADMIN_CAMPAIGN_LIST_PROJECTION = {
+    "_id": 0,
+    "campaign_id": 1,
+    "name": 1,
+    "description": {"$ifNull": ["$description", ""]},
+    "reward_amount": {"$ifNull": ["$reward_amount", 0]},
+    "status": {"$ifNull": ["$status", "active"]},
+    "requires_screenshot": {"$ifNull": ["$requires_screenshot", False]},
+    "total_submissions": {"$ifNull": ["$total_submissions", 0]},
+    "approved_submissions": {"$ifNull": ["$approved_submissions", 0]},
+    "rejected_submissions": {"$ifNull": ["$rejected_submissions", 0]},
+    "created_at": {"$ifNull": ["$created_at", "$$NOW"]},
+    "category": {"$ifNull": ["$category", "general"]},
+    "priority": {"$ifNull": ["$priority", "normal"]}
+}
+
 @app.get("/api/admin/campaigns")
 async def get_campaigns_list(
     page: int = 1,
@@ -4973,7 +9577,7 @@ async def get_campaigns_list(
 ):
     """Get campaigns list with pagination"""
     try:
-        collection = user_model.get_collection('campaigns')
+        collection = query_router.collection('campaigns', 'analytics')
         if collection is None:
             return {"success": False, "message": "Database not available"}
         
@@ -4984,30 +9588,12 @@ async def get_campaigns_list(
         total_count = await collection.count_documents(query)
         skip = (page - 1) * limit
         
-        campaigns = await collection.find(query).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
-        
-        formatted_campaigns = []
-        for campaign in campaigns:
-            formatted_campaign = {
-                "campaign_id": campaign["campaign_id"],
-                "name": campaign["name"],
-                "description": campaign.get("description", ""),
-                "reward_amount": campaign.get("reward_amount", 0),
-                "status": campaign.get("status", "active"),
-                "requires_screenshot": campaign.get("requires_screenshot", False),
-                "total_submissions": campaign.get("total_submissions", 0),
-                "approved_submissions": campaign.get("approved_submissions", 0),
-                "rejected_submissions": campaign.get("rejected_submissions", 0),
-                "created_at": campaign.get("created_at", datetime.utcnow()).isoformat(),
-                "category": campaign.get("category", "general"),
-                "priority": campaign.get("priority", "normal")
-            }
-            formatted_campaigns.append(formatted_campaign)
+        campaigns = await collection.find(query, ADMIN_CAMPAIGN_LIST_PROJECTION).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
         
-        return {
+        return FastJSONResponse({
             "success": True,
             "data": {
-                "campaigns": formatted_campaigns,
+                "campaigns": campaigns,
                 "pagination": {
                     "current_page": page,
                     "limit": limit,
@@ -5015,7 +9601,7 @@ async def get_campaigns_list(
                     "total_pages": (total_count + limit - 1) // limit
                 }
             }
-        }
+        })
         
     except Exception as e:
         logger.error(f"❌ Get campaigns list error: {e}")
@@ -5376,6 +9962,23 @@ async def get_screenshot_image(submission_id: str, username: str = Depends(authe
 
 # -------------------- Withdrawal Management API --------------------
 
+ADMIN_WITHDRAWAL_LIST_PROJECTION = {
+    "_id": 0,
+    "request_id": 1,
+    "user_id": 1,
+    "user_name": {"$ifNull": [{"$arrayElemAt": ["$user.first_name", 0]}, "Unknown"]},
+    "user_username": {"$ifNull": [{"$arrayElemAt": ["$user.username", 0]}, ""]},
+    "amount": 1,
+    "payment_method": 1,
+    "payment_details": 1,
+    "status": 1,
+    "request_time": 1,
+    "processed_time": {"$ifNull": ["$processed_time", None]},
+    "admin_notes": {"$ifNull": ["$admin_notes", ""]},
+    "transaction_id": {"$ifNull": ["$transaction_id", ""]},
+    "gateway_used": {"$ifNull": ["$gateway_used", ""]}
+}
+
 @app.get("/api/admin/withdrawals")
 async def get_withdrawals_list(
     status: str = "pending",
@@ -5385,7 +9988,7 @@ async def get_withdrawals_list(
 ):
     """Get withdrawal requests with filtering and pagination"""
     try:
-        collection = user_model.get_collection('withdrawal_requests')
+        collection = query_router.collection('withdrawal_requests', 'analytics')
         if collection is None:
             return {"success": False, "message": "Database not available"}
         
@@ -5396,34 +9999,25 @@ async def get_withdrawals_list(
         total_count = await collection.count_documents(query)
         skip = (page - 1) * limit
         
-        withdrawals = await collection.find(query).sort("request_time", -1).skip(skip).limit(limit).to_list(limit)
-        
-        # Enrich with user data
-        formatted_withdrawals = []
-        for withdrawal in withdrawals:
-            user = await user_model.get_user(withdrawal['user_id'])
-            
-            formatted_withdrawal = {
-                "request_id": withdrawal["request_id"],
-                "user_id": withdrawal["user_id"],
-                "user_name": user.get('first_name', 'Unknown') if user else 'Unknown',
-                "user_username": user.get('username', '') if user else '',
-                "amount": withdrawal["amount"],
-                "payment_method": withdrawal["payment_method"],
-                "payment_details": withdrawal["payment_details"],
-                "status": withdrawal["status"],
-                "request_time": withdrawal["request_time"].isoformat(),
-                "processed_time": withdrawal.get("processed_time", "").isoformat() if withdrawal.get("processed_time") else None,
-                "admin_notes": withdrawal.get("admin_notes", ""),
-                "transaction_id": withdrawal.get("transaction_id", ""),
-                "gateway_used": withdrawal.get("gateway_used", "")
-            }
-            formatted_withdrawals.append(formatted_withdrawal)
-        
-        return {
+        # Enrich with user data in the same round trip
+        withdrawals = await collection.aggregate([
+            {"$match": query},
+            {"$sort": {"request_time": -1}},
+            {"$skip": skip},
+            {"$limit": limit},
+            {"$lookup": {
+                "from": "users",
+                "localField": "user_id",
+                "foreignField": "user_id",
+                "as": "user"
+            }},
+            {"$project": ADMIN_WITHDRAWAL_LIST_PROJECTION}
+        ]).to_list(limit)
+        
+        return FastJSONResponse({
             "success": True,
             "data": {
-                "withdrawals": formatted_withdrawals,
+                "withdrawals": withdrawals,
                 "pagination": {
                     "current_page": page,
                     "limit": limit,
@@ -5431,7 +10025,7 @@ async def get_withdrawals_list(
                     "total_pages": (total_count + limit - 1) // limit
                 }
             }
-        }
+        })
         
     except Exception as e:
         logger.error(f"❌ Get withdrawals list error: {e}")
@@ -5509,7 +10103,7 @@ async def get_withdrawal_statistics_api(username: str = Depends(authenticate_adm
         stats = await payment_manager.get_withdrawal_statistics()
         
         # Add additional statistics
-        collection = user_model.get_collection('withdrawal_requests')
+        collection = query_router.collection('withdrawal_requests', 'analytics')
         if collection is not None:
             # Today's statistics
             today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
@@ -5535,8 +10129,50 @@ async def get_withdrawal_statistics_api(username: str = Depends(authenticate_adm
         logger.error(f"❌ Get withdrawal statistics error: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch withdrawal statistics")
 
+@app.get("/api/admin/withdrawal-jobs")
+async def get_withdrawal_jobs(
+    status: str = None,
+    limit: int = 50,
+    username: str = Depends(authenticate_admin)
+):
+    """Automatic payout jobs and worker pool state"""
+    try:
+        collection = user_model.get_collection('withdrawal_jobs')
+        if collection is None:
+            return {"success": False, "message": "Database not available"}
+        
+        query = {"status": status} if status else {}
+        jobs = await collection.find(
+            query, {"_id": 0, "payment_details": 0}
+        ).sort("created_at", -1).limit(limit).to_list(limit)
+        
+        return FastJSONResponse({"success": True, "data": {"jobs": jobs, "queue": withdrawal_queue.status()}})
+        
+    except Exception as e:
+        logger.error(f"❌ Withdrawal jobs error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to fetch withdrawal jobs")
+
 # -------------------- Gift Code Management API --------------------
 
+ADMIN_GIFT_CODE_LIST_PROJECTION = {
+    "_id": 0,
+    "code": 1,
+    "amount": 1,
+    "created_at": 1,
+    "expires_at": {"$ifNull": ["$expires_at", None]},
+    "is_used": 1,
+    "is_expired": {"$lt": [{"$ifNull": ["$expires_at", "$$NOW"]}, "$$NOW"]},
+    "used_by": {"$ifNull": ["$used_by", None]},
+    "used_at": {"$ifNull": ["$used_at", None]},
+    "max_uses": {"$ifNull": ["$max_uses", 1]},
+    "current_uses": {"$ifNull": ["$current_uses", 0]},
+    "used_by_name": {"$cond": [
+        {"$ifNull": ["$used_by", False]},
+        {"$ifNull": [{"$arrayElemAt": ["$used_by_user.first_name", 0]}, "Unknown"]},
+        "$$REMOVE"
+    ]}
+}
+
 @app.get("/api/admin/gift-codes")
 async def get_gift_codes_list(
     page: int = 1,
@@ -5546,7 +10182,7 @@ async def get_gift_codes_list(
 ):
     """Get gift codes list with pagination"""
     try:
-        collection = user_model.get_collection('gift_codes')
+        collection = query_router.collection('gift_codes', 'analytics')
         if collection is None:
             return {"success": False, "message": "Database not available"}
         
@@ -5561,37 +10197,24 @@ async def get_gift_codes_list(
         total_count = await collection.count_documents(query)
         skip = (page - 1) * limit
         
-        gift_codes = await collection.find(query).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
-        
-        # Format gift codes
-        formatted_codes = []
-        for code in gift_codes:
-            is_expired = code.get('expires_at', datetime.utcnow()) < datetime.utcnow()
-            
-            formatted_code = {
-                "code": code["code"],
-                "amount": code["amount"],
-                "created_at": code["created_at"].isoformat(),
-                "expires_at": code.get("expires_at", "").isoformat() if code.get("expires_at") else None,
-                "is_used": code["is_used"],
-                "is_expired": is_expired,
-                "used_by": code.get("used_by"),
-                "used_at": code.get("used_at", "").isoformat() if code.get("used_at") else None,
-                "max_uses": code.get("max_uses", 1),
-                "current_uses": code.get("current_uses", 0)
-            }
-            
-            # Add user info if used
-            if code.get("used_by"):
-                user = await user_model.get_user(code["used_by"])
-                formatted_code["used_by_name"] = user.get('first_name', 'Unknown') if user else 'Unknown'
-            
-            formatted_codes.append(formatted_code)
-        
-        return {
+        gift_codes = await collection.aggregate([
+            {"$match": query},
+            {"$sort": {"created_at": -1}},
+            {"$skip": skip},
+            {"$limit": limit},
+            {"$lookup": {
+                "from": "users",
+                "localField": "used_by",
+                "foreignField": "user_id",
+                "as": "used_by_user"
+            }},
+            {"$project": ADMIN_GIFT_CODE_LIST_PROJECTION}
+        ]).to_list(limit)
+        
+        return FastJSONResponse({
             "success": True,
             "data": {
-                "gift_codes": formatted_codes,
+                "gift_codes": gift_codes,
                 "pagination": {
                     "current_page": page,
                     "limit": limit,
@@ -5599,7 +10222,7 @@ async def get_gift_codes_list(
                     "total_pages": (total_count + limit - 1) // limit
                 }
             }
-        }
+        })
         
     except Exception as e:
         logger.error(f"❌ Get gift codes list error: {e}")
@@ -5651,7 +10274,7 @@ async def generate_gift_codes_api(request: Request, username: str = Depends(auth
 async def get_gift_codes_statistics(username: str = Depends(authenticate_admin)):
     """Get gift code statistics"""
     try:
-        collection = user_model.get_collection('gift_codes')
+        collection = query_router.collection('gift_codes', 'analytics')
         if collection is None:
             return {"success": False, "message": "Database not available"}
         
@@ -5951,6 +10574,20 @@ async def update_payment_method(
 
 # -------------------- API Integration Management --------------------
 
+ADMIN_API_KEY_LIST_PROJECTION = {
+    "_id": 0,
+    "api_key": 1,
+    "project_name": 1,
+    "permissions": 1,
+    "is_active": 1,
+    "usage_count": 1,
+    "created_at": 1,
+    "last_used": {"$ifNull": ["$last_used", None]},
+    "rate_limit_per_hour": {"$ifNull": ["$rate_limit_per_hour", 1000]},
+    "webhook_url": {"$ifNull": ["$webhook_url", None]},
+    "webhook_events": {"$ifNull": ["$webhook_events", None]}
+}
+
 @app.get("/api/admin/api-keys")
 async def get_api_keys_list(username: str = Depends(authenticate_admin)):
     """Get list of API keys for external integrations"""
@@ -5959,23 +10596,12 @@ async def get_api_keys_list(username: str = Depends(authenticate_admin)):
         if collection is None:
             return {"success": False, "message": "Database not available"}
         
-        api_keys = await collection.find({}).sort("created_at", -1).to_list(100)
-        
-        formatted_keys = []
-        for key in api_keys:
-            formatted_key = {
-                "api_key": key["api_key"],
-                "project_name": key["project_name"],
-                "permissions": key["permissions"],
-                "is_active": key["is_active"],
-                "usage_count": key["usage_count"],
-                "created_at": key["created_at"].isoformat(),
-                "last_used": key.get("last_used", "").isoformat() if key.get("last_used") else None,
-                "rate_limit_per_hour": key.get("rate_limit_per_hour", 1000)
-            }
-            formatted_keys.append(formatted_key)
+        api_keys = await collection.find({}, ADMIN_API_KEY_LIST_PROJECTION).sort("created_at", -1).to_list(100)
         
-        return {"success": True, "data": {"api_keys": formatted_keys}}
+        return FastJSONResponse({"success": True, "data": {
+            "api_keys": api_keys,
+            "rate_limiter": api_integration_manager.rate_limiter.status()
+        }})
         
     except Exception as e:
         logger.error(f"❌ Get API keys list error: {e}")
@@ -6023,6 +10649,9 @@ async def deactivate_api_key(api_key: str, username: str = Depends(authenticate_
             {"$set": {"is_active": False, "deactivated_at": datetime.utcnow()}}
         )
         
+        api_integration_manager.invalidate_api_key(api_key)
+        partner_webhooks.subscribers.pop(api_key, None)
+        
         if result.modified_count > 0:
             return {"success": True, "message": "API key deactivated successfully"}
         else:
@@ -6034,6 +10663,85 @@ async def deactivate_api_key(api_key: str, username: str = Depends(authenticate_
         logger.error(f"❌ Deactivate API key error: {e}")
         raise HTTPException(status_code=500, detail="Failed to deactivate API key")
 
+@app.put("/api/admin/api-keys/{api_key}/webhook")
+async def configure_api_key_webhook(api_key: str, request: Request, username: str = Depends(authenticate_admin)):
+    """Set or clear a partner's webhook; a new signing secret is returned whenever a URL is set"""
+    try:
+        data = await request.json()
+        url = (data.get('url') or '').strip()
+        events = data.get('events') or list(PartnerWebhookDispatcher.EVENT_TYPES)
+        
+        if url and not url.startswith("https://"):
+            raise HTTPException(status_code=400, detail="Webhook URL must use https")
+        if not set(events) <= set(PartnerWebhookDispatcher.EVENT_TYPES):
+            raise HTTPException(status_code=400, detail=f"Unknown event type; expected {PartnerWebhookDispatcher.EVENT_TYPES}")
+        
+        collection = user_model.get_collection('api_keys')
+        if collection is None:
+            raise HTTPException(status_code=500, detail="Database not available")
+        
+        secret = secrets.token_hex(32) if url else None
+        result = await collection.update_one(
+            {"api_key": api_key},
+            {"$set": {
+                "webhook_url": url or None,
+                "webhook_secret": secret,
+                "webhook_events": events,
+                "webhook_updated_at": datetime.utcnow()
+            }}
+        )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=404, detail="API key not found")
+        
+        await partner_webhooks.refresh_subscribers()
+        
+        if url:
+            return {"success": True, "message": "Webhook configured", "webhook_secret": secret}
+        return {"success": True, "message": "Webhook removed"}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Configure webhook error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to configure webhook")
+
+@app.get("/api/admin/partner-webhooks")
+async def get_partner_webhook_status(username: str = Depends(authenticate_admin)):
+    """Delivery counters, retry queue depth and recent dead letters"""
+    try:
+        deliveries = user_model.get_collection('partner_webhook_deliveries')
+        dead_letters = user_model.get_collection('partner_webhook_dead_letters')
+        if deliveries is None or dead_letters is None:
+            raise HTTPException(status_code=500, detail="Database not available")
+        
+        return FastJSONResponse({"success": True, "data": {
+            **partner_webhooks.status(),
+            "pending_retries": await deliveries.count_documents({}),
+            "dead_letters": await dead_letters.find(
+                {}, {"_id": 0, "events": 0}
+            ).sort("failed_at", -1).to_list(50)
+        }})
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Partner webhook status error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to fetch webhook status")
+
+@app.post("/api/admin/partner-webhooks/dead-letters/{delivery_id}/replay")
+async def replay_partner_webhook(delivery_id: str, username: str = Depends(authenticate_admin)):
+    """Queue a dead-lettered batch for redelivery"""
+    try:
+        if not await partner_webhooks.replay_dead_letter(delivery_id):
+            raise HTTPException(status_code=404, detail="Dead letter not found")
+        return {"success": True, "message": "Delivery queued for retry"}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Replay webhook error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to replay delivery")
+
 # -------------------- External API Endpoints (for integration) --------------------
 
 @app.post("/api/external/add-earnings")
@@ -6046,16 +10754,21 @@ async def add_earnings_external(request: Request):
         user_id = int(data.get('user_id', 0))
         amount = float(data.get('amount', 0))
         description = data.get('description', 'External project earnings')
+        idempotency_key = request.headers.get('idempotency-key') or data.get('idempotency_key')
         
         if not all([api_key, user_id, amount]):
             raise HTTPException(status_code=400, detail="Missing required fields")
         
-        result = await api_integration_manager.add_earnings_via_api(
-            api_key, user_id, amount, description
+        # The scoped key also goes on the ledger row, the same namespace batch items use
+        ledger_key = f"{api_key_scope(api_key)}:{idempotency_key}" if idempotency_key else None
+        result, replayed = await idempotency_store.run(
+            api_key_scope(api_key), idempotency_key,
+            {"user_id": user_id, "amount": amount, "description": description},
+            lambda: api_integration_manager.add_earnings_via_api(api_key, user_id, amount, description, ledger_key)
         )
         
         if result["success"]:
-            return result
+            return idempotent_response(result, replayed)
         else:
             raise HTTPException(status_code=400, detail=result["message"])
             
@@ -6065,9 +10778,81 @@ async def add_earnings_external(request: Request):
         logger.error(f"❌ External add earnings error: {e}")
         raise HTTPException(status_code=500, detail="Failed to add earnings")
 
+async def read_ndjson_items(request: Request, max_items: int) -> List[Dict[str, Any]]:
+    """Parse an NDJSON request body line by line, stopping once max_items is exceeded"""
+    loads = orjson.loads if orjson is not None else json.loads
+    items, buffer = [], b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                items.append(loads(line))
+        if len(items) > max_items:
+            raise HTTPException(status_code=413, detail=f"At most {max_items} items per batch")
+    if buffer.strip():
+        items.append(loads(buffer))
+    return items
+
+@app.post("/api/external/add-earnings/batch")
+async def add_earnings_batch_external(request: Request):
+    """External API endpoint for crediting many users in one request
+    
+    Body: a JSON array of items, {"api_key": ..., "items": [...]}, or NDJSON
+    (Content-Type: application/x-ndjson) with one item per line; the key can
+    also be sent as an X-API-Key header. Item fields: user_id, amount,
+    description, idempotency_key.
+    """
+    try:
+        api_key = request.headers.get('x-api-key', '')
+        
+        if 'ndjson' in request.headers.get('content-type', ''):
+            items = await read_ndjson_items(request, EXTERNAL_BATCH_MAX_ITEMS)
+        else:
+            data = await request.json()
+            if isinstance(data, dict):
+                api_key = api_key or data.get('api_key', '')
+                data = data.get('items')
+            if not isinstance(data, list):
+                raise HTTPException(status_code=400, detail="Expected a list of items")
+            items = data
+        
+        if not api_key:
+            raise HTTPException(status_code=400, detail="Missing API key")
+        if not items:
+            raise HTTPException(status_code=400, detail="No items to process")
+        if len(items) > EXTERNAL_BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=413, detail=f"At most {EXTERNAL_BATCH_MAX_ITEMS} items per batch")
+        if not all(isinstance(item, dict) for item in items):
+            raise HTTPException(status_code=400, detail="Each item must be an object")
+        
+        result = await api_integration_manager.add_earnings_batch_via_api(api_key, items)
+        
+        if result["success"]:
+            return FastJSONResponse(result)
+        else:
+            raise HTTPException(status_code=400, detail=result["message"])
+            
+    except HTTPException:
+        raise
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    except Exception as e:
+        logger.error(f"❌ External batch earnings error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to add earnings")
+
+EXTERNAL_USER_INFO_PROJECTION = {
+    "_id": 0, "user_id": 1, "first_name": 1, "device_verified": 1, "wallet_balance": 1,
+    "total_earned": 1, "is_active": 1, "is_banned": 1
+}
+
 @app.get("/api/external/user-info")
 async def get_user_info_external(user_id: int, api_key: str):
-    """External API endpoint for getting user information"""
+    """External API endpoint for getting user information
+    
+    Read-only (no last_activity write); partners should subscribe to the
+    wallet.updated webhook instead of polling this.
+    """
     try:
         # Validate API key
         validation = await api_integration_manager.validate_api_key(api_key)
@@ -6077,7 +10862,11 @@ async def get_user_info_external(user_id: int, api_key: str):
         if "user_info" not in validation.get("permissions", []):
             raise HTTPException(status_code=403, detail="Insufficient API permissions")
         
-        user = await user_model.get_user(user_id)
+        collection = user_model.get_collection('users')
+        if collection is None:
+            raise HTTPException(status_code=503, detail="Database not available")
+        
+        user = await collection.find_one({"user_id": user_id}, EXTERNAL_USER_INFO_PROJECTION)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -6125,8 +10914,9 @@ async def upload_image(
         
         # Save file
         content = await file.read()
-        async with aiofiles.open(file_path, 'wb') as f:
-            await f.write(content)
+        with update_tracer.span("file.write", {"file.path": file_path, "file.size": len(content)}):
+            async with aiofiles.open(file_path, 'wb') as f:
+                await f.write(content)
         
         # Return file URL
         file_url = f"{RENDER_EXTERNAL_URL}/uploads/admin_images/{unique_filename}"
@@ -6144,13 +10934,266 @@ async def upload_image(
         logger.error(f"❌ Upload image error: {e}")
         raise HTTPException(status_code=500, detail="Failed to upload image")
 
+# -------------------- Data Export --------------------
+
+EXPORT_DATASETS = {
+    "users": {
+        "collection": "users",
+        "fields": [
+            "user_id", "first_name", "last_name", "username", "wallet_balance",
+            "total_earned", "referral_earnings", "withdrawal_total", "device_verified",
+            "is_banned", "referred_by", "created_at", "last_activity"
+        ]
+    },
+    "transactions": {
+        "collection": "transactions",
+        "fields": ["transaction_id", "user_id", "amount", "type", "description", "status", "timestamp"],
+        "archived": True  # older rows live in transactions_archive_YYYY_MM
+    },
+    "withdrawals": {
+        "collection": "withdrawal_requests",
+        "fields": [
+            "request_id", "user_id", "amount", "payment_method", "status", "gateway_used",
+            "transaction_id", "admin_notes", "request_time", "processed_time"
+        ]
+    }
+}
+
+def _csv_value(value):
+    """Flatten a document value into a CSV cell"""
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return dump_json(value).decode("utf-8")
+    return value
+
+async def stream_export_rows(collections: List[Any], query: Dict[str, Any], fields: List[str],
+                             output_format: str, batch_size: int, dataset: str):
+    """Yield NDJSON/CSV chunks from _id-ordered cursors, one chunk per batch
+    
+    Collections are read one after the other (oldest tier first). Every row
+    carries its ``_id`` so an interrupted export can be resumed with
+    ``after=<last _id>``.
+    """
+    projection = {field: 1 for field in fields}
+    columns = ["_id"] + fields
+    
+    async def documents():
+        for collection in collections:
+            async for document in collection.find(query, projection).sort("_id", 1).batch_size(batch_size):
+                yield document
+    
+    exported = 0
+    rows = []
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if output_format == "csv":
+        writer.writerow(columns)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    
+    try:
+        async for document in documents():
+            if output_format == "csv":
+                writer.writerow([_csv_value(document.get(column)) for column in columns])
+            else:
+                rows.append(dump_json(document))
+            exported += 1
+            
+            if exported % batch_size == 0:
+                if output_format == "csv":
+                    yield buffer.getvalue().encode("utf-8")
+                    buffer.seek(0)
+                    buffer.truncate()
+                else:
+                    yield b"\n".join(rows) + b"\n"
+                    rows = []
+        
+        if output_format == "csv":
+            yield buffer.getvalue().encode("utf-8")
+        elif rows:
+            yield b"\n".join(rows) + b"\n"
+        
+        logger.info(f"📤 Export of {dataset} complete: {exported} rows")
+        
+    except Exception as e:
+        # Headers are already sent; clients resume from the last _id received
+        logger.error(f"❌ Export of {dataset} aborted after {exported} rows: {e}")
+        raise
+
+async def stream_archived_export(hot_collection, query: Dict[str, Any], fields: List[str],
+                                 output_format: str, batch_size: int, dataset: str):
+    """Export the monthly transaction archives followed by the hot tier
+    
+    Archival is paused on every replica through a lease renewed with each
+    chunk, so no row is skipped or sent twice while it moves between tiers.
+    A client that stops reading for longer than the lease lets archival
+    resume rather than stalling it (rows moved in that gap may be missed).
+    """
+    async with transaction_archive.paused():
+        collections = await transaction_archive.archive_collections("analytics") + [hot_collection]
+        async for chunk in stream_export_rows(collections, query, fields, output_format, batch_size, dataset):
+            await transaction_archive.renew_pause()
+            yield chunk
+
+@app.get("/api/admin/export/{dataset}")
+async def export_dataset(
+    dataset: str,
+    format: str = "ndjson",
+    start_date: str = None,
+    end_date: str = None,
+    after: str = None,
+    batch_size: int = 2000,
+    username: str = Depends(authenticate_admin)
+):
+    """Stream a full dataset dump as NDJSON or CSV
+    
+    Date bounds (ISO 8601) apply to the record's insertion time, taken from
+    its ObjectId, so the filter is served by the _id index.
+    """
+    try:
+        config = EXPORT_DATASETS.get(dataset)
+        if config is None:
+            raise HTTPException(status_code=404, detail=f"Unknown dataset. Available: {', '.join(EXPORT_DATASETS)}")
+        if format not in ("ndjson", "csv"):
+            raise HTTPException(status_code=400, detail="Format must be 'ndjson' or 'csv'")
+        
+        collection = query_router.collection(config["collection"], "analytics")
+        if collection is None:
+            raise HTTPException(status_code=503, detail="Database not available")
+        
+        id_range = {}
+        try:
+            if start_date:
+                id_range["$gte"] = ObjectId.from_datetime(datetime.fromisoformat(start_date))
+            if end_date:
+                id_range["$lt"] = ObjectId.from_datetime(datetime.fromisoformat(end_date))
+            if after:
+                id_range["$gt"] = ObjectId(after)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid start_date, end_date or after cursor")
+        
+        query = {"_id": id_range} if id_range else {}
+        batch_size = max(100, min(batch_size, 10000))
+        
+        media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+        filename = f"{dataset}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{format}"
+        
+        logger.info(f"📤 Export of {dataset} started by {username} ({format}, query={query})")
+        
+        if config.get("archived"):
+            rows = stream_archived_export(collection, query, config["fields"], format, batch_size, dataset)
+        else:
+            rows = stream_export_rows([collection], query, config["fields"], format, batch_size, dataset)
+        return StreamingResponse(
+            rows,
+            media_type=media_type,
+            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Export {dataset} error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to start export")
+
 # -------------------- Static File Serving --------------------
 
-# Mount static file directories
+# Mount static file directories (/static is served by the asset pipeline below)
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
-if os.path.exists("static"):
-    app.mount("/static", StaticFiles(directory="static"), name="static")
+# -------------------- Fingerprinted Static Assets --------------------
+
+class StaticAssetPipeline:
+    """Content-hashed, precompressed copies of ``static/``
+    
+    Hashed paths (listed in static/dist/manifest.json) are served under
+    /assets with immutable caching; the plain /static paths serve the same
+    precompressed buffers, revalidated through their ETag.
+    """
+    
+    IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+    REVALIDATE_CACHE_CONTROL = "public, max-age=300"
+    
+    def __init__(self, source_dir: str = "static", output_dir: str = "static/dist"):
+        self.source_dir = source_dir
+        self.output_dir = output_dir
+        self.manifest: Dict[str, str] = {}  # logical path -> hashed path
+        self.assets: Dict[str, CompressedAsset] = {}  # hashed path -> asset
+    
+    def build(self) -> int:
+        """Hash, compress and write every source asset; returns the asset count"""
+        manifest, assets = {}, {}
+        os.makedirs(self.output_dir, exist_ok=True)
+        output_root = os.path.abspath(self.output_dir)
+        
+        for root, dirs, files in os.walk(self.source_dir):
+            dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) != output_root]
+            for filename in sorted(files):
+                source_path = os.path.join(root, filename)
+                logical_path = os.path.relpath(source_path, self.source_dir).replace(os.sep, "/")
+                
+                with open(source_path, "rb") as source_file:
+                    body = source_file.read()
+                
+                stem, extension = os.path.splitext(logical_path)
+                hashed_path = f"{stem}.{hashlib.sha256(body).hexdigest()[:12]}{extension}"
+                media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                asset = CompressedAsset(body, media_type, self.IMMUTABLE_CACHE_CONTROL)
+                
+                self._write_variants(hashed_path, asset)
+                manifest[logical_path] = hashed_path
+                assets[hashed_path] = asset
+        
+        with open(os.path.join(self.output_dir, "manifest.json"), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        
+        self.manifest, self.assets = manifest, assets
+        return len(assets)
+    
+    def _write_variants(self, hashed_path: str, asset: CompressedAsset):
+        """Write the hashed file and its .gz/.br siblings (skipped if already built)"""
+        target = os.path.join(self.output_dir, hashed_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        suffixes = {"identity": "", "gzip": ".gz", "br": ".br"}
+        for encoding, body in asset.variants.items():
+            path = target + suffixes[encoding]
+            if not os.path.exists(path):
+                with open(path, "wb") as output_file:
+                    output_file.write(body)
+    
+    def source_asset(self, logical_path: str) -> Optional[CompressedAsset]:
+        """Built asset for an unhashed path under static/, if there is one"""
+        hashed_path = self.manifest.get(logical_path)
+        return self.assets.get(hashed_path) if hashed_path is not None else None
+    
+    def respond(self, hashed_path: str, request: Request) -> Response:
+        """Serve a built asset with Content-Encoding negotiation"""
+        asset = self.assets.get(hashed_path)
+        if asset is None:
+            raise HTTPException(status_code=404, detail="Asset not found")
+        return asset.response(request)
+
+static_assets = StaticAssetPipeline()
+
+@app.get("/assets/{asset_path:path}")
+async def serve_static_asset(asset_path: str, request: Request):
+    """Fingerprinted static asset (long-lived immutable cache)"""
+    return static_assets.respond(asset_path, request)
+
+# Files the pipeline did not build (e.g. static/dist itself) come straight from disk
+static_files = StaticFiles(directory="static", check_dir=False)
+
+@app.get("/static/{asset_path:path}")
+async def serve_static_file(asset_path: str, request: Request):
+    """Static file by its plain path, precompressed when the pipeline built it"""
+    asset = static_assets.source_asset(asset_path)
+    if asset is not None:
+        return asset.response(request, cache_control=static_assets.REVALIDATE_CACHE_CONTROL)
+    return await static_files.get_response(asset_path, request.scope)
 
 
 
@@ -6173,8 +11216,7 @@ if os.path.exists("static"):
 
 # -------------------- Device Verification System --------------------
 
-@app.get("/verify")
-async def verification_page(user_id: int):
+def render_verification_page() -> str:
     """Enhanced device verification page with advanced fingerprinting"""
     html_content = f"""
 <!DOCTYPE html>
@@ -6458,7 +11500,8 @@ async def verification_page(user_id: int):
     </div>
 
     <script>
-        const USER_ID = {user_id};
+        // Read from the query string so the page itself is identical for every user
+        const USER_ID = parseInt(new URLSearchParams(window.location.search).get('user_id'), 10);
         let deviceFingerprint = {{}};
         let verificationInProgress = false;
         
@@ -6768,7 +11811,14 @@ async def verification_page(user_id: int):
 </html>
     """
     
-    return HTMLResponse(content=html_content)
+    return html_content
+
+prerendered_pages.register("verify", render_verification_page, cache_control="public, max-age=300")
+
+@app.get("/verify")
+async def verification_page(request: Request, user_id: int):
+    """Device verification page (pre-rendered; the script reads user_id from the URL)"""
+    return prerendered_pages.respond("verify", request)
 
 @app.post("/api/verify-device")
 async def verify_device_api(request: Request):
@@ -6821,8 +11871,7 @@ async def verify_device_api(request: Request):
 
 # -------------------- Admin Panel Frontend Integration --------------------
 
-@app.get("/admin")
-async def admin_panel_login():
+def render_admin_login_page() -> str:
     """Admin panel login page"""
     html_content = """
 <!DOCTYPE html>
@@ -7031,10 +12080,16 @@ async def admin_panel_login():
 </html>
     """
     
-    return HTMLResponse(content=html_content)
+    return html_content
 
-@app.get("/admin/dashboard")
-async def admin_dashboard_page():
+prerendered_pages.register("admin_login", render_admin_login_page)
+
+@app.get("/admin")
+async def admin_panel_login(request: Request):
+    """Admin panel login page"""
+    return prerendered_pages.respond("admin_login", request)
+
+def render_admin_dashboard_page() -> str:
     """Admin dashboard React application"""
     html_content = """
 <!DOCTYPE html>
@@ -7630,7 +12685,14 @@ async def admin_dashboard_page():
 </html>
     """
     
-    return HTMLResponse(content=html_content)
+    return html_content
+
+prerendered_pages.register("admin_dashboard", render_admin_dashboard_page)
+
+@app.get("/admin/dashboard")
+async def admin_dashboard_page(request: Request):
+    """Admin dashboard React application"""
+    return prerendered_pages.respond("admin_dashboard", request)
 
 # -------------------- Error Pages --------------------
 
@@ -7689,78 +12751,78 @@ async def internal_server_error_handler(request: Request, exc):
 
 # -------------------- Health Check Endpoints --------------------
 
-@app.get("/health")
-async def comprehensive_health_check():
-    """Comprehensive health check for monitoring systems"""
-    try:
-        health_status = {
-            "status": "healthy",
-            "service": "enterprise-wallet-bot",
-            "version": "1.0.0",
-            "timestamp": datetime.utcnow().isoformat(),
-            "uptime": None,
-            "components": {}
-        }
-        
-        # Database health check
-        if db_connected and db_client:
-            try:
-                await db_client.admin.command('ping')
-                health_status["components"]["database"] = {
-                    "status": "healthy",
-                    "type": "mongodb",
-                    "response_time_ms": None
-                }
-            except Exception as e:
-                health_status["components"]["database"] = {
-                    "status": "unhealthy",
-                    "error": str(e),
-                    "type": "mongodb"
-                }
-                health_status["status"] = "degraded"
-        else:
-            health_status["components"]["database"] = {
-                "status": "disconnected",
-                "type": "mongodb"
-            }
-            health_status["status"] = "unhealthy"
-        
-        # Bot health check
-        if wallet_bot and wallet_bot.initialized:
-            try:
-                bot_info = await wallet_bot.bot.get_me()
-                health_status["components"]["telegram_bot"] = {
-                    "status": "healthy",
-                    "bot_username": bot_info.username,
-                    "bot_id": bot_info.id,
-                    "webhook_active": wallet_bot.webhook_set
-                }
-            except Exception as e:
-                health_status["components"]["telegram_bot"] = {
-                    "status": "unhealthy",
-                    "error": str(e)
-                }
-                health_status["status"] = "degraded"
-        else:
-            health_status["components"]["telegram_bot"] = {
-                "status": "not_initialized"
-            }
-            health_status["status"] = "unhealthy"
-        
-        # Payment system health check
+def _queue_depths() -> Dict[tuple, float]:
+    depths = {
+        ("withdrawal_workers",): withdrawal_queue.status()["busy_workers"]
+    }
+    if wallet_bot and getattr(wallet_bot, "application", None) is not None:
+        depths[("telegram_updates",)] = wallet_bot.application.update_queue.qsize()
+    return depths
+
+metrics.gauge("walletbot_queue_depth", "Items waiting in in-process queues", ("queue",), callback=_queue_depths)
+
+@app.get("/metrics")
+async def prometheus_metrics(request: Request):
+    """Prometheus scrape endpoint"""
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+class HealthMonitor:
+    """Runs component probes in the background and keeps the latest snapshot
+    
+    Each probe records its status, measured latency and check time. The
+    payment probe also picks up gateway setting changes made by other
+    replicas (initialize_gateways is a no-op when nothing changed).
+    """
+    
+    def __init__(self, interval_seconds: int = HEALTH_PROBE_INTERVAL_SECONDS,
+                 timeout_seconds: float = HEALTH_PROBE_TIMEOUT_SECONDS):
+        self.interval_seconds = interval_seconds
+        self.timeout_seconds = timeout_seconds
+        self.started_at = datetime.utcnow()
+        self.components: Dict[str, Dict[str, Any]] = {}
+        self.status = "starting"
+        self.checked_at: Optional[datetime] = None
+        self.bot_info: Dict[str, Any] = {}
+    
+    async def _timed(self, probe) -> Dict[str, Any]:
+        """Run one probe with a timeout, adding latency and timestamp"""
+        started = time.perf_counter()
         try:
-            await payment_manager.initialize_gateways()
-            health_status["components"]["payment_system"] = {
-                "status": "healthy",
-                "gateways_count": len(payment_manager.gateways)
-            }
+            result = await asyncio.wait_for(probe(), timeout=self.timeout_seconds)
+        except asyncio.TimeoutError:
+            result = {"status": "unhealthy", "error": f"timed out after {self.timeout_seconds}s"}
         except Exception as e:
-            health_status["components"]["payment_system"] = {
-                "status": "degraded",
-                "error": str(e)
-            }
-        
-        # File system health check
+            result = {"status": "unhealthy", "error": str(e)}
+        result["response_time_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        result["checked_at"] = datetime.utcnow().isoformat()
+        return result
+    
+    async def probe_database(self) -> Dict[str, Any]:
+        if not (db_connected and db_client):
+            return {"status": "disconnected", "type": "mongodb"}
+        await db_client.admin.command('ping')
+        return {"status": "healthy", "type": "mongodb"}
+    
+    async def probe_telegram_bot(self) -> Dict[str, Any]:
+        if not (wallet_bot and wallet_bot.initialized):
+            return {"status": "not_initialized"}
+        bot_info = await wallet_bot.bot.get_me()
+        self.bot_info = {"bot_username": bot_info.username, "bot_id": bot_info.id}
+        return {"status": "healthy", **self.bot_info, "webhook_active": wallet_bot.webhook_set}
+    
+    async def probe_payment_system(self) -> Dict[str, Any]:
+        rebuilt = await payment_manager.initialize_gateways()
+        return {
+            "status": "healthy",
+            "gateways_count": len(payment_manager.gateways),
+            "gateways_rebuilt": rebuilt,
+            "gateways_initialized_at": payment_manager.gateways_initialized_at.isoformat()
+            if payment_manager.gateways_initialized_at else None
+        }
+    
+    async def probe_file_system(self) -> Dict[str, Any]:
         required_dirs = ["uploads/screenshots", "uploads/campaign_images", "uploads/admin_images"]
         fs_status = "healthy"
         for directory in required_dirs:
@@ -7770,51 +12832,98 @@ async def comprehensive_health_check():
                 except Exception:
                     fs_status = "degraded"
                     break
-        
-        health_status["components"]["file_system"] = {
-            "status": fs_status,
-            "directories": required_dirs
-        }
-        
-        # Manager components health check
-        managers_status = {
-            "user_model": "healthy" if user_model else "not_initialized",
-            "campaign_manager": "healthy" if campaign_manager else "not_initialized", 
-            "screenshot_manager": "healthy" if screenshot_manager else "not_initialized",
-            "gift_code_manager": "healthy" if gift_code_manager else "not_initialized",
-            "payment_manager": "healthy" if payment_manager else "not_initialized",
-            "channel_manager": "healthy" if channel_manager else "not_initialized",
-            "button_manager": "healthy" if button_manager else "not_initialized",
-            "api_integration_manager": "healthy" if api_integration_manager else "not_initialized"
-        }
-        
-        health_status["components"]["managers"] = managers_status
-        
-        # Overall system features check
-        health_status["features"] = {
-            "device_verification": "enabled",
-            "campaign_system": "enabled", 
-            "screenshot_processing": "enabled",
-            "gift_code_system": "enabled",
-            "withdrawal_system": "enabled",
-            "referral_system": "enabled",
-            "channel_verification": "enabled",
-            "admin_panel": "enabled",
-            "api_integration": "enabled",
-            "multi_gateway_payments": "enabled"
+        return {"status": fs_status, "directories": required_dirs}
+    
+    async def run_probes(self):
+        """Refresh every component concurrently and recompute overall status"""
+        probes = {
+            "database": self.probe_database,
+            "telegram_bot": self.probe_telegram_bot,
+            "payment_system": self.probe_payment_system,
+            "file_system": self.probe_file_system
         }
-        
-        return health_status
-        
-    except Exception as e:
-        logger.error(f"❌ Health check error: {e}")
+        results = await asyncio.gather(*(self._timed(probe) for probe in probes.values()))
+        components = dict(zip(probes, results))
+        
+        if components["payment_system"]["status"] == "unhealthy":
+            components["payment_system"]["status"] = "degraded"
+        
+        status = "healthy"
+        for name in ("database", "telegram_bot"):
+            component_status = components[name]["status"]
+            if component_status in ("disconnected", "not_initialized"):
+                status = "unhealthy"
+            elif component_status != "healthy" and status == "healthy":
+                status = "degraded"
+        
+        self.components = components
+        self.status = status
+        self.checked_at = datetime.utcnow()
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Latest probe results; marked degraded if the probes stopped running"""
+        status = self.status
+        stale = self.checked_at is not None and (
+            datetime.utcnow() - self.checked_at
+        ).total_seconds() > self.interval_seconds * 3
+        if stale and status == "healthy":
+            status = "degraded"
         return {
-            "status": "unhealthy",
-            "service": "enterprise-wallet-bot", 
-            "error": str(e),
-            "timestamp": datetime.utcnow().isoformat()
+            "status": status,
+            "uptime": round((datetime.utcnow() - self.started_at).total_seconds()),
+            "checked_at": self.checked_at.isoformat() if self.checked_at else None,
+            "stale": stale,
+            "components": dict(self.components)
         }
 
+health_monitor = HealthMonitor()
+if QUERY_PROFILER_ENABLED:
+    periodic_tasks.append(PeriodicTask("query_profiler_explain", query_profiler.explain_top_shapes, 1800, initial_delay=600))
+periodic_tasks.append(PeriodicTask("health_probes", health_monitor.run_probes, HEALTH_PROBE_INTERVAL_SECONDS))
+
+@app.get("/health")
+async def comprehensive_health_check():
+    """Comprehensive health check for monitoring systems (served from the background probe snapshot)"""
+    snapshot = health_monitor.snapshot()
+    health_status = {
+        "status": snapshot["status"],
+        "service": "enterprise-wallet-bot",
+        "version": "1.0.0",
+        "timestamp": datetime.utcnow().isoformat(),
+        "uptime": snapshot["uptime"],
+        "checked_at": snapshot["checked_at"],
+        "stale": snapshot["stale"],
+        "components": snapshot["components"]
+    }
+    
+    # Manager components health check
+    health_status["components"]["managers"] = {
+        "user_model": "healthy" if user_model else "not_initialized",
+        "campaign_manager": "healthy" if campaign_manager else "not_initialized", 
+        "screenshot_manager": "healthy" if screenshot_manager else "not_initialized",
+        "gift_code_manager": "healthy" if gift_code_manager else "not_initialized",
+        "payment_manager": "healthy" if payment_manager else "not_initialized",
+        "channel_manager": "healthy" if channel_manager else "not_initialized",
+        "button_manager": "healthy" if button_manager else "not_initialized",
+        "api_integration_manager": "healthy" if api_integration_manager else "not_initialized"
+    }
+    
+    # Overall system features check
+    health_status["features"] = {
+        "device_verification": "enabled",
+        "campaign_system": "enabled", 
+        "screenshot_processing": "enabled",
+        "gift_code_system": "enabled",
+        "withdrawal_system": "enabled",
+        "referral_system": "enabled",
+        "channel_verification": "enabled",
+        "admin_panel": "enabled",
+        "api_integration": "enabled",
+        "multi_gateway_payments": "enabled"
+    }
+    
+    return health_status
+
 @app.get("/health/simple")
 async def simple_health_check():
     """Simple health check for load balancers"""
@@ -8006,6 +13115,34 @@ async def setup_telegram_webhook():
         wallet_bot.webhook_set = False
         return False
 
+async def ensure_telegram_webhook():
+    """Cluster-mode webhook registration, run by the lease holder on election
+    
+    Unlike setup_telegram_webhook this never deletes the webhook or drops
+    pending updates: other replicas keep serving while leadership moves.
+    """
+    if not wallet_bot or not wallet_bot.initialized:
+        logger.error("❌ Cannot check webhook - bot not initialized")
+        return False
+    if not RENDER_EXTERNAL_URL or RENDER_EXTERNAL_URL == "https://example.com":
+        logger.warning("⚠️ RENDER_EXTERNAL_URL not set - webhook not configured")
+        return False
+    
+    webhook_url = f"{RENDER_EXTERNAL_URL}/webhook"
+    webhook_info = await wallet_bot.bot.get_webhook_info()
+    if webhook_info.url != webhook_url:
+        logger.info(f"🔗 Leader registering webhook: {webhook_url}")
+        await wallet_bot.bot.set_webhook(
+            url=webhook_url,
+            allowed_updates=["message", "callback_query", "inline_query"],
+            max_connections=100
+        )
+    else:
+        logger.info(f"✅ Webhook already registered: {webhook_url}")
+    
+    wallet_bot.webhook_set = True
+    return True
+
 @app.post("/webhook")
 async def telegram_webhook_handler(request: Request):
     """Enhanced webhook handler with comprehensive logging and error handling"""
@@ -8032,14 +13169,30 @@ async def telegram_webhook_handler(request: Request):
             update_type = "inline_query"
             user_id = update_data["inline_query"]["from"]["id"]
         
-        logger.info(f"📨 Webhook: {update_type} from user {user_id}")
+        webhook_logger.info("📨 Webhook: %s from user %s", update_type, user_id)
         
         # Process update
         telegram_update = Update.de_json(update_data, wallet_bot.bot)
         
         if telegram_update:
             # Process update in application context
-            await wallet_bot.application.process_update(telegram_update)
+            started = time.perf_counter()
+            trace = UpdateQueryTrace(update_type)
+            trace_token = query_update_trace.set(trace)
+            origin_token = query_origin.set(f"webhook:{update_type}")
+            WEBHOOK_IN_FLIGHT.inc()
+            try:
+                with update_tracer.root_span(f"telegram.update.{update_type}", {
+                    "telegram.update_type": update_type,
+                    "telegram.update_id": update_data.get("update_id")
+                }):
+                    await wallet_bot.application.process_update(telegram_update)
+            finally:
+                WEBHOOK_IN_FLIGHT.dec()
+                WEBHOOK_SECONDS_BY_TYPE[update_type].observe(time.perf_counter() - started)
+                query_origin.reset(origin_token)
+                query_update_trace.reset(trace_token)
+                query_profiler.finish_update(trace)
             return {"status": "ok", "processed": True}
         else:
             logger.warning("⚠️ Failed to parse Telegram update")
@@ -8090,8 +13243,10 @@ async def startup_event():
             from telegram import Bot
             from telegram.ext import ApplicationBuilder
             
-            wallet_bot.bot = Bot(token=BOT_TOKEN)
-            wallet_bot.application = ApplicationBuilder().token(BOT_TOKEN).build()
+            wallet_bot.bot = Bot(token=BOT_TOKEN, request=TelegramMetricsRequest())
+            wallet_bot.application = ApplicationBuilder().token(BOT_TOKEN).request(
+                TelegramMetricsRequest(connection_pool_size=256)
+            ).build()
             
             # Setup handlers
             wallet_bot.setup_handlers()
@@ -8146,10 +13301,37 @@ async def startup_event():
     
     startup_tasks.append("✅ File System: Configured")
     
+    # Build fingerprinted static assets (before pages so they can reference them)
+    try:
+        asset_count = static_assets.build()
+        logger.info(f"📦 Built {asset_count} fingerprinted static assets")
+        startup_tasks.append("✅ Static Assets: Built")
+    except Exception as e:
+        logger.error(f"❌ Static asset build failed: {e}")
+        startup_tasks.append("⚠️ Static Assets: Unhashed Fallback")
+    
+    # Render HTML pages once into compressed buffers
+    try:
+        page_count = prerendered_pages.build_all()
+        logger.info(f"📄 Pre-rendered {page_count} HTML pages")
+        startup_tasks.append("✅ HTML Pages: Pre-rendered")
+    except Exception as e:
+        logger.error(f"❌ Page pre-rendering failed: {e}")
+        startup_tasks.append("⚠️ HTML Pages: Rendered On Demand")
+    
     # Phase 4: Webhook Configuration
     logger.info("📋 Phase 4: Webhook Configuration")
     
-    if RENDER_EXTERNAL_URL and RENDER_EXTERNAL_URL != "https://example.com":
+    if CLUSTER_MODE:
+        # Only the lease holder touches the webhook; re-checked on every election
+        leader_election.on_elected.append(ensure_telegram_webhook)
+        if await leader_election.campaign():
+            logger.info(f"👑 Cluster leader: {leader_election.node_id}")
+            startup_tasks.append("✅ Cluster: Leader (webhook owner)")
+        else:
+            logger.info(f"🧩 Cluster follower: {leader_election.node_id}")
+            startup_tasks.append("✅ Cluster: Follower")
+    elif RENDER_EXTERNAL_URL and RENDER_EXTERNAL_URL != "https://example.com":
         webhook_success = await setup_telegram_webhook()
         if webhook_success:
             logger.info("✅ Telegram webhook configured")
@@ -8161,6 +13343,13 @@ async def startup_event():
         logger.warning("⚠️ RENDER_EXTERNAL_URL not set - webhook not configured")
         startup_tasks.append("⚠️ Webhook: Not Configured (URL missing)")
     
+    # Background jobs (stats reconciliation, payout workers etc.)
+    withdrawal_queue.start()
+    for periodic_task in periodic_tasks:
+        periodic_task.start()
+    logger.info(f"⏲️ Started {len(periodic_tasks)} periodic background tasks")
+    startup_tasks.append(f"✅ Background Tasks: {len(periodic_tasks)} Running")
+    
     # Phase 5: System Validation
     logger.info("📋 Phase 5: System Validation")
     
@@ -8236,19 +13425,38 @@ async def shutdown_event():
     
     shutdown_tasks = []
     
+    # Stop periodic background tasks and payout workers
+    for periodic_task in periodic_tasks:
+        await periodic_task.stop()
+    await withdrawal_queue.stop()
+    try:
+        await partner_webhooks.flush()
+    except Exception as e:
+        logger.error(f"❌ Partner webhook flush error: {e}")
+    await gateway_http.close_all()
+    await leader_election.release()
+    try:
+        await api_integration_manager.flush_usage()
+    except Exception as e:
+        logger.error(f"❌ API usage flush error: {e}")
+    shutdown_tasks.append("✅ Background Tasks: Stopped")
+    
     # Shutdown Telegram bot
     if wallet_bot and wallet_bot.application:
         try:
             logger.info("🤖 Shutting down Telegram bot...")
             
-            # Delete webhook
-            try:
-                await wallet_bot.bot.delete_webhook()
-                logger.info("✅ Webhook removed")
-                shutdown_tasks.append("✅ Webhook: Removed")
-            except Exception as e:
-                logger.error(f"❌ Webhook removal error: {e}")
-                shutdown_tasks.append("❌ Webhook: Removal Failed")
+            # Delete webhook (in cluster mode the remaining replicas keep it)
+            if CLUSTER_MODE:
+                shutdown_tasks.append("✅ Webhook: Left To Cluster")
+            else:
+                try:
+                    await wallet_bot.bot.delete_webhook()
+                    logger.info("✅ Webhook removed")
+                    shutdown_tasks.append("✅ Webhook: Removed")
+                except Exception as e:
+                    logger.error(f"❌ Webhook removal error: {e}")
+                    shutdown_tasks.append("❌ Webhook: Removal Failed")
             
             # Stop application
             await wallet_bot.application.stop()
@@ -8336,16 +13544,22 @@ if __name__ == "__main__":
     logger.info(f"🌐 External URL: {RENDER_EXTERNAL_URL}")
     logger.info(f"🔌 Port: {PORT}")
     
+    # Clustered mode forks WEB_CONCURRENCY workers, which needs an import string
+    workers = WEB_CONCURRENCY if CLUSTER_MODE else 1
+    if workers > 1:
+        logger.info(f"🧩 Cluster mode: {workers} workers")
+    
     # Start the server
     uvicorn.run(
-        app,
+        "main:app" if workers > 1 else app,
         host="0.0.0.0",
         port=PORT,
         log_level="info",
+        log_config=None,  # uvicorn logs go through the queued root handler
         access_log=True,
         loop="asyncio",
         # Production optimizations
-        workers=1,  # Single worker for bot to avoid conflicts
+        workers=workers,  # >1 only in CLUSTER_MODE (shared state and leader lease)
         backlog=2048,
         timeout_keep_alive=30,
         timeout_graceful_shutdown=30